@@ -4,16 +4,28 @@
 # In[1]:
 
 
+from bson import ObjectId
 from pymongo import MongoClient
 import pandas as pd
+import argparse
 import ast
 import json
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
 from openpyxl import load_workbook
 import numpy as np
 
+from pickup_rules import classify_pickup_types
+from report_schema import apply_report_schema
+from report_store import VERSION_COLUMN, ReportConflict, get_report_store
+from run_metrics import recorded_run, set_run_info, stage, timed
+from status_rules import compute_status
+
 # Base log folder
 log_folder = r'logs'
 os.makedirs(log_folder, exist_ok=True)
@@ -50,217 +62,543 @@ def epoch_to_date(epoch_time):
         mongolog.error(f"Error converting epoch {epoch_time}: {e}")
         return pd.NaT
 
-def extract_date(data, target_label):
-    try:
-        if isinstance(data, str):
-            data_list = ast.literal_eval(data)
-        elif isinstance(data, list):
-            data_list = data
-        else:
-            mongolog.debug(f"Invalid data type for extract_date: {type(data)}")
-            return None
 
-        for item in data_list:
-            if isinstance(item, dict) and item.get('label') == target_label:
-                mongolog.debug(f"Found label {target_label} with value {item.get('value')}")
-                return item.get('value')
+# 'vectorized' converts a whole column of epochs at once; 'rowwise' applies epoch_to_date per value
+EPOCH_ENGINE = 'vectorized'
+
+DAY_MS = 24 * 60 * 60 * 1000
+EPOCH_DAY = date(1970, 1, 1)
+
+
+def _utc_offset_ms(seconds):
+    """Server-local UTC offset at a Unix time, as datetime.fromtimestamp applies it."""
+    return (datetime.fromtimestamp(seconds) - datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)).total_seconds() * 1000
+
+
+def epochs_to_dates(epochs):
+    """
+    Column version of epoch_to_date: millisecond epochs to 'dd-mm-YYYY' strings in local time.
+
+    The local offset is looked up once per distinct UTC day, and per value only on days with a
+    DST change, so the dates match epoch_to_date in any server time zone.
+    Missing values give NaT; values that cannot be read as a number are logged once and give NaT.
+    """
+    numeric = pd.to_numeric(epochs, errors='coerce')
+    invalid = numeric.isna() & epochs.notna()
+    if invalid.any():
+        mongolog.error(f"Error converting {int(invalid.sum())} epochs, e.g. {epochs[invalid].iloc[0]!r}")
+    # epoch_to_date truncates with int() before converting
+    millis = np.trunc(numeric.to_numpy(dtype=float))
+
+    codes, utc_days = pd.factorize(np.floor(millis / DAY_MS))
+    # one trailing NaN column for the missing-value code -1
+    day_offsets = np.full((2, len(utc_days) + 1), np.nan)
+    for i, day in enumerate(utc_days):
+        try:
+            day_offsets[:, i] = _utc_offset_ms(day * 86400), _utc_offset_ms((day + 1) * 86400 - 1)
+        except (OverflowError, OSError, ValueError) as e:
+            mongolog.error(f"Error converting epochs on UTC day {day:.0f}: {e}")
+    start, end = day_offsets[:, codes]
+    offsets = start.copy()
+    changing = np.isfinite(start) & np.isfinite(end) & (start != end)
+    for i in np.flatnonzero(changing):
+        offsets[i] = _utc_offset_ms(millis[i] / 1000)
+
+    codes, local_days = pd.factorize(np.floor((millis + offsets) / DAY_MS))
+    labels = [(EPOCH_DAY + timedelta(days=int(day))).strftime('%d-%m-%Y') for day in local_days]
+    labels = np.array(labels + [pd.NaT], dtype=object)
+    return pd.Series(labels[codes], index=epochs.index, dtype=object)
+
+
+def convert_epochs(epochs, engine=EPOCH_ENGINE):
+    if engine == 'rowwise':
+        return epochs.apply(epoch_to_date)
+    return epochs_to_dates(epochs)
+
+
+CLEARANCE_LABEL = 'Customs Clearance Complete'
+DUTY_INVOICE_LABEL = 'Custom Duties & Taxes Invoice'
+
+
+@lru_cache(maxsize=4096)
+def _parse_list_string(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    # Python-repr strings (single quotes, None/True) are not JSON
+    try:
+        return ast.literal_eval(text)
     except (SyntaxError, ValueError) as e:
-        mongolog.error(f"Error parsing data in extract_date: {e}")
+        mongolog.error(f"Error parsing list field: {e}")
         return None
+
+
+def parse_list_field(value):
+    """Decode a list-of-dicts field that may arrive as a native list or string-encoded; None if unusable."""
+    if isinstance(value, list):
+        return value
+    if isinstance(value, str):
+        parsed = _parse_list_string(value)
+        return parsed if isinstance(parsed, list) else None
     return None
 
-    
-def extract_duty_invoice(row):
-    try:
-        files = row['files']
-        if isinstance(files, str):
-            files = ast.literal_eval(files)
-        if isinstance(files, list):
-            duty_invoices = [item for item in files if item.get('label') == 'Custom Duties & Taxes Invoice']
-            if duty_invoices:
-                invoice = duty_invoices[0]
-                approved_status = invoice.get('approved', '').strip()
-                mongolog.debug(f"Duty invoice status: {approved_status}")
-                return pd.Series([row['createdOn'], approved_status or 'Pending'])
-        return pd.Series([None, None])
-    except Exception as e:
-        mongolog.error(f"Error in extract_duty_invoice for row {row['_id'] if '_id' in row else 'unknown'}: {e}")
-        return pd.Series([None, None])
 
-def contains_duty_invoice(files):
-    try:
-        if isinstance(files, str):
-            files = ast.literal_eval(files)
-        result = any(item.get('label') == 'Custom Duties & Taxes Invoice' for item in files)
-        mongolog.debug(f"contains_duty_invoice: {result}")
-        return result
-    except Exception as e:
-        mongolog.error(f"Error in contains_duty_invoice: {e}")
-        return False
+def parse_list_column(values):
+    return pd.Series([parse_list_field(value) for value in values.tolist()], index=values.index, dtype=object)
+
+
+def first_labelled_item(parsed, label):
+    """First dict with the given label in each parsed list, or None, for a whole column at once."""
+    items = parsed.explode()
+    labels = pd.Series(
+        [item.get('label') if isinstance(item, dict) else None for item in items.tolist()],
+        index=items.index, dtype=object,
+    )
+    matches = items[(labels == label).to_numpy()]
+    matches = matches[~matches.index.duplicated(keep='first')]
+    return matches.reindex(parsed.index).astype(object).where(lambda found: found.notna(), None)
+
+
+# MongoDB server details
+MONGO_HOST = "65.1.22.99"  # MongoDB server IP
+MONGO_PORT = "27017"  # MongoDB server port
+MONGO_DATABASE = "agdb-prod2"
+
+# Only bookings from this date onwards are tracked
+BOOKING_START_DATE = '2025-01-01'
+
+# Push the row filters below down to MongoDB so only the kept documents are transferred.
+# The same filters are still applied in pandas afterwards, so both modes give the same result.
+QUERY_PUSHDOWN = True
+
+# 'find' reads every collection and joins them in pandas.
+# 'pipeline' joins Bookings, SHEntities, Bookingdsr and Myactions on the server with an
+# aggregation pipeline, so rows for non-MSME bookings never reach this process.
+FETCH_ENGINE = 'find'
+
+# Number of collections read at the same time in fetch_data
+FETCH_WORKERS = 6
+
+# Documents pulled from a cursor and flattened together; bounds the raw documents held in memory
+FETCH_BATCH_SIZE = 5000
+
+# Query to fetch only required fields
+BOOKINGS_PROJECTION = {
+    "_id": 1,
+    "bookingDate": 1,
+    "entityId":1,
+    "status": 1,
+    "fba":1,
+    "contract.cargoTotals.totChargeableWeight":1,
+    "contract.fbaPallets":1,
+    "contract.shipmentType": 1,
+    "contract.shipmentScope": 1,
+    "contract.origin": 1,
+    "contract.finalPlaceOfDelivery":1,
+    "contract.destination": 1,
+}
+
+SHENTITIES_PROJECTION = {
+    "entityName": 1,
+    "entityId":1,
+    "customer.crossBorder.salesVertical":1
+}
+
+BOOKINGDSR_PROJECTION = {
+    "_id": 1,
+    "sob_pol":1,
+    "gatein_pol":1,
+    "hbl_number":1,
+    "mbl_number":1,
+    "etd_at_pol":1,
+    "stuffing_confirmation":1,
+    "pol_container_number":1,
+    "eta_fpod":1,
+    "gatein_fpod":1,
+    "carrier":1,
+    "consolidator":1,
+    "importClearance.label":1,
+    "importClearance.value":1,
+    "vdes.destination":1,
+    "vdes.atdfrompod":1,
+    "vdes.actual_delivery_date":1,
+    "vdes.total_package":1,
+    "last_free_date_at_fpod":1,
+    "delivery_order_release":1,
+    "remarks":1
+}
+
+MYACTIONS_PROJECTION = {
+    "_id.bookingNum": 1,
+    "actionName": 1,
+    "files":1,
+    "createdOn":1
+}
+
+ADDRESSDETAILS_PROJECTION = {
+    "_id": 1,
+    "fbacode":1
+}
+
+AGUSERS_PROJECTION = {"email":1}
+
+
+def build_query_filters(booking_start_date=BOOKING_START_DATE):
+    """Server-side filter documents for each collection read in fetch_data."""
+    return {
+        "Bookings": {
+            "status": {"$nin": ['CANCELLED', 'Cancellation Requested']},
+            "contract.shipmentType": 'LCL',
+            # bookingDate may be stored as an ISO string or as a BSON date
+            "$or": [
+                {"bookingDate": {"$gte": booking_start_date}},
+                {"bookingDate": {"$gte": datetime.strptime(booking_start_date, '%Y-%m-%d')}},
+            ],
+        },
+        "Myactions": {
+            "actionName": 'Invoice Acceptance',
+            # files may also arrive string-encoded; those are still checked in pandas
+            "$or": [
+                {"files.label": 'Custom Duties & Taxes Invoice'},
+                {"files": {"$type": "string"}},
+            ],
+        },
+        "Agusers": {
+            "email": {"$regex": '@agraga.com'},
+        },
+    }
+
+
+def projection_columns(projection):
+    """Top-level field names selected by a projection."""
+    return list(dict.fromkeys(field.split('.')[0] for field in projection))
+
+
+def documents_to_frame(documents, projection):
+    # Keep every projected column even when no document had it, so the prepare_* steps still apply
+    frame = pd.DataFrame(documents)
+    for column in projection_columns(projection):
+        if column not in frame.columns:
+            frame[column] = pd.Series(np.nan, index=frame.index, dtype=object)
+    return frame
+
+
+def read_in_batches(cursor, projection, prepare=None, batch_size=FETCH_BATCH_SIZE):
+    """
+    Turn a cursor into a DataFrame one batch at a time.
+
+    Each batch of raw documents is flattened and filtered by prepare before the next one is
+    read, so only one batch of Python dicts is alive at once; the kept rows are collected as
+    compact per-batch frames and concatenated at the end.
+    """
+    chunks = []
+    documents_read = 0
+    while True:
+        batch = list(islice(cursor, batch_size))
+        if not batch:
+            break
+        documents_read += len(batch)
+        frame = documents_to_frame(batch, projection)
+        del batch
+        if prepare is not None:
+            with stage(prepare.__name__) as flattened:
+                frame = prepare(frame)
+                flattened.rows = len(frame)
+        chunks.append(frame)
+
+    if not chunks:
+        frame = documents_to_frame([], projection)
+        return (prepare(frame) if prepare is not None else frame), 0
+    return pd.concat(chunks, ignore_index=True), documents_read
+
+
+def restrict_to_bookings(query_filters, booking_ids):
+    """
+    Narrow the Bookings, Bookingdsr and Myactions filters to the given booking IDs.
+    fetch_data then reads SHEntities for the entities of the bookings it found.
+    """
+    booking_ids = list(booking_ids)
+    return {
+        **query_filters,
+        "Bookings": {**query_filters.get("Bookings", {}), "_id": {"$in": booking_ids}},
+        "Bookingdsr": {**query_filters.get("Bookingdsr", {}), "_id": {"$in": booking_ids}},
+        "Myactions": {**query_filters.get("Myactions", {}), "_id.bookingNum": {"$in": booking_ids}},
+    }
+
+
+# Marker for flatten_nested: a value that is not a dict is passed through unchanged
+KEEP_VALUE = object()
+
+# output column: (path inside the nested document, default when missing, value when not a dict)
+CONTRACT_FIELDS = {
+    'shipmentType': (('shipmentType',), None, KEEP_VALUE),
+    'shipmentScope': (('shipmentScope',), None, KEEP_VALUE),
+    'fbaPallets': (('fbaPallets',), None, KEEP_VALUE),
+    'origin': (('origin',), None, KEEP_VALUE),
+    'finalPlaceOfDelivery': (('finalPlaceOfDelivery',), None, KEEP_VALUE),
+    'totChargeableWeight': (('cargoTotals', 'totChargeableWeight'), '', ''),
+}
+CUSTOMER_FIELDS = {
+    'salesVertical': (('crossBorder', 'salesVertical'), '', ''),
+}
+ACTION_ID_FIELDS = {
+    '_id': (('bookingNum',), None, KEEP_VALUE),
+}
+
+
+def flatten_nested(values, fields):
+    """
+    Pull several nested paths out of a column of dicts.
+
+    Replaces one .apply per field; fields maps each output column to
+    (path, default when missing, value when the cell is not a dict). The column is turned
+    into a plain list once and each path is read with a list comprehension, so there is no
+    Python function call per cell.
+    """
+    items = values.tolist()
+
+    flat = {}
+    for name, (path, missing, not_dict) in fields.items():
+        if not_dict is KEEP_VALUE:
+            column = [item.get(path[0], missing) if isinstance(item, dict) else item for item in items]
+        else:
+            column = [item.get(path[0], missing) if isinstance(item, dict) else not_dict for item in items]
+        for key in path[1:]:
+            # A non-dict at this level means the path is missing, or the top-level fallback was used
+            column = [item.get(key, missing) if isinstance(item, dict) else item for item in column]
+        # Columns come back as object; callers run infer_objects once rows have been filtered
+        flat[name] = pd.Series(column, index=values.index, dtype=object)
+    return pd.DataFrame(flat, index=values.index)
+
+
+def prepare_bookings(bookings):
+    bookings = bookings[~bookings['status'].isin(['CANCELLED', 'Cancellation Requested'])]
+    bookings['bookingDate'] = pd.to_datetime(bookings['bookingDate'])
+    bookings = bookings[bookings['bookingDate'] >= BOOKING_START_DATE]
+    # Extract vendor IDs from nested dictionary, all fields in one pass, then keep LCL bookings
+    contract = flatten_nested(bookings['contract'], CONTRACT_FIELDS)
+    lcl = (contract['shipmentType'] == 'LCL').to_numpy()
+    bookings = bookings.drop(columns=['contract'])[lcl].join(contract[lcl].infer_objects())
+    return bookings
+
+
+def prepare_shentities(shentities):
+    shentities['salesVertical'] = flatten_nested(shentities['customer'], CUSTOMER_FIELDS)['salesVertical'].infer_objects()
+    return shentities
+
+
+def prepare_bookingdsr(bookingdsr):
+    clearance = first_labelled_item(parse_list_column(bookingdsr['importClearance']), CLEARANCE_LABEL)
+    bookingdsr['importClearance Date'] = [item.get('value') if item is not None else None for item in clearance.tolist()]
+    bookingdsr = bookingdsr.drop(columns=['importClearance'])
+    return bookingdsr
+
+
+def prepare_myactions(Myactions):
+    Myactions = Myactions[Myactions['actionName'] == 'Invoice Acceptance']
+    Myactions['_id'] = flatten_nested(Myactions['_id'], ACTION_ID_FIELDS)['_id'].infer_objects()
+    Myactions['createdOn'] = convert_epochs(Myactions['createdOn'])
+    # files is decoded once here; merge_actions reads the parsed lists
+    Myactions['files'] = parse_list_column(Myactions['files'])
+    Myactions = Myactions[first_labelled_item(Myactions['files'], DUTY_INVOICE_LABEL).notna()]
+    return Myactions
+
+
+def prepare_agusers(Agusers):
+    return Agusers[Agusers['email'].str.contains('@agraga.com', na=False)]
+
+
+def merge_actions(bookings, Myactions):
+    bookings = pd.merge(bookings, Myactions[['_id', 'files', 'createdOn']], on='_id', how='left')
+    if bookings.empty:
+        return bookings.assign(**{'Duty Invoice': None, 'Duty Invoice Status': None})
+    invoices = first_labelled_item(parse_list_column(bookings['files']), DUTY_INVOICE_LABEL).tolist()
+    duty_invoice, duty_invoice_status = [], []
+    for invoice, created_on in zip(invoices, bookings['createdOn'].tolist()):
+        approved = invoice.get('approved', '') if invoice is not None else None
+        if isinstance(approved, str):
+            duty_invoice.append(created_on)
+            duty_invoice_status.append(approved.strip() or 'Pending')
+        else:
+            duty_invoice.append(None)
+            duty_invoice_status.append(None)
+    bookings['Duty Invoice'] = duty_invoice
+    bookings['Duty Invoice Status'] = duty_invoice_status
+    return bookings
+
+
+def build_booking_pipeline(query_filters):
+    """Aggregation pipeline returning in-scope MSME bookings joined with their entity, DSR and actions."""
+    return [
+        {"$match": query_filters["Bookings"]},
+        {"$project": BOOKINGS_PROJECTION},
+        {"$lookup": {"from": "SHEntities", "localField": "entityId", "foreignField": "entityId", "as": "shentity"}},
+        {"$unwind": "$shentity"},
+        {"$match": {"shentity.customer.crossBorder.salesVertical": 'MSME'}},
+        {"$lookup": {"from": "Bookingdsr", "localField": "_id", "foreignField": "_id", "as": "dsr"}},
+        {"$unwind": {"path": "$dsr", "preserveNullAndEmptyArrays": True}},
+        {"$lookup": {"from": "Myactions", "localField": "_id", "foreignField": "_id.bookingNum", "as": "actions"}},
+        {"$addFields": {"actions": {"$filter": {
+            "input": "$actions",
+            "as": "action",
+            "cond": {"$eq": ["$$action.actionName", 'Invoice Acceptance']},
+        }}}},
+        {"$project": {
+            **BOOKINGS_PROJECTION,
+            **{f"shentity.{field}": 1 for field in SHENTITIES_PROJECTION},
+            **{f"dsr.{field}": 1 for field in BOOKINGDSR_PROJECTION},
+            # actions are keyed by the booking they were looked up for, so their _id is not needed
+            **{f"actions.{field}": 1 for field in MYACTIONS_PROJECTION if not field.startswith('_id')},
+        }},
+    ]
 
 
-def fetch_data():
-    # MongoDB server details
-    host = "65.1.22.99"  # MongoDB server IP
-    port = "27017"  # MongoDB server port
-    database_name = "agdb-prod2"
+@timed("join_pipeline_batch", rows=len)
+def join_pipeline_batch(docs):
+    """Rebuild the frame fetch_data produces with the 'find' engine from a batch of pipeline results."""
+    booking_docs, shentity_docs, dsr_docs, action_docs = [], [], [], []
+    for doc in docs:
+        shentity_docs.append(doc.pop('shentity'))
+        dsr = doc.pop('dsr', None)
+        if dsr:
+            dsr_docs.append(dsr)
+        action_docs.extend(dict(action, _id=doc['_id']) for action in doc.pop('actions', []))
+        booking_docs.append(doc)
+
+    bookings = documents_to_frame(booking_docs, BOOKINGS_PROJECTION)
+    shentities = documents_to_frame(shentity_docs, SHENTITIES_PROJECTION).set_index(bookings.index)
+
+    bookings = prepare_bookings(bookings)
+    shentities = prepare_shentities(shentities.loc[bookings.index])
+    bookings[['entityName', 'salesVertical']] = shentities[['entityName', 'salesVertical']]
+
+    bookingdsr = pd.DataFrame(dsr_docs, columns=projection_columns(BOOKINGDSR_PROJECTION)).drop_duplicates('_id')
+    bookingdsr = prepare_bookingdsr(bookingdsr)
+    bookings = pd.merge(bookings, bookingdsr, on='_id', how='left')
+
+    Myactions = pd.DataFrame(action_docs, columns=['_id', 'actionName', 'files', 'createdOn'])
+    Myactions = prepare_myactions(Myactions)
+    bookings = merge_actions(bookings, Myactions)
+    return bookings
+
+
+def fetch_joined_bookings(db, query_filters, batch_size=FETCH_BATCH_SIZE):
+    """Run the server-side join, processing the result stream in batches."""
+    cursor = db["Bookings"].aggregate(build_booking_pipeline(query_filters), batchSize=batch_size)
+    chunks = []
+    while True:
+        batch = list(islice(cursor, batch_size))
+        if not batch:
+            break
+        chunks.append(join_pipeline_batch(batch))
+    if not chunks:
+        return join_pipeline_batch([])
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_collection(db, name, query, projection, prepare=None):
+    """Read one collection into a DataFrame, optionally cleaning it, and log how long each step took."""
+    mongolog.info(f"Fetching from {name} collection")
+    started = time.perf_counter()
+    with stage(f"fetch {name}") as fetched:
+        cursor = db[name].find(query, projection).batch_size(FETCH_BATCH_SIZE)
+        frame, documents_read = read_in_batches(cursor, projection, prepare)
+        fetched.rows = len(frame)
+    mongolog.info(f"Fetched {documents_read} {name} records in {time.perf_counter() - started:.2f}s, {len(frame)} kept")
+    return frame
+
+
+def read_joined_bookings(db, query_filters):
+    mongolog.info("Fetching joined MSME bookings with aggregation pipeline")
+    started = time.perf_counter()
+    with stage("fetch joined Bookings") as fetched:
+        bookings = fetch_joined_bookings(db, query_filters)
+        fetched.rows = len(bookings)
+    mongolog.info(f"Fetched {len(bookings)} joined booking rows in {time.perf_counter() - started:.2f}s")
+    return bookings
+
+
+def fetch_data(pushdown=QUERY_PUSHDOWN, engine=FETCH_ENGINE, booking_ids=None, workers=FETCH_WORKERS,
+               Addressdetails=None, users=True):
+    """
+    Read the tracker source collections from MongoDB.
+
+    Returns (bookings, shentities, bookingdsr, Myactions, Addressdetails, Agusers). With the
+    'pipeline' engine the joined bookings come straight from the server and shentities,
+    bookingdsr and Myactions are returned as None. When booking_ids is given only those
+    bookings (and their DSR, actions and entities) are read. An Addressdetails frame passed in
+    is used instead of reading the collection, and with users=False Agusers is not read and
+    is returned as None.
+    """
+    host = MONGO_HOST
+    port = MONGO_PORT
+    database_name = MONGO_DATABASE
+    # The pipeline engine always filters on the server
+    query_filters = build_query_filters() if pushdown or engine == 'pipeline' else {}
+    if booking_ids is not None:
+        query_filters = restrict_to_bookings(query_filters, booking_ids)
+    shentities = bookingdsr = Myactions = None
 
- 
     try:
-        mongolog.info("Connecting to MongoDB...")
-        # Create the connection
-        client = MongoClient(f'mongodb://{host}:{port}/')
+        mongolog.info(f"Connecting to MongoDB (engine: {engine}, query pushdown: {pushdown}, workers: {workers})...")
+        # Create the connection; one pooled client is shared by all fetch threads
+        client = MongoClient(f'mongodb://{host}:{port}/', maxPoolSize=max(workers, 10))
         db = client[database_name]
 
-        mongolog.info("Fetching from Bookings collection")
-        bookings_collection = db["Bookings"]
-
-        # Query to fetch only required fields
-        bookings_projection = {
-            "_id": 1,
-            "bookingDate": 1,
-            "entityId":1,
-            "status": 1,
-            "fba":1,
-            "contract.cargoTotals.totChargeableWeight":1,
-            "contract.fbaPallets":1,
-            "contract.shipmentType": 1,
-            "contract.shipmentScope": 1,
-            "contract.origin": 1,
-            "contract.finalPlaceOfDelivery":1,
-            "contract.destination": 1,
-
-        }
-
-        # Fetch data from Bookings collection
-        bookings_cursor = bookings_collection.find({}, bookings_projection)
-        bookings_data = list(bookings_cursor)
-
-        bookings = pd.DataFrame(bookings_data)
-        bookings = bookings[~bookings['status'].isin(['CANCELLED', 'Cancellation Requested'])]
-        bookings['bookingDate'] = pd.to_datetime(bookings['bookingDate'])
-        bookings = bookings[bookings['bookingDate'] >= '2025-01-01']
-        # Extract vendor IDs from nested dictionary
-        bookings['shipmentType'] = bookings['contract'].apply(lambda x: x.get('shipmentType') if isinstance(x, dict) else x)
-        bookings = bookings[bookings['shipmentType'] == 'LCL']
-        bookings['shipmentScope'] = bookings['contract'].apply(lambda x: x.get('shipmentScope') if isinstance(x, dict) else x)
-        bookings['fbaPallets'] = bookings['contract'].apply(lambda x: x.get('fbaPallets') if isinstance(x, dict) else x)
-        bookings['origin'] = bookings['contract'].apply(lambda x: x.get('origin') if isinstance(x, dict) else x)
-        bookings['finalPlaceOfDelivery'] = bookings['contract'].apply(lambda x: x.get('finalPlaceOfDelivery') if isinstance(x, dict) else x)
-        bookings['totChargeableWeight'] = bookings['contract'].apply(lambda x: x.get('cargoTotals', {}).get('totChargeableWeight', '') if isinstance(x, dict) else '')
-        bookings = bookings.drop(columns=['contract'])
-        mongolog.info(f"Fetched {len(bookings)} records from Bookings")
-
-        mongolog.info("Fetching from SHEntities collection")
-        shentities_collection = db["SHEntities"]
-
-        # Query to fetch only required fields
-        shentities_projection = {
-            "entityName": 1,
-            "entityId":1,
-            "customer.crossBorder.salesVertical":1
-        }
-
-        shentities_cursor = shentities_collection.find({}, shentities_projection)
-        shentities_data = list(shentities_cursor)
-
-        shentities = pd.DataFrame(shentities_data)
-        shentities['salesVertical'] = shentities['customer'].apply(lambda x: x.get('crossBorder', {}).get('salesVertical', '') if isinstance(x, dict) else '')
-        mongolog.info(f"Fetched {len(shentities)} SHEntities")
-
-        mongolog.info("Fetching from Bookingdsr collection")
-        bookingdsr_collection = db["Bookingdsr"]
-
-        # Query to fetch only required fields
-        bookingdsr_projection = {
-            "_id": 1,
-            "sob_pol":1,
-            "gatein_pol":1,
-            "hbl_number":1,
-            "mbl_number":1,
-            "etd_at_pol":1,
-            "stuffing_confirmation":1,
-            "pol_container_number":1,
-            "eta_fpod":1,
-            "sob_pol":1,
-            "gatein_fpod":1,
-            "carrier":1,
-            "consolidator":1,
-            "importClearance.label":1,
-            "importClearance.value":1,
-            "vdes.destination":1,
-            "vdes.atdfrompod":1,
-            "vdes.actual_delivery_date":1,
-            "vdes.total_package":1,
-            "last_free_date_at_fpod":1,
-            "delivery_order_release":1,
-            "remarks":1
-        }
-
-        bookingdsr_cursor = bookingdsr_collection.find({}, bookingdsr_projection)
-        bookingdsr_data = list(bookingdsr_cursor)
-
-        bookingdsr = pd.DataFrame(bookingdsr_data)
-        bookingdsr['importClearance Date'] = bookingdsr['importClearance'].apply(lambda x: extract_date(x, 'Customs Clearance Complete'))
-        bookingdsr = bookingdsr.drop(columns=['importClearance'])
-        mongolog.info(f"Fetched {len(bookingdsr)} Bookingdsr records")
-
-        mongolog.info("Fetching from Myactions collection")
-        Myactions_collection = db["Myactions"]
-        # Query to fetch only required fields
-        Myactions_projection = {
-            "_id.bookingNum": 1,
-            "actionName": 1,
-            "files":1,
-            "createdOn":1
-        }
-
-        Myactions_cursor = Myactions_collection.find({}, Myactions_projection)
-        Myactions_data = list(Myactions_cursor)
-
-        Myactions = pd.DataFrame(Myactions_data)
-        Myactions = Myactions[Myactions['actionName'] == 'Invoice Acceptance']
-        Myactions['_id'] = Myactions['_id'].apply(lambda x: x.get('bookingNum') if isinstance(x, dict) else x)
-        Myactions['createdOn'] = Myactions['createdOn'].apply(epoch_to_date)
-        Myactions = Myactions[Myactions['files'].apply(contains_duty_invoice)]
-        mongolog.info(f"Filtered to {len(Myactions)} Invoice Acceptance actions")
-        
-        mongolog.info("Fetching from Addressdetails collection")
-        Addressdetails_collection = db["Addressdetails"]
-        # Query to fetch only required fields
-        Addressdetails_projection = {
-            "_id": 1,
-            "fbacode":1
-        }
-
-        Addressdetails_cursor = Addressdetails_collection.find({}, Addressdetails_projection)
-        Addressdetails_data = list(Addressdetails_cursor)
-        Addressdetails = pd.DataFrame(Addressdetails_data)
-        mongolog.info(f"Fetched {len(Addressdetails)} Addressdetails records")
-        
-        mongolog.info("Fetching from Agusers collection")
-        Agusers_collection = db["Agusers"]
-        Agusers_projection = {"email":1}
-        Agusers_cursor = Agusers_collection.find({}, Agusers_projection)
-        Agusers_data = list(Agusers_cursor)
-        Agusers = pd.DataFrame(Agusers_data)
-        Agusers = Agusers[Agusers['email'].str.contains('@agraga.com', na=False)]
-        mongolog.info(f"Fetched {len(Agusers)} Agusers records")
-
-        bookings = pd.merge(bookings, shentities[['entityId', 'entityName', 'salesVertical']], on='entityId', how='left')
-        bookings = bookings[bookings['salesVertical'] == 'MSME']
-        bookings = pd.merge(bookings, bookingdsr, on='_id', how='left')
-        bookings = pd.merge(bookings, Myactions[['_id', 'files', 'createdOn']], on='_id', how='left')
-        bookings[['Duty Invoice', 'Duty Invoice Status']] = bookings.apply(extract_duty_invoice, axis=1)
+        tasks = {}
+        if Addressdetails is None:
+            tasks["Addressdetails"] = (read_collection, db, "Addressdetails", {}, ADDRESSDETAILS_PROJECTION)
+        if users:
+            tasks["Agusers"] = (read_collection, db, "Agusers", query_filters.get("Agusers", {}), AGUSERS_PROJECTION, prepare_agusers)
+        if engine == 'pipeline':
+            tasks["Bookings"] = (read_joined_bookings, db, query_filters)
+        else:
+            tasks.update({
+                "Bookings": (read_collection, db, "Bookings", query_filters.get("Bookings", {}), BOOKINGS_PROJECTION, prepare_bookings),
+                "Bookingdsr": (read_collection, db, "Bookingdsr", query_filters.get("Bookingdsr", {}), BOOKINGDSR_PROJECTION, prepare_bookingdsr),
+                "Myactions": (read_collection, db, "Myactions", query_filters.get("Myactions", {}), MYACTIONS_PROJECTION, prepare_myactions),
+            })
+            # A few changed bookings need only their own entities, which are known once they are read
+            if booking_ids is None:
+                tasks["SHEntities"] = (read_collection, db, "SHEntities", {}, SHENTITIES_PROJECTION, prepare_shentities)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {name: executor.submit(*task) for name, task in tasks.items()}
+            frames = {name: future.result() for name, future in futures.items()}
+        if engine != 'pipeline' and booking_ids is not None:
+            entity_ids = frames["Bookings"]['entityId'].dropna().unique().tolist()
+            frames["SHEntities"] = read_collection(db, "SHEntities", {"entityId": {"$in": entity_ids}}, SHENTITIES_PROJECTION, prepare_shentities)
+        mongolog.info(f"Fetched {len(frames)} collections in {time.perf_counter() - started:.2f}s")
+
+        bookings = frames["Bookings"]
+        Addressdetails = frames.get("Addressdetails", Addressdetails)
+        Agusers = frames.get("Agusers")
+        if engine != 'pipeline':
+            shentities, bookingdsr, Myactions = frames["SHEntities"], frames["Bookingdsr"], frames["Myactions"]
+            mongolog.info(f"Filtered to {len(Myactions)} Invoice Acceptance actions")
+
+        if engine != 'pipeline':
+            with stage("merge SHEntities") as merged:
+                bookings = pd.merge(bookings, shentities[['entityId', 'entityName', 'salesVertical']], on='entityId', how='left')
+                bookings = bookings[bookings['salesVertical'] == 'MSME']
+                merged.rows = len(bookings)
+            with stage("merge Bookingdsr") as merged:
+                bookings = pd.merge(bookings, bookingdsr, on='_id', how='left')
+                merged.rows = len(bookings)
+            with stage("merge Myactions") as merged:
+                bookings = merge_actions(bookings, Myactions)
+                merged.rows = len(bookings)
         mongolog.info("Merged all datasets successfully")
-        
+
 
         return bookings, shentities ,bookingdsr, Myactions ,Addressdetails, Agusers
  
     except Exception as e:
         mongolog.error(f"Error in fetch_data: {e}")
         mongolog.info('*'*100)
-        return None, None, None, None, None
+        return None, None, None, None, None, None
         
     finally:
         # Close the connection
@@ -273,205 +611,362 @@ def fetch_data():
             mongolog.info('*'*100)
 
 
+# Incremental refresh state
+WATERMARK_PATH = r"data/watermarks.json"
+
+# Change marker for each watched collection, and how a changed document leads to bookings.
+#
+# None of the source collections has an updated-at field, so the markers are fields that only
+# grow as documents are added: bookingDate on Bookings, createdOn (epoch milliseconds) on
+# Myactions and, on SHEntities, the ObjectId _id the server assigns on insert. Each marker must
+# keep one type across its collection. Incremental runs therefore pick up new bookings, actions
+# and customers. Edits to existing documents (a DSR update, an invoice approved after its action
+# was created) reach the report through the change stream listener (streamjob.py) or the daily
+# full refresh.
+#
+# Bookingdsr and Addressdetails have no marker: a DSR document's _id is its booking's and an
+# address's _id is the address itself. A booking's DSR is read whenever the booking is, and
+# addresses added after their bookings were processed are found by bookings_with_added_addresses.
+#
+# collection: (marker field, key read from a changed document, (collection, field) whose
+# documents referring to the key are the affected bookings, or None when the key is a booking ID)
+WATERMARK_FIELDS = {
+    "Bookings": ("bookingDate", "_id", None),
+    "Myactions": ("createdOn", "_id.bookingNum", None),
+    # a new customer's bookings are the ones that refer to its entityId
+    "SHEntities": ("_id", "entityId", ("Bookings", "entityId")),
+}
+
+# Incremental runs fall back to a full rebuild once the last one is older than this,
+# so edits to existing documents, which the markers do not show, are still picked up.
+FULL_REFRESH_INTERVAL_HOURS = 24
+
+
+def _encode_watermark(value):
+    if isinstance(value, datetime):
+        return {"type": "datetime", "value": value.isoformat()}
+    if isinstance(value, ObjectId):
+        return {"type": "objectid", "value": str(value)}
+    return {"type": "raw", "value": value}
+
+
+def _decode_watermark(entry):
+    if entry["type"] == "datetime":
+        return datetime.fromisoformat(entry["value"])
+    if entry["type"] == "objectid":
+        return ObjectId(entry["value"])
+    return entry["value"]
+
+
+def load_watermarks(path=WATERMARK_PATH):
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        state = json.load(f)
+    state["collections"] = {name: _decode_watermark(entry) for name, entry in state.get("collections", {}).items()}
+    return state
+
+
+def save_watermarks(state, path=WATERMARK_PATH):
+    state = dict(state, collections={name: _encode_watermark(value) for name, value in state["collections"].items()})
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _get_path(doc, dotted):
+    for part in dotted.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def scan_watermarks(db, since=None):
+    """
+    Return (changed booking IDs, new watermarks) for the watched collections.
+
+    With since=None only the current high-watermarks are read, for use before a full rebuild.
+    Matching uses $gte so documents written at the boundary are reprocessed rather than missed.
+    The booking IDs are None if some collection has no stored watermark to compare against,
+    since its changes cannot be found; the caller must run a full refresh instead.
+    """
+    booking_ids = set()
+    watermarks = {}
+    for collection, (field, key_path, referenced_by) in WATERMARK_FIELDS.items():
+        previous = (since or {}).get(collection)
+        if since is None or previous is None:
+            latest = list(db[collection].find({field: {"$exists": True}}, {field: 1}).sort(field, -1).limit(1))
+            watermarks[collection] = latest[0][field] if latest else None
+            if since is not None:
+                mongolog.warning(f"No watermark stored for {collection} ({field} missing or not yet recorded)")
+                booking_ids = None
+            continue
+
+        watermarks[collection] = previous
+        keys = set()
+        for doc in db[collection].find({field: {"$gte": previous}}, {field: 1, key_path: 1}):
+            key = _get_path(doc, key_path)
+            if key is not None:
+                keys.add(key)
+            if doc.get(field) is not None and doc[field] > watermarks[collection]:
+                watermarks[collection] = doc[field]
+        if referenced_by is not None and keys:
+            referring, reference_field = referenced_by
+            keys = {doc["_id"] for doc in db[referring].find({reference_field: {"$in": list(keys)}}, {"_id": 1})}
+        mongolog.info(f"{collection}: {len(keys)} bookings changed since {previous}")
+        if booking_ids is not None:
+            booking_ids |= keys
+
+    return booking_ids, watermarks
+
+
+def bookings_with_added_addresses(db, report):
+    """
+    Bookings in report with a delivery address that had no FBA code and now has one in Addressdetails.
+
+    Addressdetails has no change marker, so this is how an address added after its bookings were
+    processed reaches the report before the next full refresh.
+    """
+    addresses = report['Delivery Address'].fillna('').astype(str).str.strip()
+    fba_codes = report['FBA Code'].fillna('').astype(str).str.strip()
+    missing = report[(addresses != '') & (fba_codes == '')]
+    if missing.empty:
+        return set()
+    query = {"_id": {"$in": list(addresses[missing.index].unique())}, "fbacode": {"$nin": [None, '']}}
+    found = {doc["_id"] for doc in db["Addressdetails"].find(query, {"_id": 1})}
+    booking_ids = set(missing.loc[addresses[missing.index].isin(found), 'Agraga Booking #'])
+    mongolog.info(f"Addressdetails: {len(found)} addresses added for {len(booking_ids)} bookings without an FBA code")
+    return booking_ids
+
+
+def read_watermarks_from_mongo(since=None, report=None):
+    """scan_watermarks on the source database, adding bookings_with_added_addresses for report if given."""
+    client = MongoClient(f'mongodb://{MONGO_HOST}:{MONGO_PORT}/')
+    try:
+        db = client[MONGO_DATABASE]
+        booking_ids, watermarks = scan_watermarks(db, since)
+        if booking_ids is not None and report is not None:
+            booking_ids |= bookings_with_added_addresses(db, report)
+        return booking_ids, watermarks
+    finally:
+        client.close()
+
+
 # In[2]:
 
 
-def booking_process(bookings, Addressdetails):
-    booking_processlog.info("Started booking_process function")
-    result_rows = []  # Store all rows
+def build_fbacode_index(Addressdetails):
+    """Address _id -> fbacode, keeping the first row per _id like the old .loc[...].iloc[0] lookup."""
+    first = Addressdetails.drop_duplicates(subset='_id', keep='first')
+    index = dict(zip(first['_id'].tolist(), first['fbacode'].tolist()))
+    booking_processlog.info(f"Built FBA code index for {len(index)} addresses")
+    return index
+
+
+REPORT_COLUMNS = [
+    "Agraga Booking #", "Customer Name", "MBL#", "HBL#", "Booking Status", "FBA?", "ISF Filing",
+    "Stuffing Date", "Container #", "ETD", "ETA", "SOB", "ATA", "Carrier", "Consolidator",
+    "Origin", "FPOD", "CFS", "Delivery Address", "FBA Code", "Freight Broker", "Transporter", "Delivery Quote",
+    "Packages", "Pallets", "importClearance", "Duty Invoice", "Duty Invoice Status", "Actual # of Pallets", "Ready for Pick-up Date",
+    "LFD", "DO Release Approved?", "HBL Released Date", "DO Released Date", "Pick-up Date", "Pick up number",
+    "Delivery Appointment Date", "Delivery Date", "Vendor Delivery Invoice", "Updated Status Remarks", "PRO Number", "Storage Incurred (Days)",
+    "Remarks","status","pickup type"
+]
+
+# Report column -> column of the merged bookings frame, one value per booking
+BOOKING_REPORT_FIELDS = {
+    'Agraga Booking #': '_id',
+    'Customer Name': 'entityName',
+    'MBL#': 'mbl_number',
+    'HBL#': 'hbl_number',
+    'Booking Status': 'status',
+    'FBA?': 'fba',
+    'Stuffing Date': 'stuffing_confirmation',
+    'Container #': 'pol_container_number',
+    'ETD': 'etd_at_pol',
+    'ETA': 'eta_fpod',
+    'SOB': 'sob_pol',
+    'ATA': 'gatein_fpod',
+    'Carrier': 'carrier',
+    'Consolidator': 'consolidator',
+    'Origin': 'origin',
+    'FPOD': 'finalPlaceOfDelivery',
+    'Pallets': 'fbaPallets',
+    'importClearance': 'importClearance Date',
+    'Duty Invoice': 'Duty Invoice',
+    'Duty Invoice Status': 'Duty Invoice Status',
+    'LFD': 'last_free_date_at_fpod',
+    'DO Released Date': 'delivery_order_release',
+    'Updated Status Remarks': 'remarks',
+}
+
+# Report column -> key of a vdes leg, one value per delivery leg
+LEG_REPORT_FIELDS = {
+    'Delivery Address': 'destination',
+    'Packages': 'total_package',
+    'Pick-up Date': 'atdfrompod',
+    'Delivery Date': 'actual_delivery_date',
+}
+
+EXCLUDED_CUSTOMERS = ['Arora Foods']
+
+
+def parse_vdes_column(vdes, booking_ids):
+    """vdes as a list per booking; JSON strings are decoded and anything unusable becomes []."""
+    parsed = []
+    unusable = []
+    for booking_id, value in zip(booking_ids.tolist(), vdes.tolist()):
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except json.JSONDecodeError:
+                value = None
+        if isinstance(value, list):
+            parsed.append(value)
+        else:
+            parsed.append([])
+            if isinstance(value, str) or not pd.isna(value):
+                unusable.append(booking_id)
+    if unusable:
+        booking_processlog.warning(f"Unusable vdes for {len(unusable)} bookings, e.g. {unusable[:5]}")
+    return pd.Series(parsed, index=vdes.index, dtype=object)
 
-    for i, rows in bookings.iterrows():
-        try:
-            booking_id = rows['_id']
-            booking_date = rows['bookingDate']
-            status = rows['status']
-            fba = rows['fba']
-            shipmentType = rows['shipmentType']
-            shipmentScope = rows['shipmentScope']
-            fbaPallets = rows['fbaPallets']
-            origin = rows['origin']
-            fpod = rows['finalPlaceOfDelivery']
-            totChargeableWeight = rows['totChargeableWeight']
-            entityName = rows['entityName']
-            duty_invoice = rows['Duty Invoice']
-            duty_invoice_status = rows['Duty Invoice Status']
-
-            container_number = rows['pol_container_number']
-            gatein_pol = rows['gatein_pol']
-            sob_pol = rows['sob_pol']
-            hbl_number = rows['hbl_number']
-            mbl_number = rows['mbl_number']
-            gatein_fpod = rows['gatein_fpod']
-            delivery_order_release = rows['delivery_order_release']
-            remarks = rows['remarks']
-            stuffing_confirmation = rows['stuffing_confirmation']
-            etd_at_pol = rows['etd_at_pol']
-            eta_fpod = rows['eta_fpod']
-            last_free_date_at_fpod = rows['last_free_date_at_fpod']
-            carrier = rows['carrier']
-            consolidator = rows['consolidator']
-            importClearance = rows['importClearance Date']
-            vdes = rows['vdes']
-
-            booking_processlog.info(f"Processing Booking ID: {booking_id}")
-
-            # Ensure vdes is a list
-            if isinstance(vdes, str):
-                try:
-                    vdes = json.loads(vdes)
-                except json.JSONDecodeError:
-                    booking_processlog.warning(f"JSON parse error for Booking ID {booking_id}: {vdes}")
-                    vdes = []
-            elif not isinstance(vdes, list):
-                booking_processlog.warning(f"Unexpected vdes format for Booking ID {booking_id}: {vdes}")
-                vdes = []
-
-            if vdes:
-                for des in vdes:
-                    ad = des.get('destination', '')
-
-                    if ad:
-                        subAddressdetails = Addressdetails.loc[Addressdetails['_id'] == ad, 'fbacode']
-                        fbacode = subAddressdetails.iloc[0] if not subAddressdetails.empty else ''
-                    else:
-                        booking_processlog.warning(f"Missing destination in vdes for Booking ID {booking_id}")
-                        fbacode = ''
-
-                    row_data = {
-                        'Customer Name': entityName,
-                        'MBL#': mbl_number,
-                        'HBL#': hbl_number,
-                        'Agraga Booking #': booking_id,
-                        'Booking Status': status,
-                        'FBA?': fba,
-                        'ISF Filing': '',
-                        'Stuffing Date': stuffing_confirmation,
-                        'Container #': container_number,
-                        'ETD': etd_at_pol,
-                        'ETA': eta_fpod,
-                        'SOB': sob_pol,
-                        'ATA': gatein_fpod,
-                        'Carrier': carrier,
-                        'Consolidator': consolidator,
-                        'Origin': origin,
-                        'FPOD': fpod,
-                        'CFS': '',
-                        'Delivery Address': ad,
-                        'FBA Code': fbacode,
-                        'Freight Broker': '',
-                        'Transporter': '',
-                        'Delivery Quote': '',
-                        'Packages': des.get('total_package', ''),
-                        'Pallets': fbaPallets,
-                        'importClearance': importClearance,
-                        'Duty Invoice': duty_invoice,
-                        'Duty Invoice Status': duty_invoice_status,
-                        'Actual # of Pallets': '',
-                        'Ready for Pick-up Date': '',
-                        'LFD': last_free_date_at_fpod,
-                        'DO Release Approved?': '',
-                        'HBL Released Date': '',
-                        'DO Released Date': delivery_order_release,
-                        'Pick-up Date': des.get('atdfrompod', ''),
-                        'Pick up number': '',
-                        'Delivery Appointment Date': '',
-                        'Delivery Date': des.get('actual_delivery_date', ''),
-                        'Vendor Delivery Invoice': '',
-                        'Updated Status Remarks': remarks,
-                        'PRO Number': '',
-                        'Storage Incurred (Days)': '',
-                        'Remarks':'',
-                        'status':'',
-                        'pickup type':''
-                    }
-
-                    result_rows.append(row_data)
-            else:
-                # No vdes – create a single row
-                row_data = {
-                    'Customer Name': entityName,
-                    'MBL#': mbl_number,
-                    'HBL#': hbl_number,
-                    'Agraga Booking #': booking_id,
-                    'Booking Status': status,
-                    'FBA?': fba,
-                    'ISF Filing': '',
-                    'Stuffing Date': stuffing_confirmation,
-                    'Container #': container_number,
-                    'ETD': etd_at_pol,
-                    'ETA': eta_fpod,
-                    'SOB': sob_pol,
-                    'ATA': gatein_fpod,
-                    'Carrier': carrier,
-                    'Consolidator': consolidator,
-                    'Origin': origin,
-                    'FPOD': fpod,
-                    'CFS': '',
-                    'Delivery Address': '',
-                    'FBA Code': '',
-                    'Freight Broker': '',
-                    'Transporter': '',
-                    'Delivery Quote': '',
-                    'Packages': '',
-                    'Pallets': fbaPallets,
-                    'importClearance': importClearance,
-                    'Duty Invoice': duty_invoice,
-                    'Duty Invoice Status': duty_invoice_status,
-                    'Actual # of Pallets': '',
-                    'Ready for Pick-up Date': '',
-                    'LFD': last_free_date_at_fpod,
-                    'DO Release Approved?': '',
-                    'HBL Released Date': '',
-                    'DO Released Date': delivery_order_release,
-                    'Pick-up Date': '',
-                    'Pick up number': '',
-                    'Delivery Appointment Date': '',
-                    'Delivery Date': '',
-                    'Vendor Delivery Invoice': '',
-                    'Updated Status Remarks': remarks,
-                    'PRO Number': '',
-                    'Storage Incurred (Days)': '',
-                    'Remarks':'',
-                    'status':'',
-                    'pickup type':''
-                }
-
-                result_rows.append(row_data)
-
-        except Exception as e:
-            booking_processlog.error(f"Error processing Booking ID {rows.get('_id', 'UNKNOWN')}: {str(e)}")
-
-    final_df = pd.DataFrame(result_rows)
-    final_df = final_df[final_df['Customer Name'] != 'Arora Foods']
-    desired_columns = [
-        "Agraga Booking #", "Customer Name", "MBL#", "HBL#", "Booking Status", "FBA?", "ISF Filing",
-        "Stuffing Date", "Container #", "ETD", "ETA", "SOB", "ATA", "Carrier", "Consolidator",
-        "Origin", "FPOD", "CFS", "Delivery Address", "FBA Code", "Freight Broker", "Transporter", "Delivery Quote",
-        "Packages", "Pallets", "importClearance", "Duty Invoice", "Duty Invoice Status", "Actual # of Pallets", "Ready for Pick-up Date",
-        "LFD", "DO Release Approved?", "HBL Released Date", "DO Released Date", "Pick-up Date", "Pick up number",
-        "Delivery Appointment Date", "Delivery Date", "Vendor Delivery Invoice", "Updated Status Remarks", "PRO Number", "Storage Incurred (Days)",
-        "Remarks","status","pickup type"
+
+@timed("booking_process", rows=len)
+def booking_process(bookings, Addressdetails):
+    """
+    One report row per vdes delivery leg, or a single row for bookings without legs.
+
+    vdes is exploded into one row per leg, the booking-level columns are repeated onto their
+    legs with a single positional take, and the leg fields are read column-wise.
+    """
+    booking_processlog.info(f"Started booking_process for {len(bookings)} bookings")
+    fbacodes = build_fbacode_index(Addressdetails)
+
+    bookings = bookings.reset_index(drop=True)
+    legs = parse_vdes_column(bookings['vdes'], bookings['_id']).explode()
+    # Legs that are not dicts cannot be read; bookings without legs keep their NaN placeholder
+    is_leg = np.array([isinstance(leg, dict) for leg in legs.tolist()], dtype=bool)
+    no_legs = legs.isna().to_numpy()
+    if (~is_leg & ~no_legs).any():
+        booking_processlog.warning(f"Skipped {int((~is_leg & ~no_legs).sum())} vdes legs that are not objects")
+    legs = legs[is_leg | no_legs]
+
+    final_df = bookings.take(legs.index.to_numpy())[list(BOOKING_REPORT_FIELDS.values())]
+    final_df.columns = list(BOOKING_REPORT_FIELDS)
+    final_df = final_df.reset_index(drop=True)
+
+    leg_values = legs.tolist()
+    for column, key in LEG_REPORT_FIELDS.items():
+        final_df[column] = [leg.get(key, '') if isinstance(leg, dict) else '' for leg in leg_values]
+    final_df['FBA Code'] = [
+        fbacodes.get(destination, '') if destination else ''
+        for destination in final_df['Delivery Address'].tolist()
     ]
+    missing_destination = sum(isinstance(leg, dict) and not leg.get('destination', '') for leg in leg_values)
+    if missing_destination:
+        booking_processlog.warning(f"Missing destination in {missing_destination} vdes legs")
 
-    final_df = final_df.reindex(columns=desired_columns)
+    rows_created = len(final_df)
+    final_df = final_df[~final_df['Customer Name'].isin(EXCLUDED_CUSTOMERS)]
+    # Every other report column starts blank and is filled in by the role pages
+    final_df = final_df.reindex(columns=REPORT_COLUMNS, fill_value='')
 
-    booking_processlog.info(f"Finished booking_process with {len(result_rows)} rows created.")
+    booking_processlog.info(f"Finished booking_process with {rows_created} rows created.")
     booking_processlog.info('*'*100)
-    
-    return final_df
 
-def process_report(existing_report, generated_report):
+    return apply_report_schema(final_df)
+
+def columns_equal(left, right):
+    """Element-wise equality of two aligned Series, with missing on both sides counting as equal."""
+    both_missing = left.isna().to_numpy() & right.isna().to_numpy()
+    try:
+        same = (left == right).to_numpy(dtype=bool, na_value=False)
+    except TypeError:
+        same = np.array([a == b for a, b in zip(left.tolist(), right.tolist())], dtype=bool)
+    return same | both_missing
+
+
+def rows_changed(existing, generated):
+    """Boolean mask of rows where any column differs, for two frames aligned on index and columns."""
+    changed = np.zeros(len(existing), dtype=bool)
+    for col in existing.columns:
+        changed |= ~columns_equal(existing[col], generated[col])
+    return changed
+
+
+REPORT_HASHES_PATH = r"data/report_hashes.json"
+
+# A merge is redone from a fresh read if the report is edited while it runs; give up after this many
+REPORT_SAVE_ATTEMPTS = 3
+
+
+def row_hashes(frame, columns):
+    """Stable 64-bit hash of each row over the given columns."""
+    return pd.util.hash_pandas_object(frame[columns], index=False).to_numpy()
+
+
+def load_row_hashes(stamp, path=REPORT_HASHES_PATH):
+    """
+    Row hashes saved by the last comparison, keyed by composite key.
+
+    They describe the report as process_report wrote it, so they are only used while the stored
+    report's stamp is still the one they were saved with; after an edit from a role page every row
+    is compared in full again.
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        state = json.load(f)
+    if state.get("report") != stamp:
+        comparisonlog.info("Report changed since the last comparison, row hashes not used")
+        return {}
+    return {"columns": state["columns"], "rows": state["rows"]}
+
+
+def save_row_hashes(row_hashes, stamp, path=REPORT_HASHES_PATH):
+    state = dict(row_hashes, report=stamp)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+@timed("process_report", rows=lambda result: len(result[0]))
+def process_report(existing_report, generated_report, stored_hashes=None):
+    """
+    Merge a freshly generated report into the existing one.
+
+    Returns the merged report and the row hashes to save with it. Rows whose hash matches
+    stored_hashes (from load_row_hashes) are known to be unchanged and are not compared.
+    """
     key_col = 'Agraga Booking #'
     exclude_cols = [
         'ISF Filing', 'CFS', 'Freight Broker', 'Transporter', 'Delivery Quote',
         'Actual # of Pallets', 'Ready for Pick-up Date', 'DO Release Approved?',
         'HBL Released Date', 'Pick up number', 'Delivery Appointment Date',
-        'Vendor Delivery Invoice', 'PRO Number', 'Storage Incurred (Days)', 'Remarks','status','pickup type'
+        'Vendor Delivery Invoice', 'PRO Number', 'Storage Incurred (Days)', 'Remarks','status','pickup type',
+        VERSION_COLUMN
     ]
 
+    compare_cols = [col for col in existing_report.columns if col not in exclude_cols + [key_col]]
+
     # Save original dtypes of existing report
     original_dtypes = existing_report.dtypes
 
+    # Categoricals are compared and merged as plain values; two reports rarely share categories
+    for frame in (existing_report, generated_report):
+        for col in frame.columns:
+            if isinstance(frame[col].dtype, pd.CategoricalDtype):
+                frame[col] = frame[col].astype(object)
+
+    # Hashed before any dtype alignment so the same content always gives the same hash
+    incoming_hashes = row_hashes(generated_report, compare_cols)
+    stored_hashes = stored_hashes or {}
+    stored_rows = stored_hashes.get("rows", {}) if stored_hashes.get("columns") == compare_cols else {}
+
     # Convert existing report dtypes to match generated report for comparison
     for col in existing_report.columns:
         if col in generated_report.columns:
@@ -481,8 +976,6 @@ def process_report(existing_report, generated_report):
                 existing_report[col] = existing_report[col].astype("object")
                 generated_report[col] = generated_report[col].astype("object")
 
-    compare_cols = [col for col in existing_report.columns if col not in exclude_cols + [key_col]]
-
     comparisonlog.info(f"Total existing rows: {len(existing_report)}")
     comparisonlog.info(f"Total generated rows: {len(generated_report)}")
     comparisonlog.info(f"Comparing columns: {compare_cols}")
@@ -507,31 +1000,37 @@ def process_report(existing_report, generated_report):
     comparisonlog.info(f"Common records: {len(common_keys)}")
     comparisonlog.info(f"New records: {len(new_keys)}")
 
-    updated_keys = []
-    for key in common_keys:
-        existing_row = existing_df.loc[key, compare_cols]
-        generated_row = generated_df.loc[key, compare_cols]
-        if not existing_row.equals(generated_row):
-            updated_keys.append(key)
+    incoming = pd.Series(incoming_hashes, index=generated_df.index)
+    same_hash = np.array(
+        [stored_rows.get(key) == value for key, value in zip(common_keys.tolist(), incoming.loc[common_keys].tolist())],
+        dtype=bool,
+    )
+    candidate_keys = common_keys[~same_hash]
 
+    changed = rows_changed(existing_df.loc[candidate_keys, compare_cols], generated_df.loc[candidate_keys, compare_cols])
+    updated_keys = candidate_keys[changed]
+
+    comparisonlog.info(f"Unchanged rows: {len(common_keys) - len(updated_keys)} ({int(same_hash.sum())} by hash)")
     comparisonlog.info(f"Changed rows found: {len(updated_keys)}")
+    comparisonlog.info(f"New rows: {len(new_keys)}")
 
-    if updated_keys:
+    if len(updated_keys):
         sample_changes = existing_df.loc[updated_keys, compare_cols].combine_first(generated_df.loc[updated_keys, compare_cols])
         comparisonlog.info("Sample changes:")
         comparisonlog.info(sample_changes.head().to_string())
 
     # Apply updates to existing data
     final_df = existing_df.copy()
-
-    for key in updated_keys:
-        for col in compare_cols:
-            if key in generated_df.index and col in generated_df.columns:
-                final_df.at[key, col] = generated_df.at[key, col]
+    final_df.loc[updated_keys, compare_cols] = generated_df.loc[updated_keys, compare_cols]
+    # Updated rows move to a new version, so an editor still holding the old one gets a conflict
+    if VERSION_COLUMN in final_df.columns:
+        final_df.loc[updated_keys, VERSION_COLUMN] += 1
 
     # Add new rows
     new_rows_df = generated_df.loc[new_keys]
     final_df = pd.concat([final_df, new_rows_df], axis=0)
+    if VERSION_COLUMN in final_df.columns:
+        final_df[VERSION_COLUMN] = final_df[VERSION_COLUMN].fillna(1)
 
     # Drop helper columns before returning
     final_df = final_df.reset_index().drop(columns=['row_id', 'composite_key'])
@@ -539,20 +1038,60 @@ def process_report(existing_report, generated_report):
     # Convert final_df back to original dtypes
     for col in final_df.columns:
         if col in original_dtypes:
+            dtype = original_dtypes[col]
+            # categories are rebuilt from the merged values, which may include new labels
+            if isinstance(dtype, pd.CategoricalDtype):
+                dtype = 'category'
             try:
-                final_df[col] = final_df[col].astype(original_dtypes[col])
+                final_df[col] = final_df[col].astype(dtype)
             except Exception as e:
                 comparisonlog.warning(f"Failed to convert '{col}' back to original dtype: {e}")
 
+    # After the merge every generated row matches the report, so its hash describes the stored row
+    rows = dict(stored_rows)
+    rows.update(zip(incoming.index.tolist(), incoming.tolist()))
+
     comparisonlog.info(f"Final updated report rows: {len(final_df)}")
     comparisonlog.info("Comparison and update complete.")
     comparisonlog.info("*" * 100)
 
-    return final_df
+    return final_df, {"columns": compare_cols, "rows": rows}
 
 
 
 
+def merge_into_store(store, generated_report):
+    """
+    Merge generated_report into the stored report and save it if nothing was written meanwhile.
+
+    Role pages keep saving while the merge runs; if one did, the save is refused and the merge is
+    redone on the report as it is now, so the edit is kept rather than overwritten.
+    """
+    for attempt in range(1, REPORT_SAVE_ATTEMPTS + 1):
+        # The stamp is taken before the read, so a write between the two shows up as a conflict
+        stamp = store.stamp()
+        with stage("load report") as loaded:
+            existing_report = store.load()
+            loaded.rows = len(existing_report)
+        processed_report, hashes = process_report(existing_report, generated_report.copy(), load_row_hashes(stamp))
+        # Status and pickup type follow from the other columns, so rows keep to the current rules
+        # (and to FBA codes updated by this merge) even if no page saved them since. A row with a
+        # pallets or quote value that is not a number keeps its status rather than failing the run.
+        processed_report['status'] = compute_status(processed_report, errors='keep')
+        processed_report['pickup type'] = classify_pickup_types(processed_report)
+        processed_report = apply_report_schema(processed_report)
+        try:
+            with stage("save report") as saved:
+                stamp = store.save(processed_report, expected_stamp=stamp)
+                saved.rows = len(processed_report)
+        except ReportConflict:
+            comparisonlog.warning(f"Report was edited during the merge, retrying (attempt {attempt} of {REPORT_SAVE_ATTEMPTS})")
+            continue
+        save_row_hashes(hashes, stamp)
+        return processed_report
+    raise ReportConflict(f"Report kept changing during the merge; gave up after {REPORT_SAVE_ATTEMPTS} attempts")
+
+
 def close_logger(name):
     logger = logging.getLogger(name)
     for handler in logger.handlers[:]:
@@ -563,28 +1102,93 @@ def close_logger(name):
 # In[4]:
 
 
-bookings, shentities, bookingdsr, Myactions, Addressdetails, Agusers= fetch_data()
-
-with pd.ExcelWriter(r"data/Users.xlsx", engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
-    Agusers.to_excel(writer, sheet_name='Agusers', index=False)
-    
-generated_report = booking_process(bookings,Addressdetails)
-
-# generated_report.to_excel(r"data/generated_report.xlsx")
-existing_report_path = r"data/report.xlsx"
-
-if os.path.isfile(existing_report_path):
-    existing_report = pd.read_excel(existing_report_path)
-    processed_report = process_report(existing_report,generated_report)
-    processed_report.to_excel(existing_report_path, index = False)
-else:
-    generated_report.to_excel(existing_report_path, index = False)
-    comparisonlog.info(f"New Report Generated with rows: {len(generated_report)}")
-    comparisonlog.info('*'*100)
+def save_agusers(Agusers):
+    with stage("save Agusers") as saved, pd.ExcelWriter(r"data/Users.xlsx", engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
+        Agusers.to_excel(writer, sheet_name='Agusers', index=False)
+        saved.rows = len(Agusers)
+
+
+def run_full_refresh():
+    bookings, shentities, bookingdsr, Myactions, Addressdetails, Agusers= fetch_data()
+    if bookings is None:
+        raise RuntimeError("fetch_data failed, see mongo_data_extraction.log")
+
+    save_agusers(Agusers)
+
+    generated_report = booking_process(bookings,Addressdetails)
+
+    # generated_report.to_excel(r"data/generated_report.xlsx")
+    store = get_report_store()
+
+    if store.exists():
+        merge_into_store(store, generated_report)
+    else:
+        with stage("save report") as saved:
+            store.save(generated_report)
+            saved.rows = len(generated_report)
+        comparisonlog.info(f"New Report Generated with rows: {len(generated_report)}")
+        comparisonlog.info('*'*100)
+
+
+def run_incremental_refresh(booking_ids, Addressdetails=None, users=True):
+    """
+    Rebuild only the given bookings and merge them into the stored report.
+
+    The change stream listener passes the Addressdetails it keeps between batches and
+    users=False, so Users.xlsx is left to the hourly job.
+    """
+    bookings, shentities, bookingdsr, Myactions, Addressdetails, Agusers = fetch_data(
+        booking_ids=booking_ids, Addressdetails=Addressdetails, users=users
+    )
+    if bookings is None:
+        raise RuntimeError("fetch_data failed, see mongo_data_extraction.log")
+
+    if users:
+        save_agusers(Agusers)
+
+    if bookings.empty:
+        comparisonlog.info("No in-scope bookings among the changed documents")
+        comparisonlog.info('*'*100)
+        return
+
+    generated_report = booking_process(bookings, Addressdetails)
+    merge_into_store(get_report_store(), generated_report)
+
+
+def main(full=False):
+    state = load_watermarks()
+    store = get_report_store()
+    last_full = state.get("last_full_refresh")
+
+    booking_ids = None
+    if full:
+        mongolog.info("Full refresh requested")
+    elif last_full is None:
+        mongolog.warning("No full refresh recorded yet, so changes cannot be tracked; running a full refresh instead")
+    elif (datetime.now() - datetime.fromisoformat(last_full)).total_seconds() > FULL_REFRESH_INTERVAL_HOURS * 3600:
+        mongolog.info(f"Last full refresh is more than {FULL_REFRESH_INTERVAL_HOURS} hours old")
+    elif not store.exists():
+        mongolog.warning("No stored report to update; running a full refresh instead")
+    else:
+        booking_ids, watermarks = read_watermarks_from_mongo(state.get("collections", {}), store.load())
+        if booking_ids is None:
+            mongolog.warning("Changes cannot be found for every watched collection; running a full refresh instead")
+
+    if booking_ids is None:
+        mongolog.info("Running full refresh")
+        set_run_info(refresh="full")
+        _, watermarks = read_watermarks_from_mongo()
+        run_full_refresh()
+        state = {"collections": watermarks, "last_full_refresh": datetime.now().isoformat()}
+    else:
+        mongolog.info(f"Running incremental refresh for {len(booking_ids)} changed bookings")
+        set_run_info(refresh="incremental", changed_bookings=len(booking_ids))
+        if booking_ids:
+            run_incremental_refresh(booking_ids)
+        state = dict(state, collections=watermarks)
+
+    save_watermarks(state)
 
-close_logger('mongolog')
-close_logger('booking_processlog')
-close_logger('comparisonlog')
 
 # bookings.to_excel(r"D:\Ayyanagouda\MSME Shipment Tracker\data\bookings.xlsx")
 # shentities.to_excel(r"D:\Ayyanagouda\MSME Shipment Tracker\data\shentities.xlsx")
@@ -594,6 +1198,20 @@ close_logger('comparisonlog')
 # report.to_excel(r"D:\Ayyanagouda\MSME Shipment Tracker\data\report.xlsx")
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the MSME shipment tracker report from MongoDB")
+    parser.add_argument("--full", action="store_true", help="re-extract every booking instead of only changed ones")
+    args = parser.parse_args()
+    # Stage timings, memory and row counts go to logs/run_metrics.jsonl and logs/run_metrics.prom
+    with recorded_run():
+        main(full=args.full)
+
+    close_logger('mongolog')
+    close_logger('booking_processlog')
+    close_logger('comparisonlog')
+
+
+
 # In[ ]:
 
 
@@ -0,0 +1,504 @@
+"""
+Benchmarks for the MSME tracker backend on synthetic data.
+
+    python benchmark.py flatten --bookings 500000
+    python benchmark.py store --rows 20000
+    python benchmark.py pipeline --scales 10000 100000 --output baseline.json
+    python benchmark.py pipeline --scales 10000 --compare baseline.json
+    python benchmark.py pipeline --scales 10000 --engine pipeline --compare baseline.json
+
+The pipeline benchmark generates all six source collections, loads them into an in-memory
+mongomock server (pip install mongomock) or, with --mongo HOST:PORT, into the msme_benchmark
+database of a local mongod, and times fetch_data, booking_process, process_report and the
+report and role-page saves at each scale. Results are written as JSON with --output and compared
+metric by metric with an earlier file with --compare. --engine picks how fetch_data joins the
+bookings ('find' in pandas, 'pipeline' on the server). mongomock is far slower than a real
+server, so use a local mongod for scales of 1M bookings.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+from pymongo import MongoClient
+
+import Backend_data
+import report_store
+import run_metrics
+from pickup_rules import classify_pickup_types
+from report_edits import save_edits
+from report_paging import DEFAULT_PAGE_SIZE
+from status_rules import compute_status
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+# The pipeline benchmark drops and reloads this database on a local mongod
+BENCHMARK_DATABASE = "msme_benchmark"
+
+# Documents generated and inserted together
+INSERT_BATCH_SIZE = 10000
+
+# Report stores the pipeline benchmark saves to, and their file names
+STORES = {
+    'sqlite': (report_store.SQLiteReportStore, 'report.sqlite'),
+    'excel': (report_store.ExcelReportStore, 'report.xlsx'),
+}
+
+
+def make_bookings(n, seed=0, first=0, entities=None):
+    """
+    Synthetic Bookings documents shaped like the BOOKINGS_PROJECTION output, numbered from first
+    and spread over entities customers (n // 20 + 1 by default).
+    """
+    rng = random.Random(seed)
+    start = date(2024, 10, 1)
+    entities = entities or n // 20 + 1
+    documents = []
+    for i in range(first, first + n):
+        contract = {
+            'cargoTotals': {'totChargeableWeight': round(rng.uniform(10, 5000), 2)},
+            'fbaPallets': rng.randint(0, 12),
+            'shipmentType': rng.choice(['LCL', 'LCL', 'LCL', 'FCL', 'Air']),
+            'shipmentScope': rng.choice(['Port-to-Door', 'Door-to-Door']),
+            'origin': rng.choice(['Nhava Sheva, India (INNSA)', 'Chennai, India (INMAA)', 'Mundra, India (INMUN)']),
+            'finalPlaceOfDelivery': rng.choice(['New York, United States (USNYC)', 'Los Angeles, United States (USLAX)']),
+            'destination': 'United States',
+        }
+        if i % 50 == 0:
+            del contract['cargoTotals']
+        documents.append({
+            '_id': f"25{i % 12 + 1:02d}LCLSYN{i:08d}",
+            'bookingDate': (start + timedelta(days=rng.randint(0, 400))).isoformat(),
+            'entityId': f"ENT{rng.randint(0, entities):06d}",
+            'status': rng.choice(['INPROGRESS', 'INPROGRESS', 'ARCHIVED', 'CANCELLED']),
+            'fba': rng.choice(['Yes', 'No']),
+            'contract': contract if i % 997 else None,
+        })
+    return documents
+
+
+def _day(rng, start=date(2025, 1, 1), days=300):
+    return (start + timedelta(days=rng.randint(0, days))).strftime('%d-%m-%Y')
+
+
+def make_shentities(n, seed=0):
+    """Synthetic SHEntities documents for entity ids 0..n; most customers are MSME."""
+    rng = random.Random(seed)
+    documents = []
+    for i in range(n + 1):
+        documents.append({
+            'entityId': f"ENT{i:06d}",
+            'entityName': Backend_data.EXCLUDED_CUSTOMERS[0] if i == 1 else f"Customer {i}",
+            'customer': {'crossBorder': {'salesVertical': rng.choice(['MSME', 'MSME', 'MSME', 'Enterprise'])}},
+        })
+    return documents
+
+
+def make_bookingdsr(booking_ids, addresses, seed=0):
+    """Synthetic Bookingdsr documents for most of booking_ids, with zero to four vdes delivery legs."""
+    rng = random.Random(seed)
+    documents = []
+    for booking_id in booking_ids:
+        if rng.random() < 0.15:
+            continue
+        legs = [
+            {
+                'destination': f"ADDR{rng.randint(0, addresses - 1)}",
+                'total_package': rng.randint(1, 80),
+                'atdfrompod': _day(rng) if rng.random() < 0.3 else '',
+                'actual_delivery_date': _day(rng) if rng.random() < 0.2 else '',
+            }
+            for _ in range(rng.choice([0, 1, 1, 1, 2, 2, 3, 4]))
+        ]
+        documents.append({
+            '_id': booking_id,
+            'sob_pol': _day(rng),
+            'gatein_pol': _day(rng),
+            'hbl_number': f"HBL{rng.randint(0, 10**8):08d}",
+            'mbl_number': f"MBL{rng.randint(0, 10**8):08d}",
+            'etd_at_pol': _day(rng),
+            'stuffing_confirmation': _day(rng),
+            'pol_container_number': f"CONT{rng.randint(0, 10**6):07d}",
+            'eta_fpod': _day(rng),
+            'gatein_fpod': _day(rng) if rng.random() < 0.5 else '',
+            'carrier': rng.choice(['MAERSK', 'CMA CGM', 'ONE', 'HMM']),
+            'consolidator': rng.choice(['Agraga', 'Shipco', 'ECU Worldwide']),
+            'importClearance': [{'label': Backend_data.CLEARANCE_LABEL, 'value': _day(rng)}] if rng.random() < 0.4 else [],
+            'vdes': legs,
+            'last_free_date_at_fpod': _day(rng) if rng.random() < 0.3 else '',
+            'delivery_order_release': _day(rng) if rng.random() < 0.3 else '',
+            'remarks': rng.choice(['', '', 'Awaiting DO', 'Customer asked to hold']),
+        })
+    return documents
+
+
+def make_myactions(booking_ids, seed=0):
+    """Synthetic Myactions documents for about a third of booking_ids, each with a files array."""
+    rng = random.Random(seed)
+    created = int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp() * 1000)
+    documents = []
+    for booking_id in booking_ids:
+        if rng.random() < 0.67:
+            continue
+        files = [{'label': 'Commercial Invoice', 'approved': ''}]
+        if rng.random() < 0.7:
+            files.append({'label': Backend_data.DUTY_INVOICE_LABEL, 'approved': rng.choice(['Approve', 'Approve', 'Reject', ''])})
+        documents.append({
+            '_id': {'bookingNum': booking_id, 'actionId': rng.randint(0, 10**9)},
+            'actionName': rng.choice(['Invoice Acceptance', 'Invoice Acceptance', 'Document Upload']),
+            'files': files,
+            'createdOn': created + rng.randint(0, 300) * 86400000,
+        })
+    return documents
+
+
+def make_addressdetails(n):
+    return [{'_id': f"ADDR{i}", 'fbacode': f"FBA{i % 300}"} for i in range(n)]
+
+
+def make_agusers(n):
+    return [{'email': f"user{i}@agraga.com" if i % 5 else f"user{i}@example.com"} for i in range(n)]
+
+
+def load_database(db, n_bookings, seed=0):
+    """
+    Fill db with the six source collections for n_bookings bookings, generated and inserted one
+    batch at a time so memory does not grow with the scale. Returns the document count per collection.
+    """
+    entities = n_bookings // 20 + 1
+    addresses = max(100, n_bookings // 50)
+    db["SHEntities"].insert_many(make_shentities(entities, seed))
+    db["Addressdetails"].insert_many(make_addressdetails(addresses))
+    db["Agusers"].insert_many(make_agusers(200))
+    for batch, first in enumerate(range(0, n_bookings, INSERT_BATCH_SIZE)):
+        batch_seed = seed * 1_000_003 + batch
+        bookings = make_bookings(min(INSERT_BATCH_SIZE, n_bookings - first), batch_seed, first, entities)
+        booking_ids = [document['_id'] for document in bookings]
+        db["Bookings"].insert_many(bookings)
+        dsr = make_bookingdsr(booking_ids, addresses, batch_seed)
+        if dsr:
+            db["Bookingdsr"].insert_many(dsr)
+        actions = make_myactions(booking_ids, batch_seed)
+        if actions:
+            db["Myactions"].insert_many(actions)
+    return {name: db[name].count_documents({}) for name in
+            ["Bookings", "SHEntities", "Bookingdsr", "Myactions", "Addressdetails", "Agusers"]}
+
+
+def legacy_prepare_bookings(bookings):
+    """prepare_bookings as it was before flatten_nested, kept as the reference."""
+    bookings = bookings[~bookings['status'].isin(['CANCELLED', 'Cancellation Requested'])]
+    bookings['bookingDate'] = pd.to_datetime(bookings['bookingDate'])
+    bookings = bookings[bookings['bookingDate'] >= Backend_data.BOOKING_START_DATE]
+    bookings['shipmentType'] = bookings['contract'].apply(lambda x: x.get('shipmentType') if isinstance(x, dict) else x)
+    bookings = bookings[bookings['shipmentType'] == 'LCL']
+    bookings['shipmentScope'] = bookings['contract'].apply(lambda x: x.get('shipmentScope') if isinstance(x, dict) else x)
+    bookings['fbaPallets'] = bookings['contract'].apply(lambda x: x.get('fbaPallets') if isinstance(x, dict) else x)
+    bookings['origin'] = bookings['contract'].apply(lambda x: x.get('origin') if isinstance(x, dict) else x)
+    bookings['finalPlaceOfDelivery'] = bookings['contract'].apply(lambda x: x.get('finalPlaceOfDelivery') if isinstance(x, dict) else x)
+    bookings['totChargeableWeight'] = bookings['contract'].apply(lambda x: x.get('cargoTotals', {}).get('totChargeableWeight', '') if isinstance(x, dict) else '')
+    bookings = bookings.drop(columns=['contract'])
+    return bookings
+
+
+def legacy_extract_contract(contract):
+    """The six per-field .apply passes over the contract column."""
+    return pd.DataFrame({
+        'shipmentType': contract.apply(lambda x: x.get('shipmentType') if isinstance(x, dict) else x),
+        'shipmentScope': contract.apply(lambda x: x.get('shipmentScope') if isinstance(x, dict) else x),
+        'fbaPallets': contract.apply(lambda x: x.get('fbaPallets') if isinstance(x, dict) else x),
+        'origin': contract.apply(lambda x: x.get('origin') if isinstance(x, dict) else x),
+        'finalPlaceOfDelivery': contract.apply(lambda x: x.get('finalPlaceOfDelivery') if isinstance(x, dict) else x),
+        'totChargeableWeight': contract.apply(lambda x: x.get('cargoTotals', {}).get('totChargeableWeight', '') if isinstance(x, dict) else ''),
+    })
+
+
+def timed(func, *args, repeat=3):
+    """Best wall time of repeat runs, and the result of the last one."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_flatten(n_bookings, repeat=3):
+    bookings = pd.DataFrame(make_bookings(n_bookings))
+    apply_time, _ = timed(legacy_extract_contract, bookings['contract'], repeat=repeat)
+    extract_time, _ = timed(Backend_data.flatten_nested, bookings['contract'], Backend_data.CONTRACT_FIELDS, repeat=repeat)
+
+    legacy_time, legacy = timed(lambda: legacy_prepare_bookings(bookings.copy()), repeat=repeat)
+    current_time, current = timed(lambda: Backend_data.prepare_bookings(bookings.copy()), repeat=repeat)
+
+    if not legacy.equals(current[legacy.columns]):
+        raise AssertionError("prepare_bookings output differs from the per-field apply reference")
+
+    results = {
+        'bookings': n_bookings,
+        'kept_rows': len(current),
+        'extract_apply_per_field_s': round(apply_time, 4),
+        'extract_flatten_nested_s': round(extract_time, 4),
+        'extract_speedup': round(apply_time / extract_time, 2),
+        'prepare_bookings_legacy_s': round(legacy_time, 4),
+        'prepare_bookings_s': round(current_time, 4),
+        'prepare_bookings_speedup': round(legacy_time / current_time, 2),
+    }
+    print(f"contract extraction, {n_bookings} bookings: per-field apply {apply_time:.3f}s, "
+          f"flatten_nested {extract_time:.3f}s ({results['extract_speedup']}x)")
+    print(f"prepare_bookings, {n_bookings} bookings: legacy {legacy_time:.3f}s, "
+          f"current {current_time:.3f}s ({results['prepare_bookings_speedup']}x)")
+    return results
+
+
+def make_report(n, seed=0):
+    """Synthetic report with the REPORT_COLUMNS layout, filled the way the backend and role pages fill it."""
+    rng = random.Random(seed)
+    start = date(2025, 1, 1)
+
+    def day():
+        return (start + timedelta(days=rng.randint(0, 300))).strftime('%d-%m-%Y')
+
+    report = pd.DataFrame({
+        'Agraga Booking #': [f"25{i % 12 + 1:02d}LCLSYN{i // 2:08d}" for i in range(n)],
+        'Customer Name': [f"Customer {rng.randint(0, 400)}" for _ in range(n)],
+        'MBL#': [f"MBL{rng.randint(0, 10**8):08d}" for _ in range(n)],
+        'HBL#': [f"HBL{rng.randint(0, 10**8):08d}" for _ in range(n)],
+        'Booking Status': [rng.choice(['INPROGRESS', 'ARCHIVED']) for _ in range(n)],
+        'FBA?': [rng.choice(['Yes', 'No']) for _ in range(n)],
+        'ETD': [day() for _ in range(n)],
+        'ETA': [day() for _ in range(n)],
+        'Carrier': [rng.choice(['MAERSK', 'CMA CGM', 'ONE', 'HMM']) for _ in range(n)],
+        'Delivery Address': [f"ADDR{rng.randint(0, 2000)}" for _ in range(n)],
+        'FBA Code': [f"FBA{rng.randint(0, 300)}" for _ in range(n)],
+        'Packages': [float(rng.randint(1, 80)) for _ in range(n)],
+        'Delivery Quote': [round(rng.uniform(0, 2500), 2) if rng.random() < 0.4 else None for _ in range(n)],
+        'Remarks': [rng.choice(['', 'Awaiting DO', 'Customer asked to hold']) for _ in range(n)],
+    })
+    return report.reindex(columns=Backend_data.REPORT_COLUMNS)
+
+
+def bench_store(n_rows, repeat=3):
+    report = make_report(n_rows)
+    results = {'rows': n_rows}
+    with tempfile.TemporaryDirectory() as folder:
+        stores = {
+            'excel': report_store.ExcelReportStore(os.path.join(folder, 'report.xlsx')),
+            'sqlite': report_store.SQLiteReportStore(os.path.join(folder, 'report.sqlite')),
+        }
+        for name, store in stores.items():
+            save_time, _ = timed(store.save, report, repeat=repeat)
+            load_time, loaded = timed(store.load, repeat=repeat)
+            if len(loaded) != n_rows or list(loaded.columns) != list(report.columns) + [report_store.VERSION_COLUMN]:
+                raise AssertionError(f"{name} store did not round-trip the report")
+            results[f'{name}_save_s'] = round(save_time, 4)
+            results[f'{name}_load_s'] = round(load_time, 4)
+            print(f"{name} store, {n_rows} rows: save {save_time:.3f}s, load {load_time:.3f}s")
+    results['load_speedup'] = round(results['excel_load_s'] / results['sqlite_load_s'], 2)
+    results['save_speedup'] = round(results['excel_save_s'] / results['sqlite_save_s'], 2)
+    print(f"sqlite vs excel: load {results['load_speedup']}x, save {results['save_speedup']}x")
+    return results
+
+
+def timed_after(setup, func, repeat=3):
+    """Best wall time of func over repeat runs, calling setup untimed before each, and the last result."""
+    best = result = None
+    for _ in range(repeat):
+        setup()
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_client(mongo=None):
+    """
+    (client, connect) for the benchmark database. connect() stands in for MongoClient in
+    fetch_data. Without mongo an in-memory mongomock server is used; otherwise mongo is the
+    HOST:PORT of a local mongod.
+    """
+    if mongo is None:
+        if mongomock is None:
+            raise RuntimeError("The pipeline benchmark needs mongomock (pip install mongomock) or --mongo HOST:PORT")
+        client = mongomock.MongoClient()
+        return client, lambda *args, **kwargs: client
+    host, _, port = mongo.partition(':')
+    if host == Backend_data.MONGO_HOST:
+        raise ValueError("The benchmark drops and reloads its database; point --mongo at a local mongod, not production")
+    uri = f"mongodb://{host}:{port or 27017}/"
+    return MongoClient(uri), lambda *args, **kwargs: MongoClient(uri, **kwargs)
+
+
+@contextmanager
+def benchmark_source(connect):
+    """Point fetch_data at the benchmark database for the duration of the block."""
+    saved = Backend_data.MongoClient, Backend_data.MONGO_DATABASE
+    Backend_data.MongoClient, Backend_data.MONGO_DATABASE = connect, BENCHMARK_DATABASE
+    try:
+        yield
+    finally:
+        Backend_data.MongoClient, Backend_data.MONGO_DATABASE = saved
+
+
+def previous_report(generated, seed=0, new_share=0.02, changed_share=0.05):
+    """
+    generated as the last run would have stored it: a share of the bookings not yet in it and a
+    share of the other rows with a different ETA, so process_report has new and changed rows to find.
+    """
+    rng = np.random.default_rng(seed)
+    bookings = generated['Agraga Booking #'].unique()
+    new_bookings = rng.choice(bookings, size=int(len(bookings) * new_share), replace=False)
+    existing = generated[~generated['Agraga Booking #'].isin(new_bookings)].reset_index(drop=True)
+    changed = rng.random(len(existing)) < changed_share
+    existing.loc[changed, 'ETA'] = existing.loc[changed, 'ETA'] - pd.Timedelta(days=1)
+    return report_store.with_versions(existing)
+
+
+def page_edits(report, seed=0, rows=DEFAULT_PAGE_SIZE):
+    """A role page's save: edits to one page of rows, as edited_cells returns them."""
+    rng = random.Random(seed)
+    keys = report_store.row_keys(report)
+    edits = {}
+    for label in rng.sample(list(report.index), min(rows, len(report))):
+        edits[(keys.at[label, report_store.KEY_COLUMN], int(keys.at[label, 'leg']))] = {
+            'CFS': rng.choice(['New Jersey (ICT - 07201)', 'Houston (St. George - 77507)']),
+            'Actual # of Pallets': str(rng.randint(1, 12)),
+            'Ready for Pick-up Date': '2025-06-01',
+            # a few shared pickup numbers, so combined pickups are regrouped too
+            'Pick up number': f"PU{rng.randint(0, rows // 3)}",
+            'Remarks': 'Benchmark edit',
+            report_store.VERSION_COLUMN: int(keys.at[label, report_store.VERSION_COLUMN]),
+        }
+    return edits
+
+
+def bench_pipeline(n_bookings, repeat=3, mongo=None, stores=('sqlite', 'excel'), seed=0, engine=Backend_data.FETCH_ENGINE):
+    client, connect = benchmark_client(mongo)
+    client.drop_database(BENCHMARK_DATABASE)
+    started = time.perf_counter()
+    documents = load_database(client[BENCHMARK_DATABASE], n_bookings, seed)
+    results = {'bookings': n_bookings, 'documents': documents, 'load_database_s': round(time.perf_counter() - started, 4)}
+    print(f"{n_bookings} bookings: generated and loaded {sum(documents.values())} documents in {results['load_database_s']:.1f}s")
+
+    run_metrics.start_run(benchmark='pipeline', bookings=n_bookings, engine=engine)
+    with benchmark_source(connect):
+        fetch_time, fetched = timed(lambda: Backend_data.fetch_data(engine=engine), repeat=repeat)
+    bookings, Addressdetails = fetched[0], fetched[4]
+    if bookings is None:
+        raise RuntimeError("fetch_data failed, see logs/mongo_data_extraction.log")
+    process_time, generated = timed(Backend_data.booking_process, bookings, Addressdetails, repeat=repeat)
+
+    existing = previous_report(generated, seed)
+    merge_time, (merged, hashes) = timed(lambda: Backend_data.process_report(existing.copy(), generated.copy()), repeat=repeat)
+    # the hourly case: nothing changed since the last merge, so every row is skipped by its hash
+    unchanged_time, _ = timed(lambda: Backend_data.process_report(merged.copy(), generated.copy(), hashes), repeat=repeat)
+    merged['status'] = compute_status(merged)
+    merged['pickup type'] = classify_pickup_types(merged)
+
+    results.update({
+        'fetched_bookings': len(bookings),
+        'report_rows': len(generated),
+        'fetch_data_s': round(fetch_time, 4),
+        'booking_process_s': round(process_time, 4),
+        'process_report_s': round(merge_time, 4),
+        'process_report_unchanged_s': round(unchanged_time, 4),
+    })
+    print(f"  fetch_data {fetch_time:.3f}s ({len(bookings)} bookings), booking_process {process_time:.3f}s "
+          f"({len(generated)} rows), process_report {merge_time:.3f}s, unchanged {unchanged_time:.3f}s")
+
+    edits = page_edits(merged, seed)
+    with tempfile.TemporaryDirectory() as folder:
+        for name in stores:
+            store_class, file_name = STORES[name]
+            store = store_class(os.path.join(folder, file_name))
+            save_time, _ = timed(store.save, merged, repeat=repeat)
+            # each role save starts from the merged report, so the edits' versions still match
+            edit_time, written = timed_after(lambda: store.save(merged), lambda: save_edits(edits, store=store), repeat=repeat)
+            results[f'{name}_report_save_s'] = round(save_time, 4)
+            results[f'{name}_role_save_s'] = round(edit_time, 4)
+            print(f"  {name} store: report save {save_time:.3f}s, role save of {written} rows {edit_time:.3f}s")
+
+    results['stages'] = run_metrics.run_record()['stages']
+    client.drop_database(BENCHMARK_DATABASE)
+    return results
+
+
+def environment(args):
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'mongo': args.mongo or 'mongomock',
+        'engine': args.engine,
+        'repeat': args.repeat,
+        'seed': args.seed,
+    }
+
+
+def timings(results, prefix=''):
+    """{dotted.name: seconds} for every *_s value in nested results; stage breakdowns are left out."""
+    found = {}
+    for key, value in results.items():
+        if isinstance(value, dict) and key != 'stages':
+            found.update(timings(value, f"{prefix}{key}."))
+        elif key.endswith('_s') and isinstance(value, (int, float)):
+            found[f"{prefix}{key}"] = value
+    return found
+
+
+def compare_results(baseline, results):
+    """Print every timing found in both, with the change against the baseline."""
+    before, after = timings(baseline), timings(results)
+    for name in [name for name in after if name in before]:
+        ratio = after[name] / before[name] if before[name] else float('inf')
+        print(f"{name:<55} {before[name]:>10.4f}s {after[name]:>10.4f}s  {ratio:6.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the MSME tracker backend on synthetic data")
+    parser.add_argument("benchmark", choices=["flatten", "store", "pipeline"])
+    parser.add_argument("--bookings", type=int, default=500000)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000], help="bookings per pipeline run")
+    parser.add_argument("--mongo", help="HOST:PORT of a local mongod to load instead of mongomock")
+    parser.add_argument("--engine", choices=["find", "pipeline"], default=Backend_data.FETCH_ENGINE,
+                        help="how fetch_data joins the bookings")
+    parser.add_argument("--stores", nargs="+", choices=list(STORES), default=list(STORES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    if args.benchmark == "flatten":
+        results = bench_flatten(args.bookings, args.repeat)
+    elif args.benchmark == "store":
+        results = bench_store(args.rows, args.repeat)
+    else:
+        results = {str(n): bench_pipeline(n, args.repeat, args.mongo, args.stores, args.seed, args.engine) for n in args.scales}
+    record = {'environment': environment(args), 'benchmark': args.benchmark, 'results': results}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(record, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.compare} ({baseline['environment']['created']}):")
+        compare_results(baseline['results'], results)
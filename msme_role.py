@@ -1,45 +1,17 @@
 import streamlit as st
 import pandas as pd
-from io import BytesIO
-
-def convert_df_to_excel(df):
-    """Convert DataFrame to an Excel file and return as bytes for downloading."""
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        df.to_excel(writer, index=False, sheet_name='Report')
-    processed_data = output.getvalue()
-    return processed_data
-
-def is_filled(val):
-    return pd.notna(val) and str(val).strip() != ''
-
-def determine_status(row):
-    all_required_columns = [
-        'ISF Filing', 'CFS', 'Freight Broker', 'Transporter', 'Delivery Quote',
-        'Actual # of Pallets', 'Ready for Pick-up Date', 'DO Release Approved?',
-        'HBL Released Date', 'Pick up number', 'Delivery Appointment Date',
-        'Vendor Delivery Invoice', 'PRO Number', 'Storage Incurred (Days)', 'Remarks'
-    ]
-    basic_6_fields = ['CFS', 'Actual # of Pallets', 'Ready for Pick-up Date', 'Freight Broker', 'Transporter', 'Delivery Quote']
-
-    # Condition 3: All 6 fields updated
-    if all(is_filled(row[col]) for col in basic_6_fields):
-        # Check which of the 15 total required fields are still not filled
-        pending_fields = [col for col in all_required_columns if not is_filled(row[col])]
-        if pending_fields:
-            row['status'] = ', '.join(pending_fields) + ' pending'
-    # Condition 1: Basic transport info
-    elif is_filled(row['CFS']) and is_filled(row['Actual # of Pallets']) and is_filled(row['Ready for Pick-up Date']) and int(row['Actual # of Pallets']) != 0:
-        row['status'] = 'Transport Assignment Pending'
-    # Condition 2: Broker + Transporter + Quote
-    elif is_filled(row['Freight Broker']) and is_filled(row['Transporter']) and is_filled(row['Delivery Quote']) and float(row['Delivery Quote']) != 0.0:
-        row['status'] = 'Delivery Order Release Approval Pending'
-
-    return row
+from functools import partial
+from report_export import EXPORT_MIME, export_file_name, export_formats, export_report
+from report_edits import edited_cells, save_edits
+from report_facets import facet_filters, facet_index
+from report_paging import editor_key, editor_saved, editor_versions, paged_rows
+from report_store import VERSION_COLUMN, ReportConflict, load_report_version, row_keys
 
 def display_msme_report():
     try:
-        df = pd.read_excel("data/report.xlsx")
+        stamp, df = load_report_version(versions=True)
+        keys = row_keys(df)
+        df = df.drop(columns=VERSION_COLUMN)
         df = df[df['Booking Status']=='INPROGRESS']
         df["Freight Broker"] = df["Freight Broker"].astype(str).str.strip().fillna('')
         df["Transporter"] = df["Transporter"].astype(str).str.strip().fillna('')
@@ -49,46 +21,15 @@ def display_msme_report():
 
         # --- FILTER SECTION ---
 
-        # Prepare filter options
-        booking_options = sorted(df["Agraga Booking #"].dropna().unique())
-        customer_options = sorted(df["Customer Name"].dropna().unique())
-        fba_options = sorted(df["FBA Code"].dropna().unique())
-        pickup_options = sorted(df["Pick up number"].dropna().unique())
-        cfs_options = sorted(df["CFS"].dropna().unique())
-        eta_options = sorted(df["ETA"].dropna().astype(str).unique())  # convert to string if datetime
+        # Options and the rows they select come from an index built once per report version;
+        # each dropdown only offers values found in the rows the other filters leave
+        filtered_df = df.iloc[facet_filters(facet_index("msme", stamp, df), "msme")]
 
-        # First row: Booking # and Customer Name
-        col1, col2 = st.columns(2)
-        with col1:
-            selected_booking = st.selectbox("Filter by Agraga Booking #", options=["All"] + booking_options)
-        with col2:
-            selected_customer = st.selectbox("Filter by Customer Name", options=["All"] + customer_options)
-
-        # Second row: FBA Code, Pick up number, CFS, ETA
-        col3, col4, col5, col6 = st.columns(4)
-        with col3:
-            selected_fba = st.selectbox("Filter by FBA Code", options=["All"] + fba_options)
-        with col4:
-            selected_pickup = st.selectbox("Filter by Pick up number", options=["All"] + pickup_options)
-        with col5:
-            selected_cfs = st.selectbox("Filter by CFS", options=["All"] + cfs_options)
-        with col6:
-            selected_eta = st.selectbox("Filter by ETA", options=["All"] + eta_options)
-
-        # Apply filters
-        filtered_df = df.copy()
-        if selected_booking != "All":
-            filtered_df = filtered_df[filtered_df["Agraga Booking #"] == selected_booking]
-        if selected_customer != "All":
-            filtered_df = filtered_df[filtered_df["Customer Name"] == selected_customer]
-        if selected_fba != "All":
-            filtered_df = filtered_df[filtered_df["FBA Code"] == selected_fba]
-        if selected_pickup != "All":
-            filtered_df = filtered_df[filtered_df["Pick up number"] == selected_pickup]
-        if selected_cfs != "All":
-            filtered_df = filtered_df[filtered_df["CFS"] == selected_cfs]
-        if selected_eta != "All":
-            filtered_df = filtered_df[filtered_df["ETA"].astype(str) == selected_eta]
+        # Only the current page of rows is cleaned and sent to the editor; rows keep their report index
+        filtered_df = paged_rows(filtered_df, "msme").copy()
+        editor = editor_key("msme", filtered_df)
+        # Edits are checked against the row versions the user was shown, not the ones reloaded on save
+        keys = editor_versions("msme", editor, keys, filtered_df)
 
 
         # --- DROPDOWN OPTIONS ---
@@ -145,7 +86,7 @@ def display_msme_report():
             disabled=[
                 col for col in df.columns if col not in ["Freight Broker", "Transporter", "Delivery Quote","Remarks"]
             ],
-            key="msme_editor"
+            key=editor
         )
         edited_df["Freight Broker"] = edited_df["Freight Broker"].astype(str).str.strip()
         edited_df["Transporter"] = edited_df["Transporter"].astype(str).str.strip()
@@ -158,74 +99,33 @@ def display_msme_report():
         # --- SAVE BUTTON ---
         if st.button("💾 Save Changes"):
             try:
-                # Read the original full report
-                original_df = pd.read_excel("data/report.xlsx")
-
                 # Ensure indices match for correct merging
                 edited_df.index = filtered_df.index  # Maintain correct row alignment
 
-                # Update only the edited columns
+                # Write only the cells changed in the editor, then refresh status and pickup type for those rows
                 columns_to_update = ["Freight Broker", "Transporter", "Delivery Quote","Remarks"]
-                for col in columns_to_update:
-                    # Ensure both DataFrames treat the column as string type
-                    original_df[col] = original_df[col].astype(str)
-                    edited_df[col] = edited_df[col].astype(str)
-
-                    # Apply updates safely
-                    original_df.loc[filtered_df.index, col] = edited_df[col].fillna(original_df[col])
-                    # Replace 'nan' strings with empty string
-                    original_df.replace("nan", "", inplace=True)
-                    original_df.replace("None", "", inplace=True)  # If some values are 'None' as strings
-                    original_df = original_df.fillna("")  # If actual NaN exists
-
-                # Apply the function
-                original_df = original_df.apply(determine_status, axis=1)
-                # Ensure clean values
-                original_df['Pick up number'] = original_df['Pick up number'].fillna('').astype(str).str.strip()
-                original_df['FBA Code'] = original_df['FBA Code'].fillna('').astype(str).str.strip()
-
-                # Filter rows with valid 'Pick up number'
-                valid_pickup_df = original_df[
-                    (original_df['Pick up number'] != '') &
-                    (original_df['Pick up number'].str.lower() != 'nan')
-                ]
-
-                # Group only valid rows
-                pickup_counts = valid_pickup_df.groupby(['Pick up number', 'FBA Code']).size().reset_index(name='count')
-
-                # Merge back the counts to original_df
-                original_df = original_df.merge(pickup_counts, on=['Pick up number', 'FBA Code'], how='left')
-
-                # Assign pickup type based on count, default to empty or 'Single Pick-Up'
-                original_df['pickup type'] = original_df['count'].apply(
-                    lambda x: 'Combined Pick-Up' if pd.notnull(x) and x > 1 else 'Single Pick-Up'
-                )
-
-                # Optional: Set pickup type to empty where Pick up number is invalid
-                original_df.loc[
-                    (original_df['Pick up number'] == '') | (original_df['Pick up number'].str.lower() == 'nan'),
-                    'pickup type'
-                ] = ''
-
-                # Drop helper column
-                original_df.drop(columns='count', inplace=True)
-
-                # Save the updated DataFrame back to Excel
-                original_df.to_excel("data/report.xlsx", index=False)
+                edits = edited_cells(st.session_state[editor], edited_df, keys, columns_to_update)
+                save_edits(edits)
+                editor_saved("msme")
 
                 st.success("✅ Changes saved successfully!")
                 st.rerun()
+            except ReportConflict as e:
+                st.warning(f"⚠️ {e}")
             except Exception as e:
                 st.error(f"❌ Error saving file: {e}")
 
-        # --- DOWNLOAD BUTTON ---
-        excel_data = convert_df_to_excel(pd.read_excel("data/report.xlsx"))
-        st.download_button(
-            label="📥 Download Report",
-            data=excel_data,
-            file_name="MSME Tracker Report.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+        # --- DOWNLOAD BUTTONS ---
+        # Each file is built only when its button is clicked, once per report version
+        formats = export_formats()
+        for fmt, column in zip(formats, st.columns(len(formats))):
+            with column:
+                st.download_button(
+                    label=f"📥 Download Report ({fmt.upper()})",
+                    data=partial(export_report, fmt),
+                    file_name=export_file_name(fmt),
+                    mime=EXPORT_MIME[fmt]
+                )
 
     except Exception as e:
         st.error(f"Error loading MSME report: {e}")
@@ -0,0 +1,51 @@
+"""
+The report's pickup type column: rows sharing a pickup number and FBA code are picked up together.
+
+    'Combined Pick-Up'  another row has the same pickup number and FBA code
+    'Single Pick-Up'    the row has a pickup number no other row shares with its FBA code
+    ''                  the row has no pickup number
+"""
+import numpy as np
+import pandas as pd
+
+PICKUP_COLUMNS = ['Pick up number', 'FBA Code']
+COMBINED_PICKUP = 'Combined Pick-Up'
+SINGLE_PICKUP = 'Single Pick-Up'
+
+
+def pickup_keys(rows):
+    """Pickup number and FBA code cleaned the way rows are grouped, and which rows have a pickup number."""
+    pickup = rows['Pick up number'].fillna('').astype(str).str.strip()
+    fba = rows['FBA Code'].fillna('').astype(str).str.strip()
+    valid = (pickup != '') & (pickup.str.lower() != 'nan')
+    return pickup, fba, valid
+
+
+def pickup_groups(rows):
+    """The (pickup number, FBA code) groups the rows belong to."""
+    pickup, fba, valid = pickup_keys(rows)
+    return set(zip(pickup[valid].tolist(), fba[valid].tolist()))
+
+
+def classify_pickup_types(rows, groups=None):
+    """
+    Pickup type of each row, in row order and aligned on rows' index.
+
+    With groups, a set of (pickup number, FBA code), only the rows in those groups are returned,
+    so an edit can refresh just the groups it touched. rows must still hold the whole report,
+    since a group's size counts every row in it.
+    """
+    pickup, fba, valid = pickup_keys(rows)
+    valid = valid.to_numpy(dtype=bool)
+    sizes = np.zeros(len(rows), dtype=np.int64)
+    if valid.any():
+        sizes[valid] = pickup[valid].groupby([pickup[valid], fba[valid]], sort=False).transform('size').to_numpy()
+    pickup_type = pd.Series(
+        np.where(sizes > 1, COMBINED_PICKUP, np.where(valid, SINGLE_PICKUP, '')), index=rows.index, dtype=object
+    )
+    if groups is None:
+        return pickup_type
+    if not groups:
+        return pickup_type.iloc[:0]
+    in_groups = valid & pd.MultiIndex.from_arrays([pickup, fba]).isin(list(groups))
+    return pickup_type[in_groups]
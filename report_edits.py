@@ -0,0 +1,104 @@
+"""
+Delta saves for the role editors.
+
+Only the cells st.data_editor reports as changed are written, addressed by booking # and leg, and
+the derived status / pickup type columns are recomputed for the touched rows only. Each edit
+carries the version its row had when the page loaded, and the save is refused with
+ReportConflict if any of those rows has been written since.
+"""
+import pandas as pd
+
+from pickup_rules import PICKUP_COLUMNS, classify_pickup_types, pickup_groups
+from report_store import KEY_COLUMN, VERSION_COLUMN, ReportConflict, get_report_store
+from status_rules import compute_status
+
+
+def cell_value(value):
+    """An edited value as the report stores it: text, with missing values as ''."""
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return ''
+    text = str(value)
+    return '' if text in ('nan', 'None', '<NA>', 'NaT') else text
+
+
+def edited_cells(editor_state, edited_df, keys, columns):
+    """
+    {(booking #, leg): {column: value}} for the cells changed in one st.data_editor.
+
+    editor_state is st.session_state[<editor key>]; its edited_rows are positions in edited_df.
+    keys is row_keys() of the full report, and edited_df must keep the full report's index.
+    Values are taken from edited_df, so the role page's own clean-up of edited values applies.
+    When keys carry versions, each row's version is included under VERSION_COLUMN.
+    """
+    edits = {}
+    for position, changes in editor_state.get("edited_rows", {}).items():
+        label = edited_df.index[int(position)]
+        changed = {col: cell_value(edited_df.at[label, col]) for col in changes if col in columns}
+        if changed:
+            if VERSION_COLUMN in keys.columns:
+                changed[VERSION_COLUMN] = int(keys.at[label, VERSION_COLUMN])
+            edits[(keys.at[label, KEY_COLUMN], int(keys.at[label, 'leg']))] = changed
+    return edits
+
+
+def update_pickup_types(tx, touched, groups_before):
+    """
+    Recompute pickup type for the touched rows and for every row sharing a pickup group with
+    one of them, before or after the edit; other rows cannot have changed.
+    """
+    rows = tx.read(columns=PICKUP_COLUMNS + ['pickup type'])
+    pickup_type = classify_pickup_types(rows, groups_before | pickup_groups(rows.loc[touched]))
+    # touched rows that no longer have a pickup number are in no group
+    cleared = rows.index.isin(touched) & ~rows.index.isin(pickup_type.index)
+    pickup_type = pd.concat([pickup_type, pd.Series('', index=rows.index[cleared], dtype=object)])
+
+    changed = pickup_type != rows.loc[pickup_type.index, 'pickup type'].astype(object).fillna('')
+    tx.write('pickup type', pickup_type.index[changed], pickup_type[changed].tolist())
+
+
+def save_edits(edits, status=True, pickup_types=True, store=None):
+    """
+    Write edited cells to the report and refresh the derived columns of the rows they touch.
+
+    status recomputes the status column of the touched rows; pickup_types also
+    regroups combined pickups for the pickup groups the touched rows leave or join.
+    Edited rows move to a new version. Returns the number of rows written. An edited value that
+    does not fit its column's type raises ValueError, and nothing is written.
+    """
+    if not edits:
+        return 0
+    store = store or get_report_store()
+    expected = {key: changes[VERSION_COLUMN] for key, changes in edits.items() if VERSION_COLUMN in changes}
+    edits = {key: {col: value for col, value in changes.items() if col != VERSION_COLUMN} for key, changes in edits.items()}
+    keys = list(edits)
+    with store.transaction() as tx:
+        row_ids = dict(zip(keys, tx.locate(keys)))
+        touched = sorted(set(row_ids.values()))
+        if expected:
+            current = tx.read([row_ids[key] for key in expected], [VERSION_COLUMN])[VERSION_COLUMN]
+            stale = [key for key, version in expected.items() if current[row_ids[key]] != version]
+            if stale:
+                bookings = ', '.join(sorted({booking for booking, _ in stale}))
+                raise ReportConflict(
+                    f"{len(stale)} of the edited rows were changed by someone else since this page loaded "
+                    f"({bookings}). Nothing was saved; reload the page and apply your edits again.",
+                    stale,
+                )
+        if pickup_types:
+            groups_before = pickup_groups(tx.read(touched, PICKUP_COLUMNS))
+
+        columns = {col for changes in edits.values() for col in changes}
+        for col in columns:
+            changed_keys = [key for key in keys if col in edits[key]]
+            tx.write(col, [row_ids[key] for key in changed_keys], [edits[key][col] for key in changed_keys])
+        tx.bump_versions(touched)
+
+        if status:
+            rows = tx.read(touched)
+            new_status = compute_status(rows)
+            changed = ~((new_status == rows['status']) | (new_status.isna() & rows['status'].isna()))
+            tx.write('status', new_status.index[changed], new_status[changed].tolist())
+
+        if pickup_types:
+            update_pickup_types(tx, touched, groups_before)
+    return len(touched)
@@ -0,0 +1,103 @@
+"""
+Download payloads for the report.
+
+A payload is built only when a download is requested, and the bytes are kept for the stored
+report version they were built from, so repeated downloads of an unchanged report cost nothing.
+Excel is written row by row with xlsxwriter's constant_memory mode; CSV and Parquet are much
+cheaper to produce. Parquet needs pyarrow and is only offered when it is installed.
+"""
+import importlib.util
+import logging
+import threading
+from io import BytesIO
+
+import pandas as pd
+import xlsxwriter
+
+from report_schema import DISPLAY_DATE_FORMAT
+from report_store import REPORT_BACKEND, get_report_store, load_report_version
+
+EXPORT_FILE_NAME = "MSME Tracker Report"
+
+# format -> mime type, in the order the download buttons are shown
+EXPORT_MIME = {
+    'xlsx': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    'csv': "text/csv",
+    'parquet': "application/vnd.apache.parquet",
+}
+
+PARQUET_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+
+exportlog = logging.getLogger('report_export')
+
+
+def excel_bytes(report):
+    """The report as an .xlsx workbook, laid out as DataFrame.to_excel(index=False) lays it out."""
+    output = BytesIO()
+    # constant_memory flushes each row once the next one starts, so memory stays flat with report size
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Report')
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    date_format = workbook.add_format({'num_format': 'dd-mm-yyyy'})
+
+    date_columns = [n for n, col in enumerate(report.columns) if pd.api.types.is_datetime64_any_dtype(report[col])]
+    cells = report.astype(object).where(report.notna(), None)
+
+    worksheet.write_row(0, 0, [str(col) for col in report.columns], header_format)
+    for row_number, values in enumerate(cells.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_number, 0, values)
+        for n in date_columns:
+            if values[n] is not None:
+                worksheet.write_datetime(row_number, n, values[n], date_format)
+    workbook.close()
+    return output.getvalue()
+
+
+def csv_bytes(report):
+    return report.to_csv(index=False, date_format=DISPLAY_DATE_FORMAT).encode('utf-8')
+
+
+def parquet_bytes(report):
+    # Edited columns mix text and numbers, which Parquet cannot hold in one column; they are written as text
+    table = report.copy()
+    for col in table.columns:
+        if table[col].dtype == object:
+            table[col] = [None if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)) else str(value)
+                          for value in table[col].tolist()]
+    output = BytesIO()
+    table.to_parquet(output, index=False)
+    return output.getvalue()
+
+
+EXPORT_BUILDERS = {'xlsx': excel_bytes, 'csv': csv_bytes, 'parquet': parquet_bytes}
+
+
+def export_formats():
+    """The formats that can be exported here."""
+    return [fmt for fmt in EXPORT_MIME if fmt != 'parquet' or PARQUET_AVAILABLE]
+
+
+def export_file_name(fmt):
+    return f"{EXPORT_FILE_NAME}.{fmt}"
+
+
+# (backend, format) -> (stamp, bytes) for the last version exported; shared by every session
+_export_cache = {}
+_export_cache_lock = threading.Lock()
+
+
+def export_report(fmt, backend=None):
+    """The stored report as fmt bytes, built on first request for each stored version."""
+    backend = backend or REPORT_BACKEND
+    stamp = get_report_store(backend).stamp()
+    with _export_cache_lock:
+        cached = _export_cache.get((backend, fmt))
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+    # Built outside the lock so one slow export does not hold up downloads of other formats
+    stamp, report = load_report_version(backend)
+    payload = EXPORT_BUILDERS[fmt](report)
+    exportlog.info(f"Exported report version {stamp} as {fmt}: {len(payload)} bytes")
+    with _export_cache_lock:
+        _export_cache[(backend, fmt)] = (stamp, payload)
+    return payload
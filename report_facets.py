@@ -0,0 +1,138 @@
+"""
+Filter dropdowns for the role pages, served from an index built once per report version.
+
+A FacetIndex holds, for each filter column, the sorted distinct values and the row positions
+holding each value. Dropdown options come straight from it, a combination of filters resolves
+by intersecting position arrays, and each dropdown only offers the values still present in the
+rows the other filters select.
+"""
+import threading
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from report_schema import DISPLAY_DATE_FORMAT
+
+ALL = "All"
+
+# column -> dropdown label, laid out as two rows: booking and customer, then the other four
+FACET_COLUMNS = {
+    "Agraga Booking #": "Filter by Agraga Booking #",
+    "Customer Name": "Filter by Customer Name",
+    "FBA Code": "Filter by FBA Code",
+    "Pick up number": "Filter by Pick up number",
+    "CFS": "Filter by CFS",
+    "ETA": "Filter by ETA",
+}
+FACET_ROWS = [2, 4]
+
+# Columns filtered on their text form, dates as the report shows them
+TEXT_FACETS = ["ETA"]
+
+
+def _option_order(values):
+    """Positions of values in sorted order."""
+    try:
+        return sorted(range(len(values)), key=values.__getitem__)
+    except TypeError:
+        # a column mixing numbers and text has no natural order
+        return sorted(range(len(values)), key=lambda i: (type(values[i]).__name__, str(values[i])))
+
+
+class FacetIndex:
+    """Distinct values of the filter columns of one frame, and the row positions holding each."""
+
+    def __init__(self, frame, columns=FACET_COLUMNS):
+        self.size = len(frame)
+        self.codes = {}
+        self.options = {}
+        self.positions = {}
+        for col in columns:
+            values = frame[col]
+            if col in TEXT_FACETS:
+                values = values.dt.strftime(DISPLAY_DATE_FORMAT) if pd.api.types.is_datetime64_any_dtype(values) else values.astype(str)
+            codes, uniques = pd.factorize(values, use_na_sentinel=True)
+            uniques = list(uniques)
+            order = _option_order(uniques)
+            options = [uniques[i] for i in order]
+            # codes are renumbered so code order is option order; missing values keep -1
+            rank = np.empty(len(uniques) + 1, dtype=np.int64)
+            rank[order] = np.arange(len(uniques))
+            rank[-1] = -1
+            codes = rank[codes]
+            by_code = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[by_code], np.arange(-1, len(options) + 1))
+            self.codes[col] = codes
+            self.options[col] = options
+            self.positions[col] = {value: by_code[bounds[n + 1]:bounds[n + 2]] for n, value in enumerate(options)}
+
+    def rows(self, selected, skip=None):
+        """Positions of the rows matching every selected value ({column: value or ALL}), in frame order."""
+        positions = None
+        for col, value in selected.items():
+            if value == ALL or col == skip:
+                continue
+            matched = self.positions[col].get(value, np.empty(0, dtype=np.int64))
+            positions = matched if positions is None else np.intersect1d(positions, matched, assume_unique=True)
+        return np.arange(self.size) if positions is None else positions
+
+    def available(self, col, selected):
+        """The options of col present in the rows the other selections leave."""
+        if all(value == ALL for other, value in selected.items() if other != col):
+            return self.options[col]
+        codes = np.unique(self.codes[col][self.rows(selected, skip=col)])
+        options = self.options[col]
+        return [options[code] for code in codes if code >= 0]
+
+    def resolve(self, selected):
+        """
+        selected with any value no longer on offer reset to ALL, and the options for each column.
+
+        Values not in the report at all are dropped first. Of two selections that rule each other
+        out, the one in the later column is reset, one at a time, since a reset widens the others.
+        """
+        selected = {col: value if value in self.positions[col] else ALL for col, value in selected.items()}
+        while True:
+            options = {col: self.available(col, selected) for col in selected}
+            stale = [col for col, value in selected.items() if value != ALL and value not in options[col]]
+            if not stale:
+                return selected, options
+            selected[stale[-1]] = ALL
+
+
+# (page, stamp) -> FacetIndex for the last report version each page indexed
+_facet_cache = {}
+_facet_cache_lock = threading.Lock()
+
+
+def facet_index(page, stamp, frame):
+    """
+    The FacetIndex of a page's frame for report version stamp, built on first use.
+
+    frame must be the page's rows as it builds them from that version every rerun, since the
+    index records row positions.
+    """
+    with _facet_cache_lock:
+        cached = _facet_cache.get(page)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, FacetIndex(frame))
+            _facet_cache[page] = cached
+    return cached[1]
+
+
+def facet_filters(index, page):
+    """Render the filter dropdowns for a page and return the positions of the rows they select."""
+    keys = {col: f"{page}_filter_{col}" for col in FACET_COLUMNS}
+    selected, options = index.resolve({col: st.session_state.get(key, ALL) for col, key in keys.items()})
+    for col, key in keys.items():
+        # a selection the other filters ruled out goes back to All before its widget is drawn
+        if st.session_state.get(key, ALL) != selected[col]:
+            st.session_state[key] = selected[col]
+
+    columns = iter(FACET_COLUMNS.items())
+    for width in FACET_ROWS:
+        for layout, (col, label) in zip(st.columns(width), columns):
+            with layout:
+                st.selectbox(label, options=[ALL] + options[col], key=keys[col])
+    return index.rows(selected)
@@ -0,0 +1,139 @@
+"""
+Paged editing for the role pages.
+
+Only one page of the filtered rows is cleaned and handed to st.data_editor, so what is sent to
+the browser on each rerun stays the same size however many bookings are in progress. Rows keep
+their report index, so edits still map to stable row keys through row_keys().
+"""
+import hashlib
+import math
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from report_schema import plain_values
+from report_store import KEY_COLUMN, VERSION_COLUMN
+
+PAGE_SIZES = [25, 50, 100, 250]
+DEFAULT_PAGE_SIZE = 50
+
+REPORT_ORDER = "Report order"
+
+# Columns the search box looks in
+SEARCH_COLUMNS = [
+    "Agraga Booking #", "Customer Name", "MBL#", "HBL#", "Container #", "FBA Code",
+    "Pick up number", "PRO Number", "status", "Remarks",
+]
+
+
+def search_rows(frame, text, columns=SEARCH_COLUMNS):
+    """Rows with text in any of columns, ignoring case."""
+    text = text.strip()
+    if not text:
+        return frame
+    found = np.zeros(len(frame), dtype=bool)
+    for col in columns:
+        if col in frame.columns:
+            found |= frame[col].astype(str).str.contains(text, case=False, regex=False, na=False).to_numpy(dtype=bool)
+    return frame[found]
+
+
+def sort_rows(frame, column, descending=False):
+    """
+    Rows ordered by column, empty values last. A column that is all numbers sorts as numbers,
+    anything else as text; rows with equal values keep report order.
+    """
+    if column == REPORT_ORDER or column not in frame.columns:
+        return frame
+    values = frame[column].reset_index(drop=True)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        order = values.sort_values(ascending=not descending, kind='stable', na_position='last').index
+        return frame.iloc[order.to_numpy()]
+    blank = values.isna() | (values.astype(str).str.strip() == '')
+    numbers = pd.to_numeric(values.where(~blank), errors='coerce')
+    if numbers.notna().sum() == (~blank).sum():
+        sort_key = numbers
+    else:
+        sort_key = values.where(~blank).astype(str).str.casefold()
+    order = sort_key.sort_values(ascending=not descending, kind='stable', na_position='last').index
+    return frame.iloc[order.to_numpy()]
+
+
+def paged_rows(frame, page, columns=None):
+    """
+    Render the search, sort and paging controls for a page and return the rows of the current
+    page of frame, with frame's index and its categorical and Int64 columns as plain values.
+
+    columns are the ones offered for sorting; page names the controls' session state.
+    """
+    search_col, sort_col, order_col, size_col = st.columns([3, 2, 1, 1])
+    with search_col:
+        text = st.text_input("Search", key=f"{page}_search", placeholder="Booking #, customer, MBL, HBL, container, FBA code...")
+    with sort_col:
+        sort_by = st.selectbox("Sort by", options=[REPORT_ORDER] + list(columns or frame.columns), key=f"{page}_sort")
+    with order_col:
+        descending = st.selectbox("Order", options=["Ascending", "Descending"], key=f"{page}_order") == "Descending"
+    with size_col:
+        page_size = st.selectbox("Rows per page", options=PAGE_SIZES, index=PAGE_SIZES.index(DEFAULT_PAGE_SIZE), key=f"{page}_page_size")
+
+    rows = sort_rows(search_rows(frame, text), sort_by, descending)
+    pages = max(1, math.ceil(len(rows) / page_size))
+    number_key = f"{page}_page"
+    # filters and search can leave fewer pages than the one shown
+    if st.session_state.get(number_key, 1) > pages:
+        st.session_state[number_key] = pages
+
+    number_col, caption_col = st.columns([1, 6])
+    with number_col:
+        number = st.number_input("Page", min_value=1, max_value=pages, step=1, key=number_key)
+    start = (number - 1) * page_size
+    window = rows.iloc[start:start + page_size]
+    with caption_col:
+        st.caption(
+            f"Rows {start + 1 if len(window) else 0}–{start + len(window)} of {len(rows)}. "
+            "Save your changes before moving to another page; unsaved edits are not carried over."
+        )
+    # the pages' cleaning code fills blanks with text, which categorical and Int64 columns refuse
+    return plain_values(window)
+
+
+def editor_key(page, window):
+    """
+    The st.data_editor key for a page of rows. It changes with the rows shown, so edits made on
+    one page are never applied by position to another, and after each save (editor_saved).
+    """
+    rows = hashlib.blake2b(np.asarray(window.index, dtype=np.int64).tobytes(), digest_size=8).hexdigest()
+    return f"{page}_editor_{st.session_state.get(f'{page}_editor_saves', 0)}_{rows}"
+
+
+def editor_saved(page):
+    """Start the page's editor afresh after a save, so further edits are made against the saved rows."""
+    saves = f"{page}_editor_saves"
+    st.session_state[saves] = st.session_state.get(saves, 0) + 1
+
+
+def _has_pending_edits(editor):
+    state = st.session_state.get(editor) or {}
+    return any(state.get(kind) for kind in ("edited_rows", "added_rows", "deleted_rows"))
+
+
+def editor_versions(page, editor, keys, window):
+    """
+    keys for window's rows, with each row's version as it was when the editor's pending edits
+    were made, for edited_cells.
+
+    Saving reruns the page, which reloads the report, and st.data_editor keeps its edits when
+    the data under it changes; versions taken from that reload would already include anyone
+    else's save in the meantime. The versions are remembered from the last run with no pending
+    edits, so such a save is refused as a conflict instead of being overwritten. Only the page's
+    current editor is remembered; moving to another page of rows, or saving, drops the last one.
+    """
+    keys = keys.loc[window.index].copy()
+    row_ids = list(zip(keys[KEY_COLUMN].tolist(), keys['leg'].tolist()))
+    remembered = f"{page}_editor_versions"
+    if st.session_state.get(remembered, (None, None))[0] != editor or not _has_pending_edits(editor):
+        st.session_state[remembered] = (editor, dict(zip(row_ids, keys[VERSION_COLUMN].tolist())))
+    _, versions = st.session_state[remembered]
+    keys[VERSION_COLUMN] = [versions.get(row_id, version) for row_id, version in zip(row_ids, keys[VERSION_COLUMN].tolist())]
+    return keys
@@ -0,0 +1,141 @@
+"""
+Declared dtypes of the report columns.
+
+The backend applies the schema when it builds a report and the store keeps each column's dtype,
+so every consumer loads the report already typed: repeated labels as categoricals, counts as
+nullable integers, amounts as floats and dates as datetime64. A column whose stored values do
+not all fit its declared type (hand-typed text in a date column, say) is left as it is and
+logged, rather than losing those values.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+# Few distinct values repeated on many rows
+CATEGORY_COLUMNS = [
+    "Customer Name", "Booking Status", "FBA?", "Carrier", "Consolidator", "Origin", "FPOD", "CFS",
+    "Freight Broker", "Transporter", "status", "pickup type",
+]
+INTEGER_COLUMNS = ["Pallets", "Actual # of Pallets", "Storage Incurred (Days)"]
+FLOAT_COLUMNS = ["Delivery Quote"]
+DATE_COLUMNS = [
+    "Stuffing Date", "ETD", "ETA", "SOB", "ATA", "LFD", "DO Released Date", "Pick-up Date", "Delivery Date",
+    "Ready for Pick-up Date", "HBL Released Date", "Delivery Appointment Date",
+]
+
+REPORT_SCHEMA = {
+    **{col: 'category' for col in CATEGORY_COLUMNS},
+    **{col: 'Int64' for col in INTEGER_COLUMNS},
+    **{col: 'float64' for col in FLOAT_COLUMNS},
+    **{col: 'datetime64[ns]' for col in DATE_COLUMNS},
+}
+
+# The backend writes dd-mm-yyyy, the date editors ISO dates, and the store ISO date-times
+DATE_FORMATS = ['%d-%m-%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S']
+
+# How dates are shown in exports and filters, as the report has always shown them
+DISPLAY_DATE_FORMAT = '%d-%m-%Y'
+
+schemalog = logging.getLogger('report_schema')
+
+
+def blank_mask(values):
+    """True where a value is missing or blank text."""
+    return values.isna() | (values.astype(str).str.strip() == '')
+
+
+def parse_dates(values):
+    """values as datetime64, or None if some non-blank value is not a date in DATE_FORMATS."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    blank = blank_mask(values)
+    text = values.where(~blank).astype(str)
+    parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for fmt in DATE_FORMATS:
+        todo = ~blank & parsed.isna()
+        if not todo.any():
+            break
+        parsed[todo] = pd.to_datetime(text[todo], format=fmt, errors='coerce')
+    if (~blank & parsed.isna()).any():
+        return None
+    return parsed
+
+
+def parse_numbers(values, integer=False):
+    """values as Int64 or float64, or None if some non-blank value is not such a number."""
+    blank = blank_mask(values)
+    numbers = pd.to_numeric(values.where(~blank), errors='coerce')
+    if (~blank & numbers.isna()).any():
+        return None
+    if integer:
+        if not (numbers.dropna() % 1 == 0).all():
+            return None
+        return numbers.astype('Int64')
+    return numbers.astype('float64')
+
+
+def typed_column(values, dtype):
+    """values converted to dtype, or None if they do not all fit it."""
+    if str(values.dtype) == dtype or (dtype.startswith('datetime64') and pd.api.types.is_datetime64_any_dtype(values)):
+        return values
+    if dtype == 'category':
+        return values.astype('category')
+    if dtype == 'Int64':
+        return parse_numbers(values, integer=True)
+    if dtype == 'float64':
+        return parse_numbers(values)
+    return parse_dates(values)
+
+
+def apply_report_schema(report):
+    """report with every REPORT_SCHEMA column it has converted to its declared dtype."""
+    report = report.copy()
+    for col, dtype in REPORT_SCHEMA.items():
+        if col not in report.columns:
+            continue
+        typed = typed_column(report[col], dtype)
+        if typed is None:
+            schemalog.warning(f"'{col}' has values that are not {dtype}; kept as stored")
+        elif typed is not report[col]:
+            report[col] = typed
+    return report
+
+
+def _blank(value):
+    return value is None or (pd.api.types.is_scalar(value) and pd.isna(value)) or str(value).strip() == ''
+
+
+def coerce_values(dtype, values):
+    """
+    Edited values converted for a column of dtype, for writing without changing its type.
+    Raises ValueError if a value does not fit.
+    """
+    dtype = str(dtype)
+    if dtype in ('category', 'object', 'str', 'string'):
+        return list(values)
+    if dtype == 'Int64':
+        numbers = [None if _blank(value) else float(value) for value in values]
+        if any(number is not None and not number.is_integer() for number in numbers):
+            raise ValueError(f"Not whole numbers: {values}")
+        return [None if number is None else int(number) for number in numbers]
+    if dtype == 'float64':
+        return [None if _blank(value) else float(value) for value in values]
+    if dtype.startswith('datetime64'):
+        dates = parse_dates(pd.Series(list(values), dtype=object))
+        if dates is None:
+            raise ValueError(f"Not dates: {values}")
+        return [None if pd.isna(date) else date for date in dates.tolist()]
+    raise ValueError(f"No conversion to {dtype}")
+
+
+def plain_values(frame):
+    """
+    frame with categorical and nullable integer columns as plain objects, for the role pages'
+    editor code, which fills and replaces blanks with text.
+    """
+    frame = frame.copy()
+    for col in frame.columns:
+        if isinstance(frame[col].dtype, (pd.CategoricalDtype, pd.Int64Dtype)):
+            frame[col] = frame[col].astype(object).where(frame[col].notna(), np.nan)
+    return frame
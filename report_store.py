@@ -0,0 +1,488 @@
+"""
+Storage for the shipment tracker report.
+
+The report lives in a SQLite database (data/report.sqlite) that the backend and every role page
+read and write through load_report/save_report. report.xlsx is no longer the system of record;
+Excel files are only produced for downloads and exports.
+
+Every row carries a version (the _version column). Writers compare-and-swap: a role page's save
+fails with ReportConflict if any row it edits has a newer version than the one it loaded, and the
+backend's whole-report save fails if anything was written since it read the report. Reads never
+take a lock.
+
+    python report_store.py migrate    # one-time import of data/report.xlsx
+    python report_store.py export     # write the current report to data/report.xlsx
+"""
+import abc
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from datetime import date, datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from report_schema import apply_report_schema, coerce_values
+
+REPORT_EXCEL_PATH = r"data/report.xlsx"
+REPORT_DB_PATH = r"data/report.sqlite"
+
+# 'sqlite' is the canonical store; 'excel' keeps the report in report.xlsx as before
+REPORT_BACKEND = 'sqlite'
+
+# Rows are identified by booking number and leg, the position of the row among that booking's rows
+KEY_COLUMN = 'Agraga Booking #'
+
+# Incremented whenever a row is edited or updated by the backend; new rows start at 1
+VERSION_COLUMN = '_version'
+
+# How long a writer waits for another writer's lock on the Excel report
+LOCK_TIMEOUT_SECONDS = 30
+
+storelog = logging.getLogger('report_store')
+
+
+class ReportConflict(Exception):
+    """A save was based on a version of the report, or of some of its rows, that has since changed."""
+
+    def __init__(self, message, keys=()):
+        super().__init__(message)
+        self.keys = list(keys)
+
+
+def row_keys(report):
+    """
+    (booking #, leg) for every row of a report in stored order, aligned on its index, plus the
+    row's version when the report was loaded with versions.
+    """
+    keys = pd.DataFrame({KEY_COLUMN: report[KEY_COLUMN], 'leg': report.groupby(KEY_COLUMN).cumcount()})
+    if VERSION_COLUMN in report.columns:
+        keys[VERSION_COLUMN] = report[VERSION_COLUMN]
+    return keys
+
+
+def with_versions(report):
+    """report with a version on every row; reports saved before rows were versioned start at 1."""
+    if VERSION_COLUMN in report.columns:
+        return report
+    return report.assign(**{VERSION_COLUMN: 1})
+
+
+@contextmanager
+def _file_lock(path, timeout=LOCK_TIMEOUT_SECONDS):
+    """Exclusive writer lock on path, held as a path.lock file; readers never take it."""
+    lock_path = f"{path}.lock"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{lock_path} is held by another writer; delete it if no save is running")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
+class ReportStore(abc.ABC):
+    """Where the report is kept. Backends implement exists, load, save, stamp and transaction."""
+
+    @abc.abstractmethod
+    def exists(self):
+        """True if a report has been stored."""
+
+    @abc.abstractmethod
+    def load(self):
+        """The stored report, typed by its schema and with a version on every row."""
+
+    @abc.abstractmethod
+    def save(self, report, expected_stamp=None):
+        """
+        Replace the stored report and return its new stamp. With expected_stamp, raises
+        ReportConflict instead if the store was written since that stamp was taken.
+        """
+
+    @abc.abstractmethod
+    def stamp(self):
+        """Changes whenever the stored report is written; used to tell if cached data is still current."""
+
+    @abc.abstractmethod
+    def transaction(self):
+        """
+        Context manager for targeted row updates. The object it yields has
+        locate(keys) -> row ids, read(row_ids=None, columns=None) -> frame indexed by row id,
+        write(column, row_ids, values) and bump_versions(row_ids); everything is applied together
+        when the block exits, and nothing is if it raises. write raises ValueError for values that
+        do not fit the column's type, so such an edit is not saved.
+        """
+
+
+def _coerced(column, dtype, values):
+    """values converted for column by coerce_values, with the column named when they do not fit."""
+    try:
+        return coerce_values(dtype, values)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"'{column}' only takes {dtype} values; nothing was saved ({e})") from e
+
+
+class _FrameTransaction:
+    """Row updates against a report held in memory; the row id is the position in the report."""
+
+    def __init__(self, report):
+        self.report = report
+
+    def locate(self, keys):
+        positions = pd.MultiIndex.from_frame(row_keys(self.report)[[KEY_COLUMN, 'leg']]).get_indexer(pd.MultiIndex.from_tuples(keys))
+        if (positions < 0).any():
+            raise LookupError(f"Rows not in the report: {[key for key, position in zip(keys, positions) if position < 0]}")
+        return positions.tolist()
+
+    def read(self, row_ids=None, columns=None):
+        report = self.report if row_ids is None else self.report.iloc[list(row_ids)]
+        return report if columns is None else report[columns]
+
+    def write(self, column, row_ids, values):
+        dtype = self.report[column].dtype
+        values = _coerced(column, dtype, values)
+        updated = self.report[column].astype(object)
+        updated.iloc[list(row_ids)] = list(values)
+        # categories are rebuilt, since an edit may add a label the column had not seen
+        self.report[column] = updated.astype('category' if isinstance(dtype, pd.CategoricalDtype) else dtype)
+
+    def bump_versions(self, row_ids):
+        position = self.report.columns.get_loc(VERSION_COLUMN)
+        self.report.iloc[list(row_ids), position] = self.report.iloc[list(row_ids), position] + 1
+
+
+class ExcelReportStore(ReportStore):
+    def __init__(self, path=REPORT_EXCEL_PATH):
+        self.path = path
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def load(self):
+        return with_versions(apply_report_schema(pd.read_excel(self.path)))
+
+    def _replace(self, report):
+        # Written next to the workbook and renamed over it, so readers never see a half-written file
+        root, ext = os.path.splitext(self.path)
+        tmp_path = f"{root}.{os.getpid()}.{threading.get_ident()}.tmp{ext}"
+        try:
+            with_versions(report).to_excel(tmp_path, index=False)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return self.stamp()
+
+    def save(self, report, expected_stamp=None):
+        with _file_lock(self.path):
+            if expected_stamp is not None and self.stamp() != expected_stamp:
+                raise ReportConflict("The report was changed by someone else while this version was prepared")
+            return self._replace(report)
+
+    def stamp(self):
+        stat = os.stat(self.path)
+        return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+    @contextmanager
+    def transaction(self):
+        # The workbook has no partial updates; the whole file is rewritten under the writer lock
+        with _file_lock(self.path):
+            tx = _FrameTransaction(self.load())
+            yield tx
+            self._replace(tx.report)
+
+
+def _sql_value(value):
+    """Values sqlite3 can bind directly pass through; anything else is stored as text."""
+    if value is None or isinstance(value, (str, int, float, bytes)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat(sep=' ') if isinstance(value, datetime) else value.isoformat()
+    if pd.isna(value):
+        return None
+    return str(value)
+
+
+def _chunks(values, size=900):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class _SQLiteTransaction:
+    def __init__(self, store, connection):
+        self.store = store
+        self.connection = connection
+        self.dtypes = dict(connection.execute(f'SELECT name, dtype FROM "{store.COLUMNS_TABLE}"').fetchall())
+
+    def locate(self, keys):
+        bookings = sorted({booking for booking, _ in keys})
+        found = []
+        for chunk in _chunks(bookings):
+            found += self.connection.execute(
+                f'SELECT rowid, "{KEY_COLUMN}" FROM "{self.store.TABLE}" '
+                f'WHERE "{KEY_COLUMN}" IN ({", ".join("?" * len(chunk))}) ORDER BY rowid',
+                chunk,
+            ).fetchall()
+        rows = pd.DataFrame(found, columns=['rowid', KEY_COLUMN])
+        rows['leg'] = rows.groupby(KEY_COLUMN).cumcount()
+        row_ids = dict(zip(zip(rows[KEY_COLUMN].tolist(), rows['leg'].tolist()), rows['rowid'].tolist()))
+        missing = [key for key in keys if key not in row_ids]
+        if missing:
+            raise LookupError(f"Rows not in the report: {missing}")
+        return [row_ids[key] for key in keys]
+
+    def read(self, row_ids=None, columns=None):
+        selected = "*" if columns is None else ", ".join(f'"{col}"' for col in columns)
+        query = f'SELECT rowid AS _rowid, {selected} FROM "{self.store.TABLE}"'
+        if row_ids is None:
+            frames = [pd.read_sql_query(f"{query} ORDER BY rowid", self.connection)]
+        else:
+            frames = [
+                pd.read_sql_query(f"{query} WHERE rowid IN ({', '.join('?' * len(chunk))}) ORDER BY rowid", self.connection, params=chunk)
+                for chunk in _chunks(row_ids)
+            ]
+        frames = [frame for frame in frames if not frame.empty] or frames[:1]
+        return pd.concat(frames).set_index('_rowid')
+
+    def write(self, column, row_ids, values):
+        # a column with no recorded dtype is untyped and takes values as written
+        if column in self.dtypes:
+            values = _coerced(column, self.dtypes[column], values)
+        self.connection.executemany(
+            f'UPDATE "{self.store.TABLE}" SET "{column}" = ? WHERE rowid = ?',
+            [(_sql_value(value), int(row_id)) for row_id, value in zip(row_ids, values)],
+        )
+
+    def bump_versions(self, row_ids):
+        self.connection.executemany(
+            f'UPDATE "{self.store.TABLE}" SET "{VERSION_COLUMN}" = "{VERSION_COLUMN}" + 1 WHERE rowid = ?',
+            [(int(row_id),) for row_id in row_ids],
+        )
+
+
+class SQLiteReportStore(ReportStore):
+    """
+    The report as one SQLite table, plus a table recording each column's pandas dtype so typed
+    columns (dates, nullable integers) come back as they were saved, and a version counter that
+    every write increments.
+
+    Saves build the new table next to the old one and swap them in a single transaction, so a
+    reader sees either the old report or the new one. Row order is the table's rowid order.
+    WAL journaling lets readers go on reading the last committed report while a write is running.
+    """
+
+    TABLE = "report"
+    COLUMNS_TABLE = "report_columns"
+    META_TABLE = "report_meta"
+
+    def __init__(self, path=REPORT_DB_PATH):
+        self.path = path
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def exists(self):
+        if not os.path.isfile(self.path):
+            return False
+        with closing(self.connect()) as connection:
+            found = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (self.TABLE,)
+            ).fetchone()
+        return found is not None
+
+    def load(self):
+        connection = self.connect()
+        try:
+            report = pd.read_sql_query(f'SELECT * FROM "{self.TABLE}" ORDER BY rowid', connection)
+            dtypes = dict(connection.execute(f'SELECT name, dtype FROM "{self.COLUMNS_TABLE}"').fetchall())
+        finally:
+            connection.close()
+        for col, dtype in dtypes.items():
+            if col not in report.columns:
+                continue
+            try:
+                if dtype.startswith('datetime64'):
+                    report[col] = pd.to_datetime(report[col], errors='coerce')
+                elif dtype in ('category', 'Int64', 'boolean', 'bool', 'float64'):
+                    report[col] = report[col].astype(dtype)
+            except (ValueError, TypeError) as e:
+                storelog.warning(f"'{col}' could not be restored as {dtype}, loaded as stored: {e}")
+        # a report saved before the schema was declared is typed on the way out
+        return with_versions(apply_report_schema(report))
+
+    def save(self, report, expected_stamp=None):
+        report = with_versions(report)
+        table = report.copy()
+        for col in table.columns:
+            if table[col].dtype == object or pd.api.types.is_string_dtype(table[col]):
+                table[col] = [_sql_value(value) for value in table[col].tolist()]
+        columns = pd.DataFrame({"name": [str(col) for col in report.columns], "dtype": [str(dtype) for dtype in report.dtypes]})
+        # BLOB declares no type affinity, so SQLite keeps each value as written ('00123' stays text)
+        column_types = {str(col): 'BLOB' for col in report.columns}
+
+        # Each writer builds its own copy, so two saves in flight never share a staging table
+        staging = f"new_{os.getpid()}_{threading.get_ident()}"
+
+        connection = self.connect()
+        try:
+            table.to_sql(f"{self.TABLE}_{staging}", connection, if_exists='replace', index=False, dtype=column_types)
+            columns.to_sql(f"{self.COLUMNS_TABLE}_{staging}", connection, if_exists='replace', index=False)
+            connection.isolation_level = None
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if expected_stamp is not None and self._stamp(connection) != expected_stamp:
+                    raise ReportConflict("The report was changed by someone else while this version was prepared")
+                for name in (self.TABLE, self.COLUMNS_TABLE):
+                    connection.execute(f'DROP TABLE IF EXISTS "{name}"')
+                    connection.execute(f'ALTER TABLE "{name}_{staging}" RENAME TO "{name}"')
+                connection.execute(f'CREATE INDEX "{self.TABLE}_key" ON "{self.TABLE}" ("{KEY_COLUMN}")')
+                self._bump_version(connection)
+                stamp = self._stamp(connection)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                for name in (self.TABLE, self.COLUMNS_TABLE):
+                    connection.execute(f'DROP TABLE IF EXISTS "{name}_{staging}"')
+                raise
+        finally:
+            connection.close()
+        return stamp
+
+    def _add_version_column(self, connection):
+        # Databases written before rows were versioned get the column, every row at version 1
+        columns = [row[1] for row in connection.execute(f'PRAGMA table_info("{self.TABLE}")')]
+        if VERSION_COLUMN not in columns:
+            connection.execute(f'ALTER TABLE "{self.TABLE}" ADD COLUMN "{VERSION_COLUMN}" INTEGER NOT NULL DEFAULT 1')
+            connection.execute(f'INSERT INTO "{self.COLUMNS_TABLE}" (name, dtype) VALUES (?, ?)', (VERSION_COLUMN, 'int64'))
+
+    def _bump_version(self, connection):
+        connection.execute(f'CREATE TABLE IF NOT EXISTS "{self.META_TABLE}" (version INTEGER NOT NULL)')
+        if connection.execute(f'UPDATE "{self.META_TABLE}" SET version = version + 1').rowcount == 0:
+            connection.execute(f'INSERT INTO "{self.META_TABLE}" (version) VALUES (1)')
+
+    def _stamp(self, connection):
+        # the inode tells a recreated database apart from the one the version was counted in
+        try:
+            version = connection.execute(f'SELECT version FROM "{self.META_TABLE}"').fetchone()[0]
+        except (sqlite3.OperationalError, TypeError):
+            version = 0
+        return {"inode": os.stat(self.path).st_ino, "version": version}
+
+    def stamp(self):
+        with closing(self.connect()) as connection:
+            return self._stamp(connection)
+
+    @contextmanager
+    def transaction(self):
+        connection = self.connect()
+        connection.isolation_level = None
+        try:
+            # IMMEDIATE takes the write lock up front, so concurrent saves queue instead of failing midway
+            connection.execute("BEGIN IMMEDIATE")
+            self._add_version_column(connection)
+            tx = _SQLiteTransaction(self, connection)
+            try:
+                yield tx
+                self._bump_version(connection)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        finally:
+            connection.close()
+
+
+@lru_cache(maxsize=None)
+def _open_store(backend):
+    if backend == 'excel':
+        return ExcelReportStore()
+    store = SQLiteReportStore()
+    if not store.exists() and os.path.isfile(REPORT_EXCEL_PATH):
+        migrate_excel_report(store)
+    return store
+
+
+def get_report_store(backend=None):
+    return _open_store(backend or REPORT_BACKEND)
+
+
+def migrate_excel_report(store, excel_path=REPORT_EXCEL_PATH):
+    """One-time import of the Excel report into store; the Excel file is left in place."""
+    report = pd.read_excel(excel_path)
+    store.save(report)
+    storelog.info(f"Migrated {len(report)} report rows from {excel_path} to {store.path}")
+    return report
+
+
+# backend -> (stamp, report) for the last version loaded; Streamlit serves every session from
+# one process, so all pages and users share it
+_report_cache = {}
+_report_cache_lock = threading.Lock()
+
+
+def load_report(backend=None, versions=False):
+    """
+    The stored report, parsed once per stored version and shared by every session.
+
+    The store's stamp is checked on each call, so a save from any page or the backend is picked
+    up on the next call. Callers get their own copy and may modify it. Pages that save edits ask
+    for versions, which adds the _version column their saves are checked against.
+    """
+    return load_report_version(backend, versions)[1]
+
+
+def load_report_version(backend=None, versions=False):
+    """(stamp, report) for the stored report; the stamp identifies the version the report is a copy of."""
+    backend = backend or REPORT_BACKEND
+    store = get_report_store(backend)
+    with _report_cache_lock:
+        stamp = store.stamp()
+        cached = _report_cache.get(backend)
+        if cached is None or cached[0] != stamp:
+            storelog.info(f"Loading report version {stamp}")
+            cached = (stamp, store.load())
+            _report_cache[backend] = cached
+    return cached[0], cached[1].copy() if versions else cached[1].drop(columns=VERSION_COLUMN)
+
+
+def save_report(report, expected_stamp=None):
+    return get_report_store().save(report, expected_stamp)
+
+
+def export_report_excel(path=REPORT_EXCEL_PATH):
+    load_report().to_excel(path, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the stored MSME shipment tracker report")
+    parser.add_argument("command", choices=["migrate", "export"])
+    parser.add_argument("--excel", default=REPORT_EXCEL_PATH)
+    parser.add_argument("--force", action="store_true", help="migrate even if the database already holds a report")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        store = SQLiteReportStore()
+        if store.exists() and not args.force:
+            parser.error(f"{REPORT_DB_PATH} already holds a report; use --force to replace it")
+        report = migrate_excel_report(store, args.excel)
+        print(f"Migrated {len(report)} rows from {args.excel} to {REPORT_DB_PATH}")
+    else:
+        export_report_excel(args.excel)
+        print(f"Exported the report to {args.excel}")
@@ -0,0 +1,231 @@
+"""
+Stage timings for backend runs.
+
+Backend_data wraps each stage of a run (collection fetches, flattening, merges, booking_process,
+process_report, report reads and writes) in stage(), which records its wall time, the CPU time
+of the thread running it, how much it raised the process's peak RSS, and the rows it produced.
+At the end of a run the stages are written as one JSON line appended to logs/run_metrics.jsonl
+and as a Prometheus text file (logs/run_metrics.prom) for node_exporter's textfile collector.
+
+Stages are only kept while a run is active, from start_run (or the start of recorded_run) until
+recorded_run ends. Outside a run, such as in the change stream listener, stage() records nothing,
+so a long-running process does not accumulate stages.
+
+Stages nest: a collection fetch includes the flattening of its batches. A stage run more than
+once in a run (flattening runs per batch) is reported once, with its calls summed. Fetches run
+in parallel threads, so their peak RSS deltas overlap and only the largest is meaningful.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # Windows has no getrusage; peak RSS is not recorded there
+    resource = None
+
+RUN_RECORD_PATH = r"logs/run_metrics.jsonl"
+PROMETHEUS_PATH = r"logs/run_metrics.prom"
+
+METRIC_PREFIX = "msme_tracker"
+
+metricslog = logging.getLogger('run_metrics')
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far, or None where it cannot be read."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Stage:
+    """Measurements of one call of a stage; rows is set by the code being measured."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_delta_bytes = None
+
+
+class Run:
+    """The stages recorded since the run started."""
+
+    def __init__(self):
+        self.started = datetime.now(timezone.utc)
+        self.info = {}
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def add(self, stage):
+        with self.lock:
+            self.stages.append(stage)
+
+    def summary(self):
+        """Per stage name, in order of first call: calls, summed times and rows, largest RSS delta."""
+        with self.lock:
+            stages = list(self.stages)
+        summary = {}
+        for stage in stages:
+            entry = summary.setdefault(stage.name, {
+                "calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_delta_bytes": None, "rows": None,
+            })
+            entry["calls"] += 1
+            entry["wall_seconds"] += stage.wall_seconds
+            entry["cpu_seconds"] += stage.cpu_seconds
+            if stage.peak_rss_delta_bytes is not None:
+                entry["peak_rss_delta_bytes"] = max(entry["peak_rss_delta_bytes"] or 0, stage.peak_rss_delta_bytes)
+            if stage.rows is not None:
+                entry["rows"] = (entry["rows"] or 0) + stage.rows
+        for entry in summary.values():
+            entry["wall_seconds"] = round(entry["wall_seconds"], 6)
+            entry["cpu_seconds"] = round(entry["cpu_seconds"], 6)
+        return summary
+
+
+# The active run, or None when stages are not being recorded
+_run = None
+
+
+def start_run(**info):
+    """Begin recording a new run, dropping the stages of the previous one."""
+    global _run
+    _run = Run()
+    _run.info.update(info)
+    return _run
+
+
+def set_run_info(**info):
+    """Attach details (refresh mode, booking counts) to the run record, if a run is active."""
+    if _run is not None:
+        _run.info.update(info)
+
+
+@contextmanager
+def stage(name):
+    """
+    Measure the block as one call of stage name. Set .rows on the yielded Stage to record how
+    many rows it produced.
+    """
+    measured = Stage(name)
+    peak_before = peak_rss_bytes()
+    wall_started = time.perf_counter()
+    cpu_started = time.thread_time()
+    try:
+        yield measured
+    finally:
+        measured.wall_seconds = time.perf_counter() - wall_started
+        measured.cpu_seconds = time.thread_time() - cpu_started
+        if peak_before is not None:
+            measured.peak_rss_delta_bytes = peak_rss_bytes() - peak_before
+        if _run is not None:
+            _run.add(measured)
+
+
+def timed(name, rows=None):
+    """Decorator measuring each call of a function as stage name; rows(result) gives its row count."""
+    def decorate(function):
+        @wraps(function)
+        def measured_call(*args, **kwargs):
+            with stage(name) as measured:
+                result = function(*args, **kwargs)
+                if rows is not None:
+                    measured.rows = rows(result)
+            return result
+        return measured_call
+    return decorate
+
+
+def run_record(success=True, error=None):
+    """The current run as a JSON-serializable dict."""
+    finished = datetime.now(timezone.utc)
+    return {
+        "started": _run.started.isoformat(),
+        "finished": finished.isoformat(),
+        "duration_seconds": round((finished - _run.started).total_seconds(), 6),
+        "success": success,
+        "error": error,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "info": dict(_run.info),
+        "stages": _run.summary(),
+    }
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(record):
+    """The run record in the Prometheus text exposition format."""
+    metrics = [
+        ("run_success", "1 if the last run finished without an error.", [({}, int(record["success"]))]),
+        ("run_timestamp_seconds", "When the last run finished, as a Unix time.",
+         [({}, datetime.fromisoformat(record["finished"]).timestamp())]),
+        ("run_duration_seconds", "Wall time of the last run.", [({}, record["duration_seconds"])]),
+        ("run_peak_rss_bytes", "Peak resident set size of the process running the last run.", [({}, record["peak_rss_bytes"])]),
+    ]
+    stage_metrics = {
+        "calls": "Times each stage ran in the last run.",
+        "wall_seconds": "Wall time spent in each stage in the last run.",
+        "cpu_seconds": "CPU time of the thread running each stage in the last run.",
+        "peak_rss_delta_bytes": "How much each stage raised the process's peak resident set size in the last run.",
+        "rows": "Rows produced by each stage in the last run.",
+    }
+    for field, help_text in stage_metrics.items():
+        samples = [({"stage": name}, entry[field]) for name, entry in record["stages"].items()]
+        metrics.append((f"stage_{field}", help_text, samples))
+
+    lines = []
+    for name, help_text, samples in metrics:
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            continue
+        lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{_label(label)}"' for key, label in labels.items())
+            lines.append(f"{METRIC_PREFIX}_{name}{{{label_text}}} {value}" if label_text else f"{METRIC_PREFIX}_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_run_record(success=True, error=None, record_path=RUN_RECORD_PATH, prometheus_path=PROMETHEUS_PATH):
+    """Append the run record to record_path and replace prometheus_path with its metrics."""
+    record = run_record(success, error)
+    with open(record_path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    # Replaced in one step so the textfile collector never reads a half-written file
+    tmp_path = f"{prometheus_path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(prometheus_text(record))
+    os.replace(tmp_path, prometheus_path)
+    metricslog.info(f"Run record written to {record_path} and {prometheus_path}")
+    return record
+
+
+@contextmanager
+def recorded_run(**info):
+    """
+    Record the stages of the block as one run and write its record when it ends, even on error.
+    Stages after the block are not recorded until the next run starts.
+    """
+    global _run
+    run = start_run(**info)
+    try:
+        yield run
+    except BaseException as e:
+        write_run_record(success=False, error=f"{type(e).__name__}: {e}")
+        raise
+    else:
+        write_run_record()
+    finally:
+        _run = None
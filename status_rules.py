@@ -0,0 +1,146 @@
+"""
+The report's status column, derived from which of the tracked fields are filled in.
+
+The rules are evaluated for whole columns at once, in this order:
+
+1. Every STATUS_BASIC_COLUMNS field filled: "<fields> pending" listing the
+   STATUS_REQUIRED_COLUMNS still empty, or the status is left as it is when none are.
+2. The STATUS_RULES in turn: the first whose fields are all filled and whose number field is
+   non-zero sets its status.
+3. Otherwise the status is left as it is.
+
+A number field that cannot be converted makes compute_status raise, as the row-by-row rules did,
+unless errors='keep' is passed; that row then keeps its status and the value is logged.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+STATUS_REQUIRED_COLUMNS = [
+    'ISF Filing', 'CFS', 'Freight Broker', 'Transporter', 'Delivery Quote',
+    'Actual # of Pallets', 'Ready for Pick-up Date', 'DO Release Approved?',
+    'HBL Released Date', 'Pick up number', 'Delivery Appointment Date',
+    'Vendor Delivery Invoice', 'PRO Number', 'Storage Incurred (Days)', 'Remarks'
+]
+STATUS_BASIC_COLUMNS = ['CFS', 'Actual # of Pallets', 'Ready for Pick-up Date', 'Freight Broker', 'Transporter', 'Delivery Quote']
+
+# (status, fields that must be filled, field that must be a non-zero number, its type), first match wins
+STATUS_RULES = [
+    ('Transport Assignment Pending', ['CFS', 'Actual # of Pallets', 'Ready for Pick-up Date'], 'Actual # of Pallets', int),
+    ('Delivery Order Release Approval Pending', ['Freight Broker', 'Transporter', 'Delivery Quote'], 'Delivery Quote', float),
+]
+
+statuslog = logging.getLogger('status_rules')
+
+
+def filled_mask(values):
+    """True where a value is present and not blank text."""
+    return (values.notna() & (values.astype(str).str.strip() != '')).to_numpy(dtype=bool)
+
+
+def nonzero_mask(values, number_type, errors='raise'):
+    """
+    (nonzero, unreadable): True where number_type(value) != 0, and where value is not a number.
+    Each distinct value is converted once; a value that is not a number raises, as converting it
+    row by row did, unless errors='keep', where it is marked unreadable instead.
+    """
+    values = values.tolist()
+    nonzero = {}
+    for value in values:
+        if value not in nonzero:
+            try:
+                nonzero[value] = number_type(value) != 0
+            except (ValueError, TypeError):
+                if errors != 'keep':
+                    raise
+                nonzero[value] = None
+    results = [nonzero[value] for value in values]
+    return np.array([result is True for result in results], dtype=bool), np.array([result is None for result in results], dtype=bool)
+
+
+def pending_status(missing):
+    """'<fields> pending' for each row of a boolean (rows x STATUS_REQUIRED_COLUMNS) missing matrix."""
+    # Rows missing the same fields share a bit pattern, so each distinct message is built once
+    patterns, inverse = np.unique(missing @ (1 << np.arange(len(STATUS_REQUIRED_COLUMNS))), return_inverse=True)
+    messages = np.array(
+        [', '.join(col for bit, col in enumerate(STATUS_REQUIRED_COLUMNS) if pattern >> bit & 1) + ' pending' for pattern in patterns],
+        dtype=object,
+    )
+    return messages[inverse.reshape(-1)]
+
+
+def compute_status(rows, errors='raise'):
+    """
+    The status column for rows after applying the rules; rows no rule applies to keep their status.
+    With errors='keep' a row whose number field is not a number keeps its status too, rather than
+    the whole call raising.
+    """
+    filled = {col: filled_mask(rows[col]) for col in STATUS_REQUIRED_COLUMNS}
+    status = rows['status'].copy()
+
+    all_basic = np.logical_and.reduce([filled[col] for col in STATUS_BASIC_COLUMNS])
+    missing = ~np.column_stack([filled[col][all_basic] for col in STATUS_REQUIRED_COLUMNS]).reshape(-1, len(STATUS_REQUIRED_COLUMNS))
+    has_pending = missing.any(axis=1)
+    assign = np.zeros(len(rows), dtype=bool)
+    values = np.empty(len(rows), dtype=object)
+    assign[np.flatnonzero(all_basic)[has_pending]] = True
+    values[assign] = pending_status(missing[has_pending])
+
+    undecided = ~all_basic
+    for label, required, number_col, number_type in STATUS_RULES:
+        candidates = undecided & np.logical_and.reduce([filled[col] for col in required])
+        matched = np.zeros(len(rows), dtype=bool)
+        unreadable = np.zeros(len(rows), dtype=bool)
+        matched[candidates], unreadable[candidates] = nonzero_mask(rows[number_col][candidates], number_type, errors)
+        assign |= matched
+        values[matched] = label
+        # like the row-by-row rules, which stopped at the failed conversion, no later rule applies
+        undecided &= ~(matched | unreadable)
+        if unreadable.any():
+            statuslog.warning(
+                f"Kept the status of {int(unreadable.sum())} rows whose '{number_col}' is not a number: "
+                f"{sorted(set(map(str, rows[number_col][unreadable])))[:5]}"
+            )
+
+    if assign.any():
+        # a categorical status only holds labels it has seen, so rules assign into plain values
+        if isinstance(status.dtype, pd.CategoricalDtype) or not pd.api.types.is_string_dtype(status):
+            status = status.astype(object)
+        status[assign] = values[assign]
+    return status
+
+
+def is_filled(val):
+    return pd.notna(val) and str(val).strip() != ''
+
+
+def determine_status(row):
+    """
+    The status rules one row at a time, as the role pages applied them with
+    report.apply(determine_status, axis=1) before compute_status. Kept as the reference
+    compute_status is checked against in tests/test_status_rules.py. It keeps its own column
+    lists, so a change to the ones compute_status uses shows up as a difference.
+    """
+    all_required_columns = [
+        'ISF Filing', 'CFS', 'Freight Broker', 'Transporter', 'Delivery Quote',
+        'Actual # of Pallets', 'Ready for Pick-up Date', 'DO Release Approved?',
+        'HBL Released Date', 'Pick up number', 'Delivery Appointment Date',
+        'Vendor Delivery Invoice', 'PRO Number', 'Storage Incurred (Days)', 'Remarks'
+    ]
+    basic_6_fields = ['CFS', 'Actual # of Pallets', 'Ready for Pick-up Date', 'Freight Broker', 'Transporter', 'Delivery Quote']
+
+    # Condition 3: All 6 fields updated
+    if all(is_filled(row[col]) for col in basic_6_fields):
+        # Check which of the 15 total required fields are still not filled
+        pending_fields = [col for col in all_required_columns if not is_filled(row[col])]
+        if pending_fields:
+            row['status'] = ', '.join(pending_fields) + ' pending'
+    # Condition 1: Basic transport info
+    elif is_filled(row['CFS']) and is_filled(row['Actual # of Pallets']) and is_filled(row['Ready for Pick-up Date']) and int(row['Actual # of Pallets']) != 0:
+        row['status'] = 'Transport Assignment Pending'
+    # Condition 2: Broker + Transporter + Quote
+    elif is_filled(row['Freight Broker']) and is_filled(row['Transporter']) and is_filled(row['Delivery Quote']) and float(row['Delivery Quote']) != 0.0:
+        row['status'] = 'Delivery Order Release Approval Pending'
+
+    return row
@@ -0,0 +1,187 @@
+import argparse
+import os
+import time
+
+from bson import json_util
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure, PyMongoError
+
+import Backend_data
+from report_store import ReportConflict
+
+# Collections whose changes affect the report, and where each change event keeps the booking ID
+WATCHED_COLLECTIONS = {
+    "Bookings": "_id",
+    "Bookingdsr": "_id",
+    "Myactions": "_id.bookingNum",
+}
+
+# Only events on the watched collections are sent by the server
+WATCH_PIPELINE = [{"$match": {"ns.coll": {"$in": list(WATCHED_COLLECTIONS)}}}]
+
+RESUME_TOKEN_PATH = r"data/resume_token.json"
+
+# Changes arriving within this window are applied together in one report update
+BATCH_SECONDS = 5
+MAX_BATCH_SIZE = 500
+
+# Server error code when the resume token is older than the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+# A batch that fails to apply (Mongo unreachable, report edited throughout the merge) is retried
+# after RETRY_SECONDS, doubling each time, APPLY_ATTEMPTS times in all. After that the listener
+# waits RESTART_SECONDS and reopens the stream from the last saved token, which replays the batch.
+APPLY_ATTEMPTS = 4
+RETRY_SECONDS = 10
+RESTART_SECONDS = 300
+
+# Addressdetails is read once and reused by the batches that follow, then read again once older
+# than this, so new delivery addresses get their FBA codes
+ADDRESSDETAILS_MAX_AGE_SECONDS = 3600
+
+streamlog = Backend_data.setup_logger('streamlog', os.path.join(Backend_data.log_folder, 'change_stream.log'))
+
+
+def load_resume_token(path=RESUME_TOKEN_PATH):
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json_util.loads(f.read())
+
+
+def save_resume_token(token, path=RESUME_TOKEN_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(json_util.dumps(token))
+    os.replace(tmp_path, path)
+
+
+def booking_id_from_event(event):
+    """Booking ID affected by a change event, or None if it cannot be determined."""
+    id_path = WATCHED_COLLECTIONS.get(event["ns"]["coll"])
+    if id_path is None:
+        return None
+    return Backend_data._get_path(event.get("documentKey", {}), id_path)
+
+
+# (Addressdetails, when it was read)
+_addressdetails = (None, None)
+
+
+def cached_addressdetails():
+    """Addressdetails as read at most ADDRESSDETAILS_MAX_AGE_SECONDS ago."""
+    global _addressdetails
+    Addressdetails, read_at = _addressdetails
+    if Addressdetails is None or time.time() - read_at > ADDRESSDETAILS_MAX_AGE_SECONDS:
+        Addressdetails = Backend_data.read_addressdetails_from_mongo()
+        _addressdetails = (Addressdetails, time.time())
+    return Addressdetails
+
+
+def apply_changes(booking_ids):
+    """
+    Push booking_ids through the report, retrying with a growing delay if the refresh fails;
+    the last failure is raised.
+    """
+    streamlog.info(f"Applying {len(booking_ids)} changed bookings")
+    for attempt in range(1, APPLY_ATTEMPTS + 1):
+        started = time.time()
+        try:
+            # fetch_data failures arrive as RuntimeError; ReportConflict if the merge kept being overtaken.
+            # Users.xlsx is written by the hourly job only, so the two never write it at once.
+            Backend_data.run_incremental_refresh(booking_ids, Addressdetails=cached_addressdetails(), users=False)
+        except (RuntimeError, ReportConflict, PyMongoError) as e:
+            if attempt == APPLY_ATTEMPTS:
+                raise
+            delay = RETRY_SECONDS * 2 ** (attempt - 1)
+            streamlog.warning(f"Applying the batch failed (attempt {attempt} of {APPLY_ATTEMPTS}), retrying in {delay}s: {e}")
+            time.sleep(delay)
+            continue
+        streamlog.info(f"Applied {len(booking_ids)} bookings in {time.time() - started:.2f}s")
+        return
+
+
+def listen(db, resume_token=None):
+    """
+    Watch the source collections and push changed bookings through the report.
+
+    The resume token is saved only after a batch has been applied, so a crash replays the
+    last batch instead of losing it.
+    """
+    with db.watch(WATCH_PIPELINE, resume_after=resume_token) as stream:
+        streamlog.info(f"Listening for changes on {', '.join(WATCHED_COLLECTIONS)}")
+        while stream.alive:
+            booking_ids = set()
+            batch_started = None
+            while True:
+                event = stream.try_next()
+                if event is not None:
+                    booking_id = booking_id_from_event(event)
+                    if booking_id is not None:
+                        booking_ids.add(booking_id)
+                    else:
+                        streamlog.warning(f"No booking ID in {event['operationType']} event on {event['ns']['coll']}")
+                    batch_started = batch_started or time.time()
+                if len(booking_ids) >= MAX_BATCH_SIZE:
+                    break
+                if batch_started is not None and time.time() - batch_started >= BATCH_SECONDS:
+                    break
+                if event is None and batch_started is None:
+                    # Idle: keep the token moving so a restart does not replay old history
+                    if stream.resume_token is not None:
+                        save_resume_token(stream.resume_token)
+                    time.sleep(1)
+
+            if booking_ids:
+                apply_changes(booking_ids)
+            save_resume_token(stream.resume_token)
+
+
+def current_resume_token(db):
+    """A resume token for the present position of the change stream, without waiting for a change."""
+    with db.watch(WATCH_PIPELINE) as stream:
+        if stream.resume_token is None:
+            # servers before 4.0.7 only hand out a token with the first batch
+            stream.try_next()
+        return stream.resume_token
+
+
+def run(host, port, database_name):
+    Backend_data.MONGO_HOST, Backend_data.MONGO_PORT, Backend_data.MONGO_DATABASE = host, port, database_name
+    while True:
+        client = MongoClient(f'mongodb://{host}:{port}/')
+        try:
+            listen(client[database_name], load_resume_token())
+        except OperationFailure as e:
+            if e.code != CHANGE_STREAM_HISTORY_LOST:
+                raise
+            # Changes were missed while the listener was down. The stream position is taken before
+            # the full refresh, so changes made while it runs are replayed afterwards, not lost.
+            streamlog.warning(f"Resume token no longer in the oplog, running a full refresh: {e}")
+            try:
+                resume_token = current_resume_token(client[database_name])
+                Backend_data.main(full=True)
+            except (RuntimeError, ReportConflict, PyMongoError) as e:
+                # the old token is kept, so the next attempt runs the full refresh again
+                streamlog.error(f"Full refresh failed, retrying in {RESTART_SECONDS}s: {e}")
+                time.sleep(RESTART_SECONDS)
+                continue
+            save_resume_token(resume_token)
+        except PyMongoError as e:
+            streamlog.error(f"Change stream interrupted: {e}")
+            time.sleep(10)
+        except (RuntimeError, ReportConflict) as e:
+            # the batch's resume token was not saved, so reopening the stream replays it
+            streamlog.error(f"Could not apply a batch of changes, replaying it in {RESTART_SECONDS}s: {e}")
+            time.sleep(RESTART_SECONDS)
+        finally:
+            client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply MongoDB changes to the MSME shipment tracker report as they happen")
+    parser.add_argument("--host", default=Backend_data.MONGO_HOST)
+    parser.add_argument("--port", default=Backend_data.MONGO_PORT)
+    parser.add_argument("--database", default=Backend_data.MONGO_DATABASE)
+    args = parser.parse_args()
+    run(args.host, args.port, args.database)
@@ -0,0 +1,26 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+# The app's modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def import_app(tmp_path_factory):
+    """
+    Import an app module from a scratch working directory: Backend_data opens its log files
+    under logs/ in the working directory when it is first imported.
+    """
+    folder = tmp_path_factory.mktemp("app")
+
+    def import_module(name):
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            return importlib.import_module(name)
+        finally:
+            os.chdir(cwd)
+    return import_module
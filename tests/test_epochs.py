@@ -0,0 +1,67 @@
+"""
+epochs_to_dates gives the same local dates as epoch_to_date, value by value, in server time zones
+with and without DST, on either side of each clock change.
+"""
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Lord Howe moves by half an hour, and Santiago and Havana change their clocks at local midnight
+ZONES = ['America/New_York', 'Europe/London', 'Australia/Lord_Howe', 'America/Santiago', 'America/Havana',
+         'Asia/Kolkata', 'Asia/Kathmandu', 'UTC']
+
+
+@pytest.fixture(params=ZONES)
+def server_zone(request, monkeypatch):
+    """Run the test with the process's local time zone set to the zone."""
+    monkeypatch.setenv("TZ", request.param)
+    time.tzset()
+    yield ZoneInfo(request.param)
+    monkeypatch.undo()
+    time.tzset()
+
+
+def clock_changes(zone, year):
+    """UTC times at which zone's offset changes during year."""
+    hour = datetime(year, 1, 1, tzinfo=timezone.utc)
+    changes = []
+    while hour.year == year:
+        following = hour + timedelta(hours=1)
+        if hour.astimezone(zone).utcoffset() != following.astimezone(zone).utcoffset():
+            changes.append(following)
+        hour = following
+    return changes
+
+
+def epochs_around(changes, seed):
+    """Millisecond epochs every few minutes for two days either side of each change."""
+    rng = random.Random(seed)
+    epochs = []
+    for change in changes:
+        start = int(change.timestamp() * 1000) - 2 * 86_400_000
+        epochs += [start + minutes * 60_000 + rng.randint(0, 59_999) for minutes in range(0, 4 * 24 * 60, 7)]
+    return epochs
+
+
+def test_epochs_to_dates_matches_epoch_to_date_across_clock_changes(import_app, server_zone):
+    Backend_data = import_app("Backend_data")
+    changes = clock_changes(server_zone, 2024) + clock_changes(server_zone, 2025)
+    epochs = epochs_around(changes, seed=0) + epochs_around([datetime(2025, 6, 1, tzinfo=timezone.utc)], seed=1)
+    epochs = pd.Series(epochs, dtype=object)
+
+    expected = epochs.apply(Backend_data.epoch_to_date).astype(object)
+    pd.testing.assert_series_equal(Backend_data.epochs_to_dates(epochs), expected)
+    # as they are read from Mongo: floats, with a few missing
+    floats = pd.Series(epochs.astype(float).where(np.arange(len(epochs)) % 50 != 0))
+    pd.testing.assert_series_equal(Backend_data.epochs_to_dates(floats), floats.apply(Backend_data.epoch_to_date).astype(object))
+
+
+def test_epochs_to_dates_reads_what_epoch_to_date_reads(import_app, server_zone):
+    Backend_data = import_app("Backend_data")
+    epochs = pd.Series([None, np.nan, 'not a date', '1710054000000', 1710054000000.9, -86_400_001, 0, 1], dtype=object)
+    pd.testing.assert_series_equal(Backend_data.epochs_to_dates(epochs), epochs.apply(Backend_data.epoch_to_date).astype(object))
@@ -0,0 +1,72 @@
+"""
+fetch_data's 'pipeline' engine joins bookings on the server; it must read the same bookings as
+the 'find' engine, which joins them in pandas. Both run against a generated dataset in mongomock.
+"""
+import pandas as pd
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+BOOKINGS = 3000
+
+
+@pytest.fixture(scope="module")
+def source(import_app):
+    """Backend_data with fetch_data reading a mongomock copy of the benchmark dataset."""
+    Backend_data = import_app("Backend_data")
+    benchmark = import_app("benchmark")
+    client = mongomock.MongoClient()
+    benchmark.load_database(client[benchmark.BENCHMARK_DATABASE], BOOKINGS, seed=1)
+    with benchmark.benchmark_source(lambda *args, **kwargs: client):
+        yield Backend_data
+
+
+def fetched(Backend_data, engine, booking_ids=None):
+    fetched = Backend_data.fetch_data(engine=engine, booking_ids=booking_ids)
+    assert fetched[0] is not None, "fetch_data failed, see mongo_data_extraction.log"
+    return fetched
+
+
+def by_booking(frame, key):
+    return frame.sort_values(key, kind="stable").reset_index(drop=True)
+
+
+def assert_same_bookings(Backend_data, booking_ids=None):
+    find = fetched(Backend_data, 'find', booking_ids)
+    pipeline = fetched(Backend_data, 'pipeline', booking_ids)
+    assert len(find[0]) > 0
+    assert set(find[0].columns) == set(pipeline[0].columns)
+    pd.testing.assert_frame_equal(by_booking(pipeline[0][find[0].columns], '_id'), by_booking(find[0], '_id'))
+
+    # and the report built from them, which is what the pages show
+    find_report = Backend_data.booking_process(find[0], find[4])
+    pipeline_report = Backend_data.booking_process(pipeline[0], pipeline[4])
+    pd.testing.assert_frame_equal(by_booking(pipeline_report, 'Agraga Booking #'), by_booking(find_report, 'Agraga Booking #'))
+    return find[0]
+
+
+def test_pipeline_engine_reads_the_same_bookings(source):
+    assert_same_bookings(source)
+
+
+def test_pipeline_engine_reads_the_same_changed_bookings(source):
+    everything = fetched(source, 'find')[0]
+    booking_ids = list(everything['_id'].iloc[::7])
+    changed = assert_same_bookings(source, booking_ids)
+    assert set(changed['_id']) == set(booking_ids)
+
+
+def test_changed_bookings_read_only_what_they_need(source):
+    everything = fetched(source, 'find')
+    booking_ids = list(everything[0]['_id'].iloc[::7])
+    changed = fetched(source, 'find', booking_ids)
+    # as the change stream listener reads a batch: its own Addressdetails, no users
+    Addressdetails = everything[4]
+    narrowed = source.fetch_data(engine='find', booking_ids=booking_ids, Addressdetails=Addressdetails, users=False)
+
+    pd.testing.assert_frame_equal(by_booking(narrowed[0], '_id'), by_booking(changed[0], '_id'))
+    assert narrowed[4] is Addressdetails
+    assert narrowed[5] is None
+    # SHEntities is read for the changed bookings' entities only
+    assert set(changed[0]['entityId']) <= set(narrowed[1]['entityId'])
+    assert len(narrowed[1]) < len(everything[1])
@@ -0,0 +1,137 @@
+"""
+Incremental refresh on a generated dataset in mongomock: which bookings scan_watermarks finds,
+and when main() updates only those rather than rebuilding the report.
+"""
+import logging
+from datetime import date, timedelta
+
+import pandas as pd
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+BOOKINGS = 600
+
+
+@pytest.fixture
+def source(import_app, tmp_path, monkeypatch):
+    """(Backend_data, db) with fetch_data reading a fresh mongomock dataset and files kept under tmp_path."""
+    Backend_data = import_app("Backend_data")
+    benchmark = import_app("benchmark")
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    # save_agusers replaces a sheet of the existing users workbook
+    pd.DataFrame({"email": []}).to_excel(tmp_path / "data" / "Users.xlsx", sheet_name="Agusers", index=False)
+    client = mongomock.MongoClient()
+    db = client[benchmark.BENCHMARK_DATABASE]
+    benchmark.load_database(db, BOOKINGS, seed=3)
+    with benchmark.benchmark_source(lambda *args, **kwargs: client):
+        yield Backend_data, db
+
+
+def in_scope_booking(Backend_data, db):
+    """A booking document that makes it into the report, to copy new bookings from."""
+    report = Backend_data.get_report_store().load()
+    return db["Bookings"].find_one({"_id": report['Agraga Booking #'].iloc[0]})
+
+
+def add_booking(db, template, booking_id, booking_date):
+    db["Bookings"].insert_one(dict(template, _id=booking_id, bookingDate=booking_date))
+    dsr = db["Bookingdsr"].find_one({"vdes.0": {"$exists": True}})
+    db["Bookingdsr"].insert_one(dict(dsr, _id=booking_id))
+
+
+def latest_booking_date(db):
+    return max(doc["bookingDate"] for doc in db["Bookings"].find({}, {"bookingDate": 1}))
+
+
+def test_scan_finds_new_bookings_actions_and_customers(source):
+    Backend_data, db = source
+    none, watermarks = Backend_data.scan_watermarks(db)
+    assert none == set()
+    assert all(watermarks[collection] is not None for collection in Backend_data.WATERMARK_FIELDS)
+
+    template = db["Bookings"].find_one({"contract.shipmentType": "LCL"})
+    later = (date.fromisoformat(latest_booking_date(db)) + timedelta(days=1)).isoformat()
+    db["Bookings"].insert_one(dict(template, _id="NEW-BOOKING", bookingDate=later))
+    # an action created later for an old booking
+    action = db["Myactions"].find_one()
+    db["Myactions"].insert_one(dict(action, _id={"bookingNum": "OLD-BOOKING", "actionId": -1},
+                                    createdOn=watermarks["Myactions"] + 1))
+    # a customer added after its booking was written
+    db["Bookings"].insert_one(dict(template, _id="NEW-CUSTOMER-BOOKING", entityId="NEWENT", bookingDate="2025-01-01"))
+    db["SHEntities"].insert_one({"entityId": "NEWENT", "entityName": "New Customer",
+                                 "customer": {"crossBorder": {"salesVertical": "MSME"}}})
+
+    booking_ids, new_watermarks = Backend_data.scan_watermarks(db, watermarks)
+    assert {"NEW-BOOKING", "OLD-BOOKING", "NEW-CUSTOMER-BOOKING"} <= booking_ids
+    # $gte keeps the bookings at the old watermark, but not the rest
+    assert len(booking_ids) < 20
+    assert new_watermarks["Bookings"] == later
+    assert new_watermarks["Myactions"] == watermarks["Myactions"] + 1
+    assert new_watermarks["SHEntities"] > watermarks["SHEntities"]
+
+    # nothing new since then: only the boundary documents again
+    again, _ = Backend_data.scan_watermarks(db, new_watermarks)
+    assert "OLD-BOOKING" in again and "NEW-CUSTOMER-BOOKING" in again
+    assert len(again) < 5
+
+
+def test_scan_without_a_stored_watermark_asks_for_a_full_refresh(source):
+    Backend_data, db = source
+    _, watermarks = Backend_data.scan_watermarks(db)
+    del watermarks["Myactions"]
+    booking_ids, _ = Backend_data.scan_watermarks(db, watermarks)
+    assert booking_ids is None
+
+
+def test_watermarks_survive_a_round_trip(source):
+    Backend_data, db = source
+    _, watermarks = Backend_data.scan_watermarks(db)
+    Backend_data.save_watermarks({"collections": watermarks, "last_full_refresh": "2025-06-01T00:00:00"})
+    assert Backend_data.load_watermarks()["collections"] == watermarks
+
+
+def test_added_address_refreshes_its_bookings(source):
+    Backend_data, db = source
+    report = pd.DataFrame({
+        'Agraga Booking #': ["B1", "B1", "B2", "B3", "B4"],
+        'Delivery Address': ["NEW-ADDRESS", "ADDR1", "NEW-ADDRESS", "NO-CODE-ADDRESS", ""],
+        'FBA Code': ["", "FBA1", None, "", ""],
+    })
+    assert Backend_data.bookings_with_added_addresses(db, report) == set()
+    db["Addressdetails"].insert_many([{"_id": "NEW-ADDRESS", "fbacode": "FBA9"}, {"_id": "NO-CODE-ADDRESS", "fbacode": ""}])
+    assert Backend_data.bookings_with_added_addresses(db, report) == {"B1", "B2"}
+
+
+def test_main_switches_to_incremental_after_a_full_refresh(source, caplog):
+    Backend_data, db = source
+    caplog.set_level(logging.INFO, logger="mongolog")
+    Backend_data.main()
+    assert "No full refresh recorded yet" in caplog.text
+    report = Backend_data.get_report_store().load()
+
+    template = in_scope_booking(Backend_data, db)
+    later = (date.fromisoformat(latest_booking_date(db)) + timedelta(days=1)).isoformat()
+    add_booking(db, template, "2512LCLNEW0000001", later)
+    caplog.clear()
+    Backend_data.main()
+    assert "Running incremental refresh" in caplog.text
+    assert not [record for record in caplog.records if record.levelno >= logging.WARNING]
+    updated = Backend_data.get_report_store().load()
+    assert set(updated['Agraga Booking #']) == set(report['Agraga Booking #']) | {"2512LCLNEW0000001"}
+    assert Backend_data.load_watermarks()["collections"]["Bookings"] == later
+
+
+def test_main_warns_when_it_falls_back_to_a_full_refresh(source, caplog):
+    Backend_data, db = source
+    # a database whose actions have no marker
+    db["Myactions"].update_many({}, {"$unset": {"createdOn": ""}})
+    Backend_data.main()
+    assert Backend_data.load_watermarks()["collections"]["Myactions"] is None
+    caplog.set_level(logging.INFO, logger="mongolog")
+    Backend_data.main()
+    warnings = [record.getMessage() for record in caplog.records if record.levelno == logging.WARNING]
+    assert any("No watermark stored for Myactions" in message for message in warnings)
+    assert any("running a full refresh instead" in message for message in warnings)
+    assert "Running full refresh" in caplog.text
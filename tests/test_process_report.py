@@ -0,0 +1,229 @@
+"""
+process_report merges a generated report into the stored one: checked against a row-at-a-time
+merge on random reports, with and without the row hashes of the previous run. merge_into_store
+then saves it only if no role page saved since the report was read.
+"""
+import logging
+import random
+
+import pandas as pd
+import pytest
+
+from report_edits import save_edits
+from report_schema import apply_report_schema
+from report_store import KEY_COLUMN, VERSION_COLUMN, ReportConflict, SQLiteReportStore, with_versions
+
+# Columns the backend fills; the rest are edited on the role pages and never taken from a generated report
+GENERATED_CHANGES = {
+    'Carrier': ['MAERSK', 'MSC', None],
+    'ETA': ['01-03-2025', '15-09-2025', None],
+    'Packages': [1.0, 12.0, None],
+    'FBA Code': ['FBA1', 'FBA999', ''],
+}
+EDITED_CHANGES = {'Remarks': ['Generated remark'], 'CFS': ['Generated CFS'], 'status': ['Generated status']}
+
+
+@pytest.fixture(scope="module")
+def app(import_app):
+    return import_app("Backend_data"), import_app("benchmark")
+
+
+def same(a, b):
+    missing = lambda value: value is None or (pd.api.types.is_scalar(value) and pd.isna(value))
+    return (missing(a) and missing(b)) or (not missing(a) and not missing(b) and a == b)
+
+
+def legs(report):
+    return list(zip(report[KEY_COLUMN], report.groupby(KEY_COLUMN).cumcount()))
+
+
+def reference_merge(existing, generated, compare_cols):
+    """The merge one row at a time: matching rows take the changed compare columns and a new version."""
+    generated_rows = dict(zip(legs(generated), generated.to_dict('records')))
+    rows = []
+    for leg, row in zip(legs(existing), existing.to_dict('records')):
+        incoming = generated_rows.pop(leg, None)
+        if incoming is not None and not all(same(row[col], incoming[col]) for col in compare_cols):
+            row.update({col: incoming[col] for col in compare_cols})
+            row[VERSION_COLUMN] += 1
+        rows.append(row)
+    rows += [dict(row, **{VERSION_COLUMN: 1}) for row in generated_rows.values()]
+    return pd.DataFrame(rows, columns=existing.columns)
+
+
+def random_reports(benchmark, seed):
+    """(existing, generated): a stored report and the next run's report of the same bookings, changed at random."""
+    rng = random.Random(seed)
+    existing = benchmark.make_report(60, seed=seed)
+    # some bookings have more than one row (one per container leg)
+    existing = pd.concat([existing, existing.sample(10, random_state=seed)]).reset_index(drop=True)
+    existing['Remarks'] = [rng.choice(['', 'Customer asked to hold']) for _ in range(len(existing))]
+    # blanks on both sides are the same value; a blank filled in by the next run is a change
+    for position in rng.sample(range(len(existing)), 20):
+        existing.at[position, rng.choice(list(GENERATED_CHANGES))] = None
+    existing = with_versions(apply_report_schema(existing)).assign(**{VERSION_COLUMN: [rng.randint(1, 4) for _ in range(len(existing))]})
+
+    generated = existing.drop(columns=[VERSION_COLUMN]).astype(object)
+    for position in rng.sample(range(len(generated)), 25):
+        changes = {**GENERATED_CHANGES, **EDITED_CHANGES}
+        col = rng.choice(list(changes))
+        generated.at[position, col] = rng.choice(changes[col])
+    # bookings that dropped out of scope, and new ones
+    generated = generated.drop(index=rng.sample(range(len(generated)), 5))
+    new = benchmark.make_report(5, seed=seed + 1000).assign(**{KEY_COLUMN: [f"NEW{seed}-{i}" for i in range(5)]})
+    generated = pd.concat([generated, new.astype(object)]).reset_index(drop=True)
+    return existing, apply_report_schema(generated)
+
+
+def comparable(report):
+    return report.astype(object).where(report.notna(), None).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_process_report_matches_a_row_by_row_merge(app, seed):
+    Backend_data, benchmark = app
+    existing, generated = random_reports(benchmark, seed)
+
+    merged, hashes = Backend_data.process_report(existing.copy(), generated.copy())
+    compare_cols = hashes["columns"]
+    assert not set(EDITED_CHANGES) & set(compare_cols)
+    assert set(GENERATED_CHANGES) <= set(compare_cols)
+    expected = reference_merge(comparable(existing), comparable(generated), compare_cols)
+    pd.testing.assert_frame_equal(comparable(merged), comparable(expected))
+
+
+def test_generated_changes_are_taken_and_edits_kept(app):
+    Backend_data, benchmark = app
+    existing = benchmark.make_report(3)
+    existing.loc[1, 'Remarks'] = 'Customer asked to hold'
+    existing = with_versions(apply_report_schema(existing))
+    generated = benchmark.make_report(3)
+    generated.loc[1, 'Carrier'] = 'MSC'
+    generated = apply_report_schema(generated)
+
+    merged, _ = Backend_data.process_report(existing.copy(), generated.copy())
+    assert merged['Carrier'].tolist() == generated['Carrier'].tolist()
+    assert merged['Remarks'].tolist() == existing['Remarks'].tolist()
+    assert merged[VERSION_COLUMN].tolist() == [1, 2, 1]
+
+
+def changed_again(benchmark, report, seed):
+    """The run after report: a few generated columns changed on a few rows."""
+    rng = random.Random(seed)
+    report = report.drop(columns=[VERSION_COLUMN]).astype(object)
+    for position in rng.sample(range(len(report)), 10):
+        col = rng.choice(list(GENERATED_CHANGES))
+        report.at[position, col] = rng.choice(GENERATED_CHANGES[col])
+    return apply_report_schema(report)
+
+
+def record_compared_rows(Backend_data, monkeypatch):
+    """A list that gets the number of rows of each full comparison process_report makes."""
+    compared = []
+    rows_changed = Backend_data.rows_changed
+
+    def recorded(existing, generated):
+        compared.append(len(existing))
+        return rows_changed(existing, generated)
+    monkeypatch.setattr(Backend_data, "rows_changed", recorded)
+    return compared
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_stored_hashes_skip_unchanged_rows_without_changing_the_merge(app, monkeypatch, seed):
+    Backend_data, benchmark = app
+    existing, generated = random_reports(benchmark, seed)
+    stored, hashes = Backend_data.process_report(existing.copy(), generated.copy())
+    following = changed_again(benchmark, generated.assign(**{VERSION_COLUMN: 1}), seed)
+
+    compared = record_compared_rows(Backend_data, monkeypatch)
+    with_hashes, _ = Backend_data.process_report(stored.copy(), following.copy(), hashes)
+    without_hashes, _ = Backend_data.process_report(stored.copy(), following.copy())
+    pd.testing.assert_frame_equal(comparable(with_hashes), comparable(without_hashes))
+
+    # only the rows whose generated content differs from the last run are compared
+    rehashed = Backend_data.row_hashes(following, hashes["columns"])
+    assert compared[0] == int((rehashed != Backend_data.row_hashes(generated, hashes["columns"])).sum())
+    assert compared[0] < compared[1] == len(following)
+
+
+def test_hashes_over_other_columns_are_not_used(app, monkeypatch):
+    Backend_data, benchmark = app
+    existing, generated = random_reports(benchmark, 0)
+    stored, hashes = Backend_data.process_report(existing.copy(), generated.copy())
+    compared = record_compared_rows(Backend_data, monkeypatch)
+    Backend_data.process_report(stored.copy(), generated.copy(), dict(hashes, columns=hashes["columns"][1:]))
+    assert compared == [len(generated)]
+
+
+@pytest.fixture
+def stored(app, tmp_path, monkeypatch):
+    """(Backend_data, store, generated): a store holding a report merged once, row hashes saved under tmp_path."""
+    Backend_data, benchmark = app
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    existing, generated = random_reports(benchmark, 0)
+    store = SQLiteReportStore(str(tmp_path / "data" / "report.sqlite"))
+    store.save(existing)
+    Backend_data.merge_into_store(store, generated)
+    return Backend_data, store, generated
+
+
+def remark_edit(store, booking, remark):
+    """Save a remark on booking's first row the way a role page does."""
+    report = store.load()
+    row = report.index[report[KEY_COLUMN] == booking][0]
+    return save_edits({(booking, 0): {'Remarks': remark, VERSION_COLUMN: int(report.at[row, VERSION_COLUMN])}}, store=store)
+
+
+def test_an_edit_since_the_last_merge_sets_the_hashes_aside(app, stored, monkeypatch, caplog):
+    Backend_data, store, generated = stored
+    _, benchmark = app
+    following = changed_again(benchmark, generated.assign(**{VERSION_COLUMN: 1}), 0)
+    compared = record_compared_rows(Backend_data, monkeypatch)
+    Backend_data.merge_into_store(store, following)
+    assert compared[-1] < len(following)
+
+    remark_edit(store, following[KEY_COLUMN].iloc[0], 'Customer asked to hold')
+    caplog.set_level(logging.INFO, logger="comparisonlog")
+    merged = Backend_data.merge_into_store(store, following)
+    assert "row hashes not used" in caplog.text
+    assert compared[-1] == len(following)
+    assert merged['Remarks'].iloc[0] == 'Customer asked to hold'
+
+
+def test_merge_is_redone_when_a_page_saves_during_it(stored, monkeypatch, caplog):
+    Backend_data, store, generated = stored
+    booking = generated[KEY_COLUMN].iloc[0]
+    save = store.save
+    saves = []
+
+    def save_after_an_edit(report, expected_stamp=None):
+        # a role page saves between the merge's read and its save, once
+        if not saves:
+            remark_edit(store, booking, 'Edited during the merge')
+        saves.append(expected_stamp)
+        return save(report, expected_stamp)
+    monkeypatch.setattr(store, "save", save_after_an_edit)
+    merged = Backend_data.merge_into_store(store, generated)
+
+    assert len(saves) == 2 and saves[0] != saves[1]
+    assert "retrying (attempt 1 of" in caplog.text
+    # the edit is merged into, not overwritten
+    assert merged.loc[merged[KEY_COLUMN] == booking, 'Remarks'].iloc[0] == 'Edited during the merge'
+    assert store.load().loc[0, 'Remarks'] == 'Edited during the merge'
+
+
+def test_merge_gives_up_when_pages_keep_saving(stored, monkeypatch):
+    Backend_data, store, generated = stored
+    save = store.save
+    booking = generated[KEY_COLUMN].iloc[0]
+    edits = iter(range(Backend_data.REPORT_SAVE_ATTEMPTS + 1))
+
+    def save_after_an_edit(report, expected_stamp=None):
+        remark_edit(store, booking, f'Edit {next(edits)}')
+        return save(report, expected_stamp)
+    monkeypatch.setattr(store, "save", save_after_an_edit)
+    with pytest.raises(ReportConflict, match="gave up"):
+        Backend_data.merge_into_store(store, generated)
+    assert store.load().loc[0, 'Remarks'] == f'Edit {Backend_data.REPORT_SAVE_ATTEMPTS - 1}'
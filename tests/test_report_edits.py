@@ -0,0 +1,64 @@
+"""
+save_edits against both report stores: edits that fit their columns are written, and ones that do
+not, or that were made to a row saved since it was loaded, are refused without writing anything.
+"""
+import pytest
+
+from report_edits import save_edits
+from report_schema import apply_report_schema
+from report_store import KEY_COLUMN, VERSION_COLUMN, ExcelReportStore, ReportConflict, SQLiteReportStore, row_keys
+
+
+@pytest.fixture(params=["sqlite", "excel"])
+def store(request, import_app, tmp_path):
+    """A store holding a small typed report."""
+    benchmark = import_app("benchmark")
+    store = SQLiteReportStore(str(tmp_path / "report.sqlite")) if request.param == "sqlite" else ExcelReportStore(str(tmp_path / "report.xlsx"))
+    store.save(apply_report_schema(benchmark.make_report(4)))
+    return store
+
+
+def first_row(store):
+    report = store.load()
+    return (row_keys(report)[KEY_COLUMN].iloc[0], 0), report
+
+
+def test_edit_that_fits_its_column_is_saved(store):
+    key, before = first_row(store)
+    assert str(before['Actual # of Pallets'].dtype) == 'Int64'
+
+    assert save_edits({key: {'Actual # of Pallets': '3', VERSION_COLUMN: int(before[VERSION_COLUMN].iloc[0])}}, store=store) == 1
+    after = store.load()
+    assert after['Actual # of Pallets'].iloc[0] == 3
+    assert str(after['Actual # of Pallets'].dtype) == 'Int64'
+    assert after[VERSION_COLUMN].iloc[0] == before[VERSION_COLUMN].iloc[0] + 1
+
+
+def test_edit_that_does_not_fit_its_column_is_refused(store):
+    key, before = first_row(store)
+    stamp = store.stamp()
+
+    edits = {key: {'Actual # of Pallets': 'two', 'Remarks': 'counted twice', VERSION_COLUMN: int(before[VERSION_COLUMN].iloc[0])}}
+    with pytest.raises(ValueError, match="Actual # of Pallets"):
+        save_edits(edits, store=store)
+    # nothing was written, not even the edit that did fit
+    assert store.stamp() == stamp
+    after = store.load()
+    assert after['Remarks'].iloc[0] == before['Remarks'].iloc[0]
+    assert str(after['Actual # of Pallets'].dtype) == 'Int64'
+
+
+def test_edit_of_a_row_saved_since_it_was_loaded_is_refused(store):
+    key, before = first_row(store)
+    loaded = int(before[VERSION_COLUMN].iloc[0])
+    # another page saves the row first
+    save_edits({key: {'Remarks': 'first', VERSION_COLUMN: loaded}}, store=store)
+    stamp = store.stamp()
+
+    with pytest.raises(ReportConflict) as refused:
+        save_edits({key: {'Remarks': 'second', VERSION_COLUMN: loaded}}, store=store)
+    assert refused.value.keys == [key]
+    assert store.stamp() == stamp
+    after = store.load()
+    assert after['Remarks'].iloc[0] == 'first'
+    assert after[VERSION_COLUMN].iloc[0] == loaded + 1
@@ -0,0 +1,138 @@
+"""
+FacetIndex against filtering the frame directly on random reports, and facet_filters with a plain
+dict standing in for st.session_state.
+"""
+import random
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import report_facets
+from report_facets import ALL, FACET_COLUMNS, TEXT_FACETS, FacetIndex, facet_filters, facet_index
+from report_schema import DISPLAY_DATE_FORMAT
+
+
+def random_frame(rng, rows):
+    """The filter columns with few distinct values, some missing, and pickup numbers mixing numbers and text."""
+    def column(pool):
+        return [rng.choice(pool) for _ in range(rows)]
+    return pd.DataFrame({
+        "Agraga Booking #": column([f"B{i}" for i in range(8)]),
+        "Customer Name": column(["Acme", "Globex", "Initech", None]),
+        "FBA Code": column(["FBA1", "FBA2", "FBA3", ""]),
+        "Pick up number": pd.Series(column([101, 205, "P-7", "P-12", None]), dtype=object),
+        "CFS": column(["CFS A", "CFS B", np.nan]),
+        "ETA": pd.to_datetime(column(["2025-01-05", "2025-01-06", "2024-12-31", None])),
+    })
+
+
+def shown(frame, col):
+    """A column's values as its filter compares them."""
+    values = frame[col]
+    return values.dt.strftime(DISPLAY_DATE_FORMAT) if col in TEXT_FACETS else values
+
+
+def reference_rows(frame, selected, skip=None):
+    matched = np.ones(len(frame), dtype=bool)
+    for col, value in selected.items():
+        if value != ALL and col != skip:
+            matched &= (shown(frame, col) == value).fillna(False).to_numpy(dtype=bool)
+    return np.flatnonzero(matched)
+
+
+def reference_available(frame, col, selected):
+    values = shown(frame, col).iloc[reference_rows(frame, selected, skip=col)]
+    return set(values[values.notna()].tolist())
+
+
+def random_selection(rng, frame):
+    """Up to three filters set, to values that are in the frame or, now and then, that are not."""
+    selected = {col: ALL for col in FACET_COLUMNS}
+    for col in rng.sample(list(FACET_COLUMNS), rng.randint(0, 3)):
+        values = shown(frame, col).dropna().tolist()
+        selected[col] = rng.choice(values) if values and rng.random() < 0.9 else "Not in the report"
+    return selected
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_facet_index_matches_filtering_the_frame(seed):
+    rng = random.Random(seed)
+    frame = random_frame(rng, rng.choice([0, 1, 40, 300]))
+    index = FacetIndex(frame)
+
+    for col in FACET_COLUMNS:
+        assert set(index.options[col]) == reference_available(frame, col, {})
+        assert len(index.options[col]) == len(set(index.options[col]))
+    assert index.options["CFS"] == sorted(index.options["CFS"])
+    assert index.options["ETA"] == sorted(index.options["ETA"])
+
+    for _ in range(20):
+        selected = random_selection(rng, frame)
+        assert index.rows(selected).tolist() == reference_rows(frame, selected).tolist()
+        for col in FACET_COLUMNS:
+            available = index.available(col, selected)
+            assert set(available) == reference_available(frame, col, selected)
+            # offered in the same order as the unfiltered options
+            assert available == [value for value in index.options[col] if value in set(available)]
+
+
+def test_resolve_resets_selections_the_others_rule_out():
+    frame = pd.DataFrame({
+        "Agraga Booking #": ["B1", "B2", "B3"],
+        "Customer Name": ["Acme", "Globex", "Globex"],
+        "FBA Code": ["FBA1", "FBA2", "FBA1"],
+        "Pick up number": [None, None, None],
+        "CFS": ["CFS A", "CFS A", "CFS B"],
+        "ETA": pd.to_datetime(["2025-01-05", "2025-01-06", "2025-01-06"]),
+    })
+    index = FacetIndex(frame)
+    selected = {col: ALL for col in FACET_COLUMNS}
+
+    # B1 is Acme's, so the later Globex selection is the one reset
+    resolved, options = index.resolve(dict(selected, **{"Agraga Booking #": "B1", "Customer Name": "Globex"}))
+    assert resolved == dict(selected, **{"Agraga Booking #": "B1"})
+    assert options["Customer Name"] == ["Acme"]
+    assert options["ETA"] == ["05-01-2025"]
+    assert index.rows(resolved).tolist() == [0]
+
+    # a value not in the report at all is dropped before anything else
+    resolved, options = index.resolve(dict(selected, **{"Agraga Booking #": "B9", "CFS": "CFS B"}))
+    assert resolved == dict(selected, **{"CFS": "CFS B"})
+    assert options["Agraga Booking #"] == ["B3"]
+    assert options["Pick up number"] == []
+
+
+def test_index_is_built_once_per_report_version(monkeypatch):
+    monkeypatch.setattr(report_facets, "_facet_cache", {})
+    frame = random_frame(random.Random(0), 20)
+    first = facet_index("msme", {"version": 1}, frame)
+    assert facet_index("msme", {"version": 1}, frame) is first
+    assert facet_index("centralOps", {"version": 1}, frame) is not first
+    assert facet_index("msme", {"version": 2}, frame.iloc[:5]).size == 5
+
+
+def test_facet_filters_draws_the_remaining_options(monkeypatch):
+    state = {"msme_filter_Customer Name": "Globex", "msme_filter_Agraga Booking #": "B1"}
+    drawn = {}
+    fake_st = SimpleNamespace(
+        session_state=state,
+        columns=lambda width: [nullcontext()] * width,
+        selectbox=lambda label, options, key: drawn.setdefault(key, options),
+    )
+    monkeypatch.setattr(report_facets, "st", fake_st)
+    frame = pd.DataFrame({
+        "Agraga Booking #": ["B1", "B2"], "Customer Name": ["Acme", "Globex"], "FBA Code": ["FBA1", "FBA2"],
+        "Pick up number": [7, 7], "CFS": ["CFS A", "CFS B"], "ETA": pd.to_datetime(["2025-01-05", None]),
+    })
+
+    assert facet_filters(FacetIndex(frame), "msme").tolist() == [0]
+    # the Globex selection was ruled out by B1 and is set back to All before its dropdown is drawn
+    assert state["msme_filter_Customer Name"] == ALL
+    assert list(drawn) == [f"msme_filter_{col}" for col in FACET_COLUMNS]
+    assert drawn["msme_filter_Customer Name"] == [ALL, "Acme"]
+    # a dropdown is narrowed by the other filters, not its own selection
+    assert drawn["msme_filter_Agraga Booking #"] == [ALL, "B1", "B2"]
+    assert drawn["msme_filter_ETA"] == [ALL, "05-01-2025"]
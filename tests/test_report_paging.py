@@ -0,0 +1,50 @@
+"""editor_versions against a plain dict standing in for st.session_state."""
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+import report_paging
+from report_paging import editor_versions
+from report_store import KEY_COLUMN, VERSION_COLUMN, row_keys
+
+
+@pytest.fixture
+def session_state(monkeypatch):
+    state = {}
+    monkeypatch.setattr(report_paging, "st", SimpleNamespace(session_state=state))
+    return state
+
+
+def report(versions):
+    return pd.DataFrame({KEY_COLUMN: ["B1", "B1", "B2", "B3"], VERSION_COLUMN: versions})
+
+
+def test_versions_are_kept_while_edits_are_pending(session_state):
+    window = report([1, 1, 1, 1]).iloc[:3]
+    assert editor_versions("msme", "msme_editor_0_a", row_keys(report([1, 1, 1, 1])), window)[VERSION_COLUMN].tolist() == [1, 1, 1]
+
+    # someone else saves B2 while this page has an edit pending
+    session_state["msme_editor_0_a"] = {"edited_rows": {0: {"Remarks": "x"}}}
+    keys = editor_versions("msme", "msme_editor_0_a", row_keys(report([1, 1, 2, 1])), window)
+    assert keys[VERSION_COLUMN].tolist() == [1, 1, 1]
+    assert keys['leg'].tolist() == [0, 1, 0]
+
+    # with nothing pending the reloaded versions are taken
+    session_state["msme_editor_0_a"] = {"edited_rows": {}}
+    assert editor_versions("msme", "msme_editor_0_a", row_keys(report([1, 1, 2, 1])), window)[VERSION_COLUMN].tolist() == [1, 1, 2]
+
+
+def test_only_the_current_editor_is_remembered(session_state):
+    full = report([1, 1, 1, 1])
+    for saves in range(50):
+        editor = f"msme_editor_{saves}_a"
+        session_state[editor] = {"edited_rows": {0: {"Remarks": "x"}}}
+        editor_versions("msme", editor, row_keys(full), full.iloc[saves % 2:][:2])
+        editor_versions("creditcontrol", f"creditcontrol_editor_{saves}_a", row_keys(full), full)
+    assert [key for key in session_state if key.endswith("_versions")] == ["msme_editor_versions", "creditcontrol_editor_versions"]
+
+    # a new editor starts from the versions it is shown, even with edits pending in it
+    session_state["msme_editor_50_b"] = {"edited_rows": {0: {"Remarks": "x"}}}
+    keys = editor_versions("msme", "msme_editor_50_b", row_keys(report([1, 1, 3, 1])), full.iloc[2:])
+    assert keys[VERSION_COLUMN].tolist() == [3, 1]
@@ -0,0 +1,41 @@
+import json
+
+import run_metrics
+from run_metrics import recorded_run, stage
+
+
+def test_stages_outside_a_run_are_not_kept(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "logs").mkdir()
+
+    with recorded_run(refresh="full"):
+        with stage("fetch Bookings") as fetched:
+            fetched.rows = 3
+    # as in the change stream listener, which never starts a run
+    for _ in range(100):
+        with stage("booking_process"):
+            pass
+    assert run_metrics._run is None
+
+    records = (tmp_path / "logs" / "run_metrics.jsonl").read_text().splitlines()
+    assert len(records) == 1
+    record = json.loads(records[0])
+    assert record["info"] == {"refresh": "full"}
+    assert list(record["stages"]) == ["fetch Bookings"]
+    assert record["stages"]["fetch Bookings"]["rows"] == 3
+
+
+def test_failed_run_is_written_and_ended(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "logs").mkdir()
+
+    try:
+        with recorded_run():
+            raise RuntimeError("fetch_data failed")
+    except RuntimeError:
+        pass
+    assert run_metrics._run is None
+    record = json.loads((tmp_path / "logs" / "run_metrics.jsonl").read_text())
+    assert record["success"] is False
+    assert record["error"] == "RuntimeError: fetch_data failed"
+    assert "msme_tracker_run_success 0" in (tmp_path / "logs" / "run_metrics.prom").read_text()
@@ -0,0 +1,108 @@
+"""
+Property test: compute_status agrees with the row-at-a-time determine_status on random reports,
+including which reports make it raise.
+"""
+import random
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from report_schema import apply_report_schema
+from report_store import SQLiteReportStore
+from status_rules import STATUS_REQUIRED_COLUMNS, compute_status, determine_status
+
+BLANKS = ['', '  ', None, np.nan]
+TEXT = ['Yes', 'x', 'Amazon Freight', ' padded ']
+# Values the number rules convert, and ones int() and float() refuse
+PALLETS = [0, 2, 2.5, 0.0, '0', '3', ' 4 ']
+QUOTES = [0, 0.0, 10.5, '0', '12.75', '0.0']
+BAD_PALLETS = ['2.5', '0.0', 'two']
+BAD_QUOTES = ['n/a', '1,000']
+STATUSES = ['', 'Old status', None, np.nan]
+
+
+def random_report(rng, rows):
+    """A report of rows rows whose status fields are blank often enough for every rule to apply."""
+    def column(pool, blank_share):
+        return [rng.choice(BLANKS) if rng.random() < blank_share else rng.choice(pool) for _ in range(rows)]
+
+    blank_share = rng.choice([0.05, 0.3, 0.6])
+    report = {col: column(TEXT, blank_share) for col in STATUS_REQUIRED_COLUMNS}
+    # about one report in five has a value the number rules refuse somewhere
+    bad = rng.random() < 0.2
+    report['Actual # of Pallets'] = column(PALLETS + BAD_PALLETS if bad else PALLETS, blank_share)
+    report['Delivery Quote'] = column(QUOTES + BAD_QUOTES if bad else QUOTES, blank_share)
+    report['status'] = [rng.choice(STATUSES) for _ in range(rows)]
+    return pd.DataFrame(report, dtype=object)
+
+
+def reference_status(report):
+    return report.apply(determine_status, axis=1)['status']
+
+
+def reference_status_keeping_bad_rows(report):
+    """determine_status row by row, with a row it raises on left as it was."""
+    def determine_or_keep(row):
+        try:
+            return determine_status(row.copy())
+        except (ValueError, TypeError):
+            return row
+    return report.apply(determine_or_keep, axis=1)['status']
+
+
+def outcome(function, report):
+    """function(report) as a comparable list, or the type of exception it raised."""
+    try:
+        status = function(report.copy())
+    except (ValueError, TypeError) as e:
+        return type(e)
+    return ['<missing>' if pd.isna(value) else value for value in status.tolist()]
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_compute_status_matches_determine_status(seed):
+    rng = random.Random(seed)
+    report = random_report(rng, rng.randint(1, 40))
+    assert outcome(compute_status, report) == outcome(reference_status, report)
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_compute_status_matches_determine_status_on_typed_reports(seed):
+    # Reports are loaded with the declared dtypes; the number columns then hold Int64 and floats
+    rng = random.Random(seed)
+    report = random_report(rng, rng.randint(1, 40))
+    report['Actual # of Pallets'] = [rng.choice([None, 0, 1, 3]) for _ in range(len(report))]
+    report['Delivery Quote'] = [rng.choice([None, 0.0, 10.5]) for _ in range(len(report))]
+    report['Ready for Pick-up Date'] = [rng.choice([None, '01-05-2025']) for _ in range(len(report))]
+    typed = apply_report_schema(report)
+    assert str(typed['Actual # of Pallets'].dtype) == 'Int64'
+    assert outcome(compute_status, typed) == outcome(reference_status, typed)
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_compute_status_keeps_rows_it_cannot_read(seed):
+    rng = random.Random(seed)
+    report = random_report(rng, rng.randint(1, 40))
+    report.loc[rng.randrange(len(report)), ['CFS', 'Actual # of Pallets', 'Ready for Pick-up Date']] = ['CFS', 'two', '01-05-2025']
+    keep = partial(compute_status, errors='keep')
+    assert outcome(keep, report) == outcome(reference_status_keeping_bad_rows, report)
+
+
+def test_merge_keeps_going_past_a_bad_number(import_app, tmp_path):
+    Backend_data = import_app("Backend_data")
+    benchmark = import_app("benchmark")
+    report = benchmark.make_report(3).astype(object)
+    report[STATUS_REQUIRED_COLUMNS] = ''
+    report['status'] = 'Old status'
+    report[['CFS', 'Actual # of Pallets', 'Ready for Pick-up Date']] = [['CFS', 'two', 'x'], ['CFS', '3', 'x'], ['', '', '']]
+    report[['Freight Broker', 'Transporter', 'Delivery Quote']] = [['', '', '']] * 2 + [['Amazon Freight', 'FedEx', '1.5']]
+    store = SQLiteReportStore(str(tmp_path / "report.sqlite"))
+    store.save(report)
+
+    merged = Backend_data.merge_into_store(store, report.drop(columns=['status', 'pickup type']))
+    # the first row keeps its status; the rules still apply to the others
+    assert merged['status'].tolist() == [
+        'Old status', 'Transport Assignment Pending', 'Delivery Order Release Approval Pending',
+    ]
@@ -0,0 +1,206 @@
+"""
+The change stream listener against fake streams: which booking an event names, how events are
+batched, and what happens when the stream's history is lost.
+"""
+import pytest
+from pymongo.errors import OperationFailure
+
+
+@pytest.fixture
+def streamjob(import_app, tmp_path, monkeypatch):
+    """streamjob with a fake clock, saving its resume token under tmp_path."""
+    streamjob = import_app("streamjob")
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    clock = FakeClock()
+    monkeypatch.setattr(streamjob, "time", clock)
+    return streamjob
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class StreamClosed(Exception):
+    """Raised by a fake stream once all its events are read and the last batch has had time to end."""
+
+
+class FakeStream:
+    """
+    Hands out (arrival time, event) pairs once the clock reaches them. try_next waits half a
+    second when nothing has arrived, as a real getMore waits for new events.
+    """
+
+    def __init__(self, clock, events, resume_token="start"):
+        self.clock = clock
+        self.events = list(events)
+        self.resume_token = resume_token
+        self.alive = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def try_next(self):
+        if self.events and self.events[0][0] <= self.clock.now:
+            _, event = self.events.pop(0)
+            self.resume_token = event["_id"]
+            return event
+        if not self.events and self.clock.now > 60:
+            raise StreamClosed()
+        self.clock.now += 0.5
+        return None
+
+
+class FakeDatabase:
+    """Opens the given streams in turn; a stream that is an exception is raised instead."""
+
+    def __init__(self, *streams):
+        self.streams = list(streams)
+        self.watched = []
+
+    def watch(self, pipeline, resume_after=None):
+        self.watched.append(resume_after)
+        stream = self.streams.pop(0)
+        if isinstance(stream, Exception):
+            raise stream
+        return stream
+
+
+def change(collection, document_key, token):
+    return {"_id": token, "operationType": "update", "ns": {"db": "agdb", "coll": collection}, "documentKey": document_key}
+
+
+def booking_change(booking_id, token):
+    return change("Bookings", {"_id": booking_id}, token)
+
+
+def record_batches(streamjob, monkeypatch):
+    """Replace applying and token saving with a log of both, in the order they happen."""
+    log = []
+    monkeypatch.setattr(streamjob, "apply_changes", lambda booking_ids: log.append(("apply", set(booking_ids))))
+    monkeypatch.setattr(streamjob, "save_resume_token", lambda token: log.append(("save", token)))
+    return log
+
+
+def test_booking_id_from_event(streamjob):
+    assert streamjob.booking_id_from_event(change("Bookings", {"_id": "B1"}, "t")) == "B1"
+    assert streamjob.booking_id_from_event(change("Bookingdsr", {"_id": "B2"}, "t")) == "B2"
+    # actions are keyed by booking and action together
+    action_key = {"_id": {"bookingNum": "B3", "actionName": "Invoice Acceptance"}}
+    assert streamjob.booking_id_from_event(change("Myactions", action_key, "t")) == "B3"
+    assert streamjob.booking_id_from_event(change("Myactions", {"_id": "A1"}, "t")) is None
+    assert streamjob.booking_id_from_event(change("Agusers", {"_id": "U1"}, "t")) is None
+    assert streamjob.booking_id_from_event({"_id": "t", "ns": {"coll": "Bookings"}}) is None
+
+
+def test_changes_within_the_window_are_applied_together(streamjob, monkeypatch):
+    log = record_batches(streamjob, monkeypatch)
+    events = [(0, booking_change("B1", "t1")), (1, booking_change("B2", "t2")), (1, booking_change("B1", "t3")),
+              (7, booking_change("B3", "t4")), (8, booking_change("B4", "t5"))]
+    with pytest.raises(StreamClosed):
+        streamjob.listen(FakeDatabase(FakeStream(streamjob.time, events)))
+
+    batches = [entry for entry in log if entry[0] == "apply"]
+    assert batches == [("apply", {"B1", "B2"}), ("apply", {"B3", "B4"})]
+    # each batch's token is saved after it is applied, not before
+    assert log.index(("apply", {"B1", "B2"})) + 1 == log.index(("save", "t3"))
+    assert log.index(("apply", {"B3", "B4"})) + 1 == log.index(("save", "t5"))
+
+
+def test_large_batches_are_applied_at_the_size_limit(streamjob, monkeypatch):
+    batches = []
+    monkeypatch.setattr(streamjob, "apply_changes", lambda booking_ids: batches.append((streamjob.time.now, set(booking_ids))))
+    monkeypatch.setattr(streamjob, "save_resume_token", lambda token: None)
+    monkeypatch.setattr(streamjob, "MAX_BATCH_SIZE", 3)
+    events = [(0, booking_change(f"B{i}", f"t{i}")) for i in range(7)]
+    with pytest.raises(StreamClosed):
+        streamjob.listen(FakeDatabase(FakeStream(streamjob.time, events)))
+
+    # the full batches are applied at once; the rest waits out the time window
+    assert batches == [(0, {"B0", "B1", "B2"}), (0, {"B3", "B4", "B5"}), (streamjob.BATCH_SECONDS, {"B6"})]
+
+
+def test_token_of_a_failed_batch_is_not_saved(streamjob, monkeypatch):
+    saved = []
+    monkeypatch.setattr(streamjob, "save_resume_token", saved.append)
+
+    def fail(booking_ids):
+        raise RuntimeError("fetch_data failed")
+    monkeypatch.setattr(streamjob, "apply_changes", fail)
+    with pytest.raises(RuntimeError):
+        streamjob.listen(FakeDatabase(FakeStream(streamjob.time, [(0, booking_change("B1", "t1"))])))
+    assert "t1" not in saved
+
+
+def test_apply_changes_retries_then_gives_up(streamjob, monkeypatch):
+    calls = []
+
+    def refresh(booking_ids, Addressdetails=None, users=True):
+        calls.append((booking_ids, users))
+        raise RuntimeError("fetch_data failed")
+    monkeypatch.setattr(streamjob.Backend_data, "run_incremental_refresh", refresh)
+    monkeypatch.setattr(streamjob, "cached_addressdetails", lambda: None)
+    with pytest.raises(RuntimeError):
+        streamjob.apply_changes({"B1"})
+    assert calls == [({"B1"}, False)] * streamjob.APPLY_ATTEMPTS
+    assert streamjob.time.sleeps == [10, 20, 40]
+
+
+class Stop(Exception):
+    """Ends run()'s loop, which is not one of the errors it recovers from."""
+
+
+def run_with(streamjob, monkeypatch, database, full_refresh):
+    client = type("FakeClient", (), {"__getitem__": lambda self, name: database, "close": lambda self: None})()
+    monkeypatch.setattr(streamjob, "MongoClient", lambda *args, **kwargs: client)
+    monkeypatch.setattr(streamjob.Backend_data, "main", full_refresh)
+    # run() points Backend_data at the database it watches; these restore the settings afterwards
+    for setting in ("MONGO_HOST", "MONGO_PORT", "MONGO_DATABASE"):
+        monkeypatch.setattr(streamjob.Backend_data, setting, getattr(streamjob.Backend_data, setting))
+    with pytest.raises(Stop):
+        streamjob.run("localhost", "27017", "agdb")
+
+
+def test_history_lost_resumes_from_before_the_full_refresh(streamjob, monkeypatch):
+    streamjob.save_resume_token("expired")
+    refreshes = []
+    database = FakeDatabase(
+        OperationFailure("resume point no longer in the oplog", code=streamjob.CHANGE_STREAM_HISTORY_LOST),
+        # the stream opened for its position before the refresh
+        FakeStream(streamjob.time, [], resume_token="before refresh"),
+        Stop(),
+    )
+    run_with(streamjob, monkeypatch, database, lambda full: refreshes.append((full, list(database.watched))))
+
+    # the stream's position was taken before the full refresh started
+    assert refreshes == [(True, ["expired", None])]
+    # the listener picks up from where the stream was when the refresh started
+    assert database.watched == ["expired", None, "before refresh"]
+    assert streamjob.load_resume_token() == "before refresh"
+
+
+def test_failed_full_refresh_keeps_the_old_token(streamjob, monkeypatch):
+    streamjob.save_resume_token("expired")
+    history_lost = OperationFailure("resume point no longer in the oplog", code=streamjob.CHANGE_STREAM_HISTORY_LOST)
+    database = FakeDatabase(history_lost, FakeStream(streamjob.time, [], resume_token="before refresh"), Stop())
+
+    def fail(full):
+        raise RuntimeError("fetch_data failed")
+    run_with(streamjob, monkeypatch, database, fail)
+
+    # so the next attempt finds the history lost again and reruns the full refresh
+    assert database.watched == ["expired", None, "expired"]
+    assert streamjob.load_resume_token() == "expired"
+    assert streamjob.time.sleeps == [streamjob.RESTART_SECONDS]
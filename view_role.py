@@ -1,26 +1,26 @@
-import io
 import streamlit as st
-import pandas as pd
+from functools import partial
+from report_export import EXPORT_MIME, export_file_name, export_formats, export_report
+from report_store import load_report
 
 def display_view_report():
     try:
-        report_df = pd.read_excel("data/report.xlsx")
+        report_df = load_report()
 
         st.write("### 📊 View Report")
         st.dataframe(report_df, use_container_width=True)
 
         # Download logic
-        buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            report_df.to_excel(writer, index=False, sheet_name='Report')
-        buffer.seek(0)
-
-        st.download_button(
-            label="📥 Download Report",
-            data=buffer,
-            file_name="MSME Tracker Report.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+        # Each file is built only when its button is clicked, once per report version
+        formats = export_formats()
+        for fmt, column in zip(formats, st.columns(len(formats))):
+            with column:
+                st.download_button(
+                    label=f"📥 Download Report ({fmt.upper()})",
+                    data=partial(export_report, fmt),
+                    file_name=export_file_name(fmt),
+                    mime=EXPORT_MIME[fmt]
+                )
 
     except Exception as e:
         st.error(f"Error loading report: {e}")
\ No newline at end of file